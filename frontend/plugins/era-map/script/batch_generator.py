@@ -0,0 +1,383 @@
+"""
+无界面的批量布局生成。
+
+对一段种子区间，在 ProcessPoolExecutor 的多个工作进程中各自运行完整的生成流程 (main_generator.run_generation)，
+主进程负责导出 layout_<seed>.json (或按 Settings.LAYOUT_FORMAT 导出二进制布局 layout_<seed>.bin)。场和粒子密度网格这类大数组通过 multiprocessing.shared_memory 交回主进程，
+而不是被 pickle 复制；对象只有几百个，按列 pickle 即可。
+
+每次运行记录生成、交接和导出的耗时，最后输出吞吐量汇总，并把逐次记录写入 batch_summary.json。
+工作进程中的管道日志默认转为 WARNING 级别的 logging 记录 (只输出警告和错误)；
+--profile 时每次生成都挂上性能分析器，各阶段的汇总合并后写入 batch_summary.json 的 profile 一项。
+
+用法:
+    python batch_generator.py --seeds 0:100 --out layouts
+    python batch_generator.py --seeds 0:1000 --workers 8 --out layouts --set GRID_WIDTH=60 --set GRID_HEIGHT=40
+    python batch_generator.py --settings my_settings:LargeRoom --seeds 100:200 --out layouts --no-export
+    python batch_generator.py --seeds 0:50 --out layouts --no-export --profile
+"""
+import argparse
+import ast
+import contextlib
+import importlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from functools import lru_cache
+from multiprocessing import resource_tracker, shared_memory
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from core_types import ParticleLayer
+from instrumentation import Profiler, format_stage_table, merge_stage_totals, quiet_output
+from io_and_vis import layout_encoding_options, layout_filenames, write_layout_json
+from layout_binary import write_layout_binary
+from layer_storage import copy_blocks
+from main_generator import run_generation
+from object_store import ObjectTable
+
+Overrides = Tuple[Tuple[str, object], ...]
+
+
+@dataclass(frozen=True)
+class SharedArray:
+    """放在共享内存中的数组的描述 (可以廉价地 pickle)：共享内存块的名字、形状和 dtype。"""
+    name: str
+    shape: Tuple[int, ...]
+    dtype: str
+
+    @classmethod
+    def publish(cls, array: np.ndarray) -> 'SharedArray':
+        """
+        把 array 复制到一块新的共享内存中 (memmap 上的数组分块复制)。
+        所有权交给读取方：本进程不再跟踪这块内存，由 attach() 的调用方在用完后释放。
+        """
+        shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+        try:
+            copy_blocks(np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf), array)
+        except BaseException:
+            _unlink_and_close(shm)
+            raise
+        shm.close()
+        # 否则工作进程退出时，它的资源跟踪器会把还没被读取的共享内存删掉
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return cls(shm.name, tuple(array.shape), array.dtype.str)
+
+    @contextlib.contextmanager
+    def attach(self) -> Iterator[np.ndarray]:
+        """在 with 块内以数组形式访问共享内存 (零复制)，退出时释放共享内存块。"""
+        shm = shared_memory.SharedMemory(name=self.name)
+        try:
+            array = np.ndarray(self.shape, dtype=np.dtype(self.dtype), buffer=shm.buf)
+            yield array
+            del array
+        finally:
+            _unlink_and_close(shm)
+
+    def discard(self):
+        """不读取，直接释放 (出错或不导出时使用)。已经释放过时什么也不做。"""
+        try:
+            shm = shared_memory.SharedMemory(name=self.name)
+        except FileNotFoundError:
+            return
+        _unlink_and_close(shm)
+
+
+def _unlink_and_close(shm: shared_memory.SharedMemory):
+    """
+    删除共享内存块并关闭本进程的映射。先删除名字：即使还有数组引用这块内存 (例如写出失败时异常回溯中的帧)，
+    关闭失败，内存也会在最后一个引用消失时被回收，不会泄漏。
+    """
+    shm.unlink()
+    try:
+        shm.close()
+    except BufferError:
+        pass
+
+
+@dataclass
+class RunResult:
+    """一次生成交回主进程的结果。"""
+    seed: int
+    object_columns: Dict[str, np.ndarray]
+    object_uids: np.ndarray
+    fields: Dict[str, SharedArray]
+    particles: Dict[str, Tuple[str, int, SharedArray]]  # 名字 -> (粒子类型, 粒子种子, 密度网格)
+    grid_size: Tuple[int, int]
+    generate_seconds: float
+    publish_seconds: float
+    profile: Optional[List[dict]] = None  # 各阶段的汇总 (Profiler.stage_totals)，没有分析时为 None
+
+    def shared_arrays(self) -> List[SharedArray]:
+        return list(self.fields.values()) + [grid for _, _, grid in self.particles.values()]
+
+
+# --- Settings 的来源 ---
+
+def parse_override(text: str) -> Tuple[str, object]:
+    """解析 NAME=VALUE；VALUE 按 Python 字面量解析 (数字、元组、None……)，解析失败时作为字符串。"""
+    name, sep, value = text.partition('=')
+    if not sep or not name.strip():
+        raise argparse.ArgumentTypeError(f"覆盖项 '{text}' 的格式应为 NAME=VALUE")
+    try:
+        parsed = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        parsed = value
+    return name.strip(), parsed
+
+
+@lru_cache(maxsize=None)
+def load_settings(source: str, overrides: Overrides = ()) -> type:
+    """按 'module:Attribute' 导入 Settings 类，再用 overrides 派生一个子类 (每个进程中只构建一次)。"""
+    module_name, _, attribute = source.partition(':')
+    settings = getattr(importlib.import_module(module_name), attribute or 'Settings')
+    if not overrides:
+        return settings
+    base = settings if isinstance(settings, type) else type(settings)
+    return type(f"{base.__name__}WithOverrides", (base,), dict(overrides))
+
+
+def parse_seed_range(text: str) -> range:
+    """'START:STOP' (不含 STOP) 或单个种子 'N'。"""
+    start, sep, stop = text.partition(':')
+    try:
+        return range(int(start), int(stop)) if sep else range(int(start), int(start) + 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"种子区间 '{text}' 的格式应为 START:STOP")
+
+
+# --- 工作进程 ---
+
+def generate_one(
+        source: str,
+        overrides: Overrides,
+        seed: int,
+        verbose: bool = False,
+        profile: bool = False,
+        trace_memory: bool = False
+) -> RunResult:
+    """在工作进程中生成一张布局，把场和粒子密度网格发布到共享内存。"""
+    settings = load_settings(source, overrides)
+    profiler = Profiler(trace_memory=trace_memory) if profile else None
+
+    start = time.perf_counter()
+    with contextlib.nullcontext() if verbose else quiet_output(), \
+            profiler if profiler is not None else contextlib.nullcontext():
+        context = run_generation(settings, seed=seed, profiler=profiler)
+    generated = time.perf_counter()
+
+    published: List[SharedArray] = []
+
+    def publish(array: np.ndarray) -> SharedArray:
+        shared = SharedArray.publish(array)
+        published.append(shared)
+        return shared
+
+    try:
+        result = RunResult(
+            seed=seed,
+            object_columns=context.objects.columns(),
+            object_uids=context.objects.uids.copy(),
+            fields={name: publish(array) for name, array in context.fields.items()},
+            particles={
+                name: (layer.type, layer.seed, publish(layer.density_grid))
+                for name, layer in context.particles.items()
+            },
+            grid_size=(context.grid_width, context.grid_height),
+            generate_seconds=generated - start,
+            publish_seconds=time.perf_counter() - generated,
+            profile=None if profiler is None else profiler.stage_totals(),
+        )
+    except BaseException:
+        # 发布到一半失败时 (例如共享内存不足)，已经发布的块不再受本进程跟踪，也不会有人读取，在这里释放
+        for shared in published:
+            shared.discard()
+        raise
+    finally:
+        context.storage.close()
+    return result
+
+
+# --- 主进程 ---
+
+def export_result(result: RunResult, out_dir: str, settings: type) -> List[str]:
+    """
+    把结果写成 layout_<seed>.json 和 / 或 layout_<seed>.bin (见 io_and_vis.layout_filenames；网格直接从共享内存流式写出)，
+    并释放共享内存。写出失败 (路径无效、磁盘已满……) 时共享内存同样被释放，异常继续向上抛出。返回写出的文件。
+    """
+    try:
+        objects = ObjectTable(capacity=len(result.object_uids))
+        objects.extend_columns(result.object_columns, uids=result.object_uids)
+        filenames = layout_filenames(settings, os.path.join(out_dir, f"layout_{result.seed}"))
+        meta_data = {"gridWidth": result.grid_size[0], "gridHeight": result.grid_size[1], "seed": result.seed}
+
+        with contextlib.ExitStack() as stack:
+            fields = {name: stack.enter_context(shared.attach()) for name, shared in result.fields.items()}
+            particles = {
+                name: ParticleLayer(
+                    type=particle_type, seed=particle_seed, density_grid=stack.enter_context(shared.attach())
+                )
+                for name, (particle_type, particle_seed, shared) in result.particles.items()
+            }
+            try:
+                if 'json' in filenames:
+                    write_layout_json(
+                        filenames['json'], meta_data, objects, fields, particles, **layout_encoding_options(settings)
+                    )
+                if 'binary' in filenames:
+                    write_layout_binary(
+                        filenames['binary'], meta_data, objects, fields, particles,
+                        compression=settings.LAYOUT_COMPRESSION
+                    )
+            finally:
+                # 共享内存只有在没有数组引用它时才能关闭
+                fields.clear()
+                particles.clear()
+    finally:
+        # 释放还没有附加的块 (例如附加前一块时就出错了)；已经随 attach() 释放的块会被跳过
+        for shared in result.shared_arrays():
+            shared.discard()
+    return list(filenames.values())
+
+
+def _discard_future(future):
+    """释放一个生成任务交回的全部共享内存 (任务失败、被取消或已经释放时什么也不做)。"""
+    if future.cancelled() or future.exception() is not None:
+        return
+    for shared in future.result().shared_arrays():
+        shared.discard()
+
+
+def _percentile(values: List[float], q: float) -> float:
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def run_batch(
+        source: str,
+        seeds: range,
+        out_dir: str,
+        workers: Optional[int] = None,
+        overrides: Overrides = (),
+        export: bool = True,
+        verbose: bool = False,
+        profile: bool = False,
+        trace_memory: bool = False
+) -> dict:
+    """并行生成 seeds 中的每一张布局，返回汇总 (同 batch_summary.json)。"""
+    workers = workers or os.cpu_count() or 1
+    os.makedirs(out_dir, exist_ok=True)
+    settings = load_settings(source, overrides)  # 在启动工作进程之前检查 Settings 能否加载
+    if export:
+        layout_filenames(settings, 'layout')  # 同样提前检查布局格式
+
+    print(f"--- 批量生成: {len(seeds)} 张布局 (种子 {seeds.start}..{seeds.stop - 1})，{workers} 个工作进程 ---")
+    runs = []
+    failures = []
+    profiles = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(generate_one, source, overrides, seed, verbose, profile, trace_memory): seed
+            for seed in seeds
+        }
+        try:
+            for future in as_completed(futures):
+                seed = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"!!! 种子 {seed} 生成失败: {e} !!!")
+                    failures.append({"seed": seed, "error": repr(e)})
+                    continue
+
+                export_start = time.perf_counter()
+                if export:
+                    export_result(result, out_dir, settings)
+                else:
+                    for shared in result.shared_arrays():
+                        shared.discard()
+                export_seconds = time.perf_counter() - export_start
+                if result.profile is not None:
+                    profiles.append(result.profile)
+
+                runs.append({
+                    "seed": seed,
+                    "objects": len(result.object_uids),
+                    "generateSeconds": round(result.generate_seconds, 4),
+                    "publishSeconds": round(result.publish_seconds, 4),
+                    "exportSeconds": round(export_seconds, 4),
+                })
+                print(f"  - 种子 {seed}: {len(result.object_uids)} 个对象，生成 {result.generate_seconds:.2f}s，"
+                      f"导出 {export_seconds:.2f}s ({len(runs)}/{len(seeds)})")
+        except BaseException as e:
+            # 导出失败 (路径无效、磁盘已满……) 通常对后面的布局同样成立，停止批量生成：
+            # 还没开始的生成被取消，已经交回或正在进行的生成等它们结束后释放全部共享内存
+            print(f"!!! 批量生成中止: {e!r}，正在释放其余结果的共享内存 !!!")
+            executor.shutdown(wait=True, cancel_futures=True)
+            for future in futures:
+                _discard_future(future)
+            raise
+    wall_seconds = time.perf_counter() - start
+
+    generate_times = [run["generateSeconds"] for run in runs]
+    summary = {
+        "settings": source,
+        "overrides": {name: repr(value) for name, value in overrides},
+        "workers": workers,
+        "completed": len(runs),
+        "failed": len(failures),
+        "wallSeconds": round(wall_seconds, 3),
+        "layoutsPerSecond": round(len(runs) / wall_seconds, 3) if wall_seconds > 0 else 0.0,
+        "generateSeconds": {
+            "mean": round(float(np.mean(generate_times)), 4) if generate_times else 0.0,
+            "p50": round(_percentile(generate_times, 50), 4),
+            "p95": round(_percentile(generate_times, 95), 4),
+            "max": round(max(generate_times, default=0.0), 4),
+        },
+        "exportSecondsTotal": round(sum(run["exportSeconds"] for run in runs), 3),
+        "runs": sorted(runs, key=lambda run: run["seed"]),
+        "failures": failures,
+    }
+    if profile:
+        summary["profile"] = merge_stage_totals(profiles)
+    with open(os.path.join(out_dir, "batch_summary.json"), 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=2)
+
+    print(f"--- 完成 {len(runs)}/{len(seeds)} 张 (失败 {len(failures)})，用时 {wall_seconds:.1f}s，"
+          f"吞吐量 {summary['layoutsPerSecond']:.2f} 张/秒 ---")
+    print(f"--- 单张生成耗时: 平均 {summary['generateSeconds']['mean']:.2f}s，"
+          f"p50 {summary['generateSeconds']['p50']:.2f}s，p95 {summary['generateSeconds']['p95']:.2f}s ---")
+    if profile:
+        print(f"--- 各阶段汇总 ({len(profiles)} 次生成) ---")
+        print(format_stage_table(summary["profile"]))
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="无界面的批量布局生成")
+    parser.add_argument("--settings", default="prototype:Settings", help="Settings 类，格式为 module:Attribute")
+    parser.add_argument("--set", dest="overrides", action="append", type=parse_override, default=[],
+                        metavar="NAME=VALUE", help="覆盖 Settings 中的参数 (可重复)")
+    parser.add_argument("--seeds", type=parse_seed_range, required=True, help="种子区间 START:STOP (不含 STOP)")
+    parser.add_argument("--out", required=True, help="输出目录")
+    parser.add_argument("--workers", type=int, default=None, help="工作进程数 (默认 CPU 核数)")
+    parser.add_argument("--no-export", action="store_true", help="只生成不导出 (测量生成吞吐量)")
+    parser.add_argument("--verbose", action="store_true", help="输出每次生成的管道日志")
+    parser.add_argument("--profile", action="store_true", help="记录每个阶段的耗时和计数器，汇总写入 batch_summary.json")
+    parser.add_argument("--trace-memory", action="store_true", help="性能分析时同时用 tracemalloc 记录内存峰值 (较慢)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s [%(processName)s] %(message)s")
+
+    summary = run_batch(
+        args.settings, args.seeds, args.out, workers=args.workers, overrides=tuple(args.overrides),
+        export=not args.no_export, verbose=args.verbose, profile=args.profile, trace_memory=args.trace_memory
+    )
+    if summary["failed"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+对比 apply_perlin_noise 的两个噪声后端：
+  - numpy:     向量化梯度噪声 (noise.fractal_noise_grid)
+  - reference: 逐格调用 PerlinNoise 的旧实现 (noise.reference_noise_grid)
+
+旧实现在大尺寸下需要几十分钟，因此只对前若干行计时，再按格子数线性外推 (结果标记为“估算”)。
+
+用法:
+    python benchmark_noise.py
+    python benchmark_noise.py --sizes 256 1024 --octaves 2 --reference-budget 10
+"""
+import argparse
+import time
+
+import numpy as np
+
+from noise import fractal_noise_grid, reference_noise_grid
+
+
+def _sample_coords(size: int, scale: float) -> np.ndarray:
+    return np.arange(size) * scale + 1234.5
+
+
+def time_numpy_backend(size: int, scale: float, octaves: int, repeats: int) -> float:
+    xs = _sample_coords(size, scale)
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fractal_noise_grid(xs, xs, octaves=octaves, seed=42)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def time_reference_backend(size: int, scale: float, octaves: int, budget_seconds: float) -> tuple:
+    """返回 (耗时秒数, 是否为外推估算)。"""
+    xs = _sample_coords(size, scale)
+
+    # 先用一行估算单行耗时，再决定在预算内能测多少行
+    start = time.perf_counter()
+    reference_noise_grid(xs[:1], xs, octaves=octaves, seed=42)
+    per_row = time.perf_counter() - start
+
+    rows = int(min(size, max(1, budget_seconds / max(per_row, 1e-9))))
+    start = time.perf_counter()
+    reference_noise_grid(xs[:rows], xs, octaves=octaves, seed=42)
+    elapsed = time.perf_counter() - start
+    return elapsed * size / rows, rows < size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="柏林噪声后端基准测试")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[256, 1024, 4096], help="正方形网格的边长")
+    parser.add_argument("--scale", type=float, default=0.1, help="噪声缩放，与 Settings.NOISE_SCALE 相同")
+    parser.add_argument("--octaves", type=int, default=1, help="八度数量")
+    parser.add_argument("--repeats", type=int, default=3, help="numpy 后端重复次数 (取最小值)")
+    parser.add_argument("--reference-budget", type=float, default=5.0, help="旧实现每个尺寸的计时预算 (秒)")
+    args = parser.parse_args()
+
+    print(f"{'size':>10} | {'numpy (s)':>12} | {'reference (s)':>16} | {'speedup':>10}")
+    print("-" * 58)
+    for size in args.sizes:
+        numpy_time = time_numpy_backend(size, args.scale, args.octaves, args.repeats)
+        ref_time, estimated = time_reference_backend(size, args.scale, args.octaves, args.reference_budget)
+        ref_label = f"{ref_time:.3f}" + (" (估算)" if estimated else "")
+        print(f"{f'{size}x{size}':>10} | {numpy_time:>12.4f} | {ref_label:>16} | {ref_time / numpy_time:>9.0f}x")
+
+
+if __name__ == "__main__":
+    main()
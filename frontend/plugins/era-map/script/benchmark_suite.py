@@ -0,0 +1,407 @@
+"""
+生成器的基准测试套件。
+
+对修改器、放置策略、粒子转换、JSON / 二进制导出和完整的生成流程做参数化计时：
+网格尺寸 (默认 30x20、128²、512²，--full 时加上 2048²) 与各基准自己的参数 (对象数、sigma、八度……) 的每一种组合是一个用例。
+所有随机输入和生成流程都使用固定种子 (BENCH_SEED)，不同提交之间的结果可以直接比较。
+
+每个用例重复若干次 (每次重新构建输入，构建不计时)，记录最小值和中位数；比较和回归判断都用最小值，它受系统噪声影响最小。
+结果写入 JSON；给出 --baseline 时与之逐个比较，任一用例比基线慢超过 --threshold (且绝对差超过 --min-delta) 即以非零状态退出。
+同一基准、同一组参数在不同尺寸上的耗时构成一条扩展曲线，输出按格子数做对数拟合得到的增长指数，--plot 时画成图。
+
+用法:
+    python benchmark_suite.py --out bench.json
+    python benchmark_suite.py --filter influence --sizes 128 512 1024
+    python benchmark_suite.py --full --save-baseline baseline.json
+    python benchmark_suite.py --baseline baseline.json --threshold 0.2 --plot scaling.png
+"""
+import argparse
+import fnmatch
+import itertools
+import json
+import logging
+import os
+import platform
+import tempfile
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from core_types import GenerationContext, convert_objects_to_particles
+from instrumentation import quiet_output
+from io_and_vis import export_context_to_binary, export_context_to_json
+from main_generator import create_generation_context, run_generation
+from modifiers import apply_perlin_noise, apply_influence_to_layer, bind_floating_objects_to_grid, reserve_grid_margin
+from placement_strategies import (
+    place_grid_objects_from_layer, place_one_grid_object_from_layer, place_floating_objects_from_layer
+)
+from prototype import Settings
+
+BENCH_SEED = 20240607
+
+GridSize = Tuple[int, int]
+DEFAULT_SIZES: Tuple[GridSize, ...] = ((30, 20), (128, 128), (512, 512))
+FULL_SIZES: Tuple[GridSize, ...] = DEFAULT_SIZES + ((2048, 2048),)
+
+
+@dataclass(frozen=True)
+class Benchmark:
+    """
+    一个参数化的基准。setup(size, **params) 构建输入 (不计时)，返回一个无参数的函数，只有它被计时。
+    params 是除尺寸之外的参数网格；max_cells 不为 None 时跳过格子数超过它的尺寸。
+    """
+    name: str
+    setup: Callable[..., Callable[[], object]]
+    params: Dict[str, tuple]
+    max_cells: Optional[int] = None
+
+    def cases(self, sizes: List[GridSize]) -> List[Tuple[GridSize, dict]]:
+        names = list(self.params)
+        combos = [dict(zip(names, values)) for values in itertools.product(*(self.params[n] for n in names))]
+        return [
+            (size, params) for size in sizes for params in combos
+            if self.max_cells is None or size[0] * size[1] <= self.max_cells
+        ]
+
+
+BENCHMARKS: List[Benchmark] = []
+
+
+def benchmark(max_cells: Optional[int] = None, **params) -> Callable:
+    """注册一个基准；名字取自函数名去掉 'bench_' 前缀。"""
+    def decorate(setup):
+        BENCHMARKS.append(Benchmark(setup.__name__[len('bench_'):], setup, params, max_cells))
+        return setup
+    return decorate
+
+
+def case_id(name: str, size: GridSize, params: dict) -> str:
+    """用例的稳定标识，也是结果和基线 JSON 中的键。"""
+    parts = [f"size={size[0]}x{size[1]}"] + [f"{k}={v}" for k, v in params.items()]
+    return f"{name}[{','.join(parts)}]"
+
+
+# --- 输入 ---
+
+def _settings(size: GridSize, **overrides) -> type:
+    return type('BenchSettings', (Settings,), {
+        'GRID_WIDTH': size[0], 'GRID_HEIGHT': size[1], 'SEED': BENCH_SEED, 'STAGE_WORKERS': 1, **overrides
+    })
+
+
+def _context(size: GridSize) -> GenerationContext:
+    """带一圈墙和一张随机概率层 'bench_prob' 的空上下文。"""
+    ctx = create_generation_context(_settings(size))
+    ctx = reserve_grid_margin(ctx, margin_width=1)
+    rng = np.random.default_rng(BENCH_SEED)
+    ctx.layers['bench_prob'] = rng.random(size, dtype=np.float32)
+    return ctx
+
+
+def _scatter(ctx: GenerationContext, obj_type: str, count: int):
+    rng = np.random.default_rng(BENCH_SEED + count)
+    positions = rng.uniform((0, 0), (ctx.grid_width, ctx.grid_height), size=(count, 2))
+    return ctx.add_floating_objects(obj_type, positions)
+
+
+# --- 基准 ---
+
+@benchmark(octaves=(1, 3))
+def bench_apply_perlin_noise(size: GridSize, octaves: int):
+    ctx = _context(size)
+    return lambda: apply_perlin_noise(ctx, 'bench_noise', 0.1, 1.0, octaves=octaves)
+
+
+@benchmark(sources=(16, 256), sigma=(2.0, 8.0), backend=('auto', 'window'))
+def bench_apply_influence_to_layer(size: GridSize, sources: int, sigma: float, backend: str):
+    ctx = _context(size)
+    selection = _scatter(ctx, 'SOURCE', sources)
+    return lambda: apply_influence_to_layer(ctx, 'bench_influence', selection, sigma=sigma, backend=backend)
+
+
+@benchmark(count=(16, 256))
+def bench_place_grid_objects_from_layer(size: GridSize, count: int):
+    ctx = _context(size)
+    return lambda: place_grid_objects_from_layer(ctx, 'bench_prob', count, 'CHAIR', (1, 1), {'CHAIR', 'WALL_RESERVED'})
+
+
+@benchmark(count=(16,))
+def bench_place_one_grid_object_from_layer(size: GridSize, count: int):
+    # 迭代放置的典型用法：每次只放一个，下一次的掩码在上一次的基础上增量更新
+    ctx = _context(size)
+
+    def run():
+        for _ in range(count):
+            place_one_grid_object_from_layer(ctx, 'bench_prob', 'TABLE', (2, 1), {'TABLE', 'WALL_RESERVED'})
+    return run
+
+
+@benchmark(count=(1000, 20000), min_spacing=(0.0, 1.0))
+def bench_place_floating_objects_from_layer(size: GridSize, count: int, min_spacing: float):
+    ctx = _context(size)
+    return lambda: place_floating_objects_from_layer(
+        ctx, 'bench_prob', count, 'ELF', {'WALL_RESERVED'}, min_spacing=min_spacing
+    )
+
+
+@benchmark(count=(5000, 200000))
+def bench_convert_objects_to_particles(size: GridSize, count: int):
+    ctx = _context(size)
+    _scatter(ctx, 'GRIME_SMALL', count)
+    ctx = bind_floating_objects_to_grid(ctx)
+    return lambda: convert_objects_to_particles(ctx, 'GRIME_SMALL', 'grime', seed=BENCH_SEED)
+
+
+def _export_context(size: GridSize, objects: int) -> GenerationContext:
+    """带对象、一个光照场和一个粒子层的上下文，和完整流程导出时的内容相同。"""
+    ctx = _context(size)
+    _scatter(ctx, 'ELF', objects)
+    _scatter(ctx, 'GRIME_SMALL', 5000)
+    ctx = bind_floating_objects_to_grid(ctx)
+    ctx = convert_objects_to_particles(ctx, 'GRIME_SMALL', 'grime', seed=BENCH_SEED)
+    ctx.fields['light_level'] = ctx.layers.read('bench_prob')
+    return ctx
+
+
+@benchmark(objects=(200, 5000))
+def bench_export_context_to_json(size: GridSize, objects: int):
+    ctx = _export_context(size, objects)
+    settings = _settings(size)
+    filename = os.path.join(_scratch_dir(), 'layout.json')
+    return lambda: export_context_to_json(ctx, settings, filename)
+
+
+@benchmark(objects=(200, 5000), compression=(None, 'gzip'))
+def bench_export_context_to_binary(size: GridSize, objects: int, compression: Optional[str]):
+    ctx = _export_context(size, objects)
+    settings = _settings(size)
+    filename = os.path.join(_scratch_dir(), 'layout.bin')
+    return lambda: export_context_to_binary(ctx, settings, filename, compression=compression)
+
+
+@benchmark(count_scale=(1, 4))
+def bench_full_flow(size: GridSize, count_scale: int):
+    # 与 main_generator 的 __main__ 相同：完整生成并导出 JSON (不绘图)
+    settings = _settings(size, **{
+        name: getattr(Settings, name) * count_scale
+        for name in ('NUM_TABLES', 'NUM_WINDOWS', 'NUM_TORCHES', 'GRIME_SPLATTER_COUNT', 'NUM_LARGE_GRIME_PATCHES',
+                     'NUM_ELVES', 'NUM_DWARVES', 'NUM_MUSHROOM_PEOPLE')
+    })
+    filename = os.path.join(_scratch_dir(), 'layout.json')
+
+    def run():
+        context = run_generation(settings)
+        export_context_to_json(context, settings, filename)
+        context.storage.close()
+    return run
+
+
+_SCRATCH: Optional[tempfile.TemporaryDirectory] = None
+
+
+def _scratch_dir() -> str:
+    global _SCRATCH
+    if _SCRATCH is None:
+        _SCRATCH = tempfile.TemporaryDirectory(prefix='era-map-bench-')
+    return _SCRATCH.name
+
+
+# --- 计时 ---
+
+def time_case(bench: Benchmark, size: GridSize, params: dict, repeats: int, budget_seconds: float) -> List[float]:
+    """重复运行一个用例，返回每次的耗时；至少运行一次，总时间超出预算后不再重复。"""
+    times = []
+    started = time.perf_counter()
+    for _ in range(repeats):
+        with quiet_output(logging.ERROR):
+            run = bench.setup(size, **params)
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+        if time.perf_counter() - started > budget_seconds:
+            break
+    return times
+
+
+def run_suite(
+        sizes: List[GridSize],
+        patterns: List[str],
+        repeats: int,
+        budget_seconds: float
+) -> dict:
+    results = {}
+    selected = [b for b in BENCHMARKS if not patterns or any(fnmatch.fnmatch(b.name, f"*{p}*") for p in patterns)]
+    print(f"{'case':<78} | {'min (ms)':>10} | {'median (ms)':>11} | {'runs':>4}")
+    print("-" * 112)
+    for bench in selected:
+        for size, params in bench.cases(sizes):
+            key = case_id(bench.name, size, params)
+            times = time_case(bench, size, params, repeats, budget_seconds)
+            results[key] = {
+                "benchmark": bench.name,
+                "size": list(size),
+                "cells": size[0] * size[1],
+                "params": params,
+                "min": min(times),
+                "median": float(np.median(times)),
+                "runs": len(times),
+            }
+            print(f"{key:<78} | {min(times) * 1000:>10.3f} | {np.median(times) * 1000:>11.3f} | {len(times):>4}")
+    return {
+        "meta": {
+            "seed": BENCH_SEED,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpuCount": os.cpu_count(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+        "curves": scaling_curves(results),
+    }
+
+
+# --- 扩展曲线 ---
+
+def scaling_curves(results: Dict[str, dict]) -> List[dict]:
+    """
+    把同一基准、同一组参数在不同尺寸上的结果连成曲线 (按格子数排序)。
+    exponent 是 log(耗时) 对 log(格子数) 的拟合斜率：1 表示线性增长，0 表示与网格尺寸无关。
+    """
+    series: Dict[Tuple[str, str], List[dict]] = {}
+    for result in results.values():
+        label = ",".join(f"{k}={v}" for k, v in result["params"].items())
+        series.setdefault((result["benchmark"], label), []).append(result)
+
+    curves = []
+    for (name, label), points in series.items():
+        points.sort(key=lambda r: r["cells"])
+        cells = [p["cells"] for p in points]
+        seconds = [p["min"] for p in points]
+        exponent = None
+        if len(points) >= 2 and min(seconds) > 0:
+            exponent = round(float(np.polyfit(np.log(cells), np.log(seconds), 1)[0]), 3)
+        curves.append({"benchmark": name, "params": label, "cells": cells, "seconds": seconds, "exponent": exponent})
+    return curves
+
+
+def print_curves(curves: List[dict]):
+    print(f"\n{'benchmark':<36} | {'params':<40} | {'exponent':>8}")
+    print("-" * 90)
+    for curve in curves:
+        exponent = '-' if curve["exponent"] is None else f"{curve['exponent']:.2f}"
+        print(f"{curve['benchmark']:<36} | {curve['params']:<40} | {exponent:>8}")
+
+
+def plot_curves(curves: List[dict], filename: str):
+    """每个基准一张对数坐标子图，每组参数一条曲线。"""
+    import matplotlib.pyplot as plt
+
+    names = list(dict.fromkeys(curve["benchmark"] for curve in curves))
+    cols = min(3, len(names))
+    rows = (len(names) + cols - 1) // cols
+    fig, axes = plt.subplots(rows, cols, figsize=(6 * cols, 4.5 * rows), squeeze=False)
+    for ax, name in zip(axes.flat, names):
+        for curve in (c for c in curves if c["benchmark"] == name):
+            label = curve["params"] or "default"
+            if curve["exponent"] is not None:
+                label += f" (k={curve['exponent']:.2f})"
+            ax.loglog(curve["cells"], curve["seconds"], marker='o', label=label)
+        ax.set_title(name)
+        ax.set_xlabel("cells")
+        ax.set_ylabel("seconds (min)")
+        ax.grid(True, which='both', alpha=0.3)
+        ax.legend(fontsize=7)
+    for ax in list(axes.flat)[len(names):]:
+        ax.set_visible(False)
+    fig.tight_layout()
+    fig.savefig(filename, dpi=120)
+    plt.close(fig)
+    print(f"--- 扩展曲线已保存到 '{filename}' ---")
+
+
+# --- 基线比较 ---
+
+def compare_to_baseline(results: Dict[str, dict], baseline: Dict[str, dict], threshold: float, min_delta: float) -> List[str]:
+    """逐个用例与基线比较最小耗时，返回回归的用例。基线中没有的用例只列出，不算回归。"""
+    regressions = []
+    print(f"\n{'case':<78} | {'base (ms)':>10} | {'now (ms)':>10} | {'ratio':>6} | status")
+    print("-" * 122)
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            print(f"{key:<78} | {'-':>10} | {result['min'] * 1000:>10.3f} | {'-':>6} | new")
+            continue
+        ratio = result["min"] / base["min"] if base["min"] > 0 else float('inf')
+        regressed = ratio > 1 + threshold and result["min"] - base["min"] > min_delta
+        improved = ratio < 1 / (1 + threshold)
+        status = "REGRESSION" if regressed else ("faster" if improved else "ok")
+        if regressed:
+            regressions.append(key)
+        print(f"{key:<78} | {base['min'] * 1000:>10.3f} | {result['min'] * 1000:>10.3f} | {ratio:>6.2f} | {status}")
+    return regressions
+
+
+def parse_size(text: str) -> GridSize:
+    """'512' 表示 512x512，也可以写成 'WxH'。"""
+    w, sep, h = text.lower().partition('x')
+    try:
+        return (int(w), int(h)) if sep else (int(w), int(w))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"网格尺寸 '{text}' 的格式应为 N 或 WxH")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="生成器的基准测试套件")
+    parser.add_argument("--sizes", type=parse_size, nargs="+", default=None,
+                        help="网格尺寸，N 或 WxH (默认 30x20 128 512)")
+    parser.add_argument("--full", action="store_true", help="尺寸加上 2048x2048")
+    parser.add_argument("--filter", nargs="+", default=[], help="只运行名字包含这些子串的基准")
+    parser.add_argument("--repeats", type=int, default=5, help="每个用例的最多重复次数")
+    parser.add_argument("--budget", type=float, default=10.0, help="每个用例的计时预算 (秒)，超出后不再重复")
+    parser.add_argument("--out", default=None, help="把结果写入该 JSON 文件")
+    parser.add_argument("--baseline", default=None, help="与该基线 JSON 比较，有回归时以非零状态退出")
+    parser.add_argument("--threshold", type=float, default=0.25, help="相对基线变慢超过该比例视为回归")
+    parser.add_argument("--min-delta", type=float, default=0.001, help="绝对差小于该秒数时不视为回归 (过滤计时噪声)")
+    parser.add_argument("--save-baseline", default=None, help="把本次结果保存为基线")
+    parser.add_argument("--plot", default=None, help="把扩展曲线画到该图片文件")
+    parser.add_argument("--list", action="store_true", help="只列出用例，不运行")
+    args = parser.parse_args()
+
+    sizes = list(args.sizes or (FULL_SIZES if args.full else DEFAULT_SIZES))
+    if args.full and args.sizes:
+        sizes += [s for s in FULL_SIZES[len(DEFAULT_SIZES):] if s not in sizes]
+    # 基准运行期间的管道输出只保留错误 (见 time_case)
+    logging.basicConfig(format="%(levelname)s %(message)s")
+
+    if args.list:
+        for bench in BENCHMARKS:
+            if not args.filter or any(p in bench.name for p in args.filter):
+                for size, params in bench.cases(sizes):
+                    print(case_id(bench.name, size, params))
+        return
+
+    report = run_suite(sizes, args.filter, args.repeats, args.budget)
+    print_curves(report["curves"])
+
+    for filename in (args.out, args.save_baseline):
+        if filename:
+            with open(filename, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+            print(f"--- 结果已写入 '{filename}' ---")
+    if args.plot:
+        plot_curves(report["curves"], args.plot)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)["results"]
+        regressions = compare_to_baseline(report["results"], baseline, args.threshold, args.min_delta)
+        if regressions:
+            raise SystemExit(f"{len(regressions)} 个用例相对基线出现回归: {', '.join(regressions)}")
+        print("--- 没有发现回归 ---")
+
+
+if __name__ == "__main__":
+    main()
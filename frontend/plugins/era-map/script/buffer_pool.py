@@ -0,0 +1,68 @@
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+
+BufferKey = Tuple[Tuple[int, ...], str]
+
+
+class BufferPool:
+    """
+    按 (形状, dtype) 复用临时数组的缓冲池。
+
+    迭代放置循环中每一轮都需要若干张与网格同尺寸的临时图 (归一化光照、黑暗度、最终概率……)，
+    从池中借用并在用完后归还，稳定状态下就不再有任何整张网格大小的新分配。
+    借出的数组内容是未定义的 (不会清零)，调用方需要自己完整写入。
+    借用和归还是线程安全的，并发运行的阶段可以共用同一个缓冲池。
+    """
+
+    def __init__(self, max_free_per_key: int = 8):
+        self.max_free_per_key = max_free_per_key
+        self._free: Dict[BufferKey, List[np.ndarray]] = {}
+        self._lock = threading.Lock()
+        # 统计：新分配的次数和从池中复用的次数
+        self.allocations = 0
+        self.reuses = 0
+
+    @staticmethod
+    def _key(shape, dtype) -> BufferKey:
+        return tuple(int(n) for n in np.atleast_1d(shape)), np.dtype(dtype).str
+
+    def acquire(self, shape, dtype=np.float64) -> np.ndarray:
+        """借出一个指定形状和 dtype 的数组 (内容未初始化)。"""
+        with self._lock:
+            free = self._free.get(self._key(shape, dtype))
+            if free:
+                self.reuses += 1
+                return free.pop()
+            self.allocations += 1
+        return np.empty(shape, dtype=dtype)
+
+    def release(self, *buffers: np.ndarray):
+        """归还数组。只接受自己拥有数据的数组 (不能是视图)，超出上限的直接丢弃。"""
+        with self._lock:
+            for buffer in buffers:
+                if buffer is None or buffer.base is not None:
+                    continue
+                free = self._free.setdefault(self._key(buffer.shape, buffer.dtype), [])
+                if len(free) < self.max_free_per_key and not any(b is buffer for b in free):
+                    free.append(buffer)
+
+    @contextmanager
+    def scratch(self, shape, dtype=np.float64, count: int = 1) -> Iterator:
+        """在 with 块内借用 count 个临时数组，退出时自动归还。count 为 1 时直接给出数组本身。"""
+        buffers = [self.acquire(shape, dtype) for _ in range(count)]
+        try:
+            yield buffers[0] if count == 1 else buffers
+        finally:
+            self.release(*buffers)
+
+    def clear(self):
+        with self._lock:
+            self._free.clear()
+
+    @property
+    def pooled_bytes(self) -> int:
+        with self._lock:
+            return sum(b.nbytes for free in self._free.values() for b in free)
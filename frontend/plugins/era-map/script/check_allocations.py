@@ -0,0 +1,130 @@
+"""
+用 tracemalloc 检查迭代放置循环在稳定状态下的内存分配。
+
+对 lighting_pipeline 中“放置窗户并更新光照”这一轮做两种写法的对比：
+  - legacy: 每轮分配新的归一化光照、黑暗度和概率图 (重构前的写法)
+  - pooled: 通过 out= 把所有整图计算写进从 ctx.buffers 借来的缓冲区 (现在的写法)
+
+先做几轮预热，让缓冲池、缓存掩码、对象表容量都进入稳定状态，
+再统计每轮的瞬时峰值 (峰值 - 轮前占用)，以“相当于几张整图”为单位输出。
+pooled 写法剩下的约 128KB 是 NumPy 在混合类型运算 (float32 × bool，以及 float32 概率写入 float64 累积分布) 时
+使用的固定大小类型转换缓冲 (np.getbufsize() 个元素)，网格达到约 91x91 之后就不再随网格变大。
+--strict 先在这个“刚好用满缓冲”的网格上测出常数基线，再看目标网格的峰值比基线多出的部分
+相当于两者之间面积差的多少倍：达到一整张图就说明每轮仍在分配整图大小的数组。
+
+用法:
+    python check_allocations.py
+    python check_allocations.py --size 512 --iterations 20 --strict
+"""
+import argparse
+import logging
+import math
+import tracemalloc
+
+import numpy as np
+
+from instrumentation import quiet_output
+from main_generator import create_generation_context
+from modifiers import (
+    safe_normalize, create_layer_from_coordinates, apply_influence_from_points, combine_layers,
+    ensure_layer_exists, apply_influence_to_layer
+)
+from placement_strategies import place_one_grid_object_from_layer
+from prototype import Settings
+
+
+def _prepare_context(size: int):
+    class LargeSettings(Settings):
+        GRID_WIDTH = size
+        GRID_HEIGHT = size
+        SEED = 0
+
+    ctx = create_generation_context(LargeSettings)
+    w, h = ctx.grid_width, ctx.grid_height
+    edge = [(x, 0) for x in range(w)] + [(x, h - 1) for x in range(w)]
+    edge += [(0, y) for y in range(1, h - 1)] + [(w - 1, y) for y in range(1, h - 1)]
+    ctx = ensure_layer_exists(ctx, 'global_light_map', fill_value=0.0)
+    ctx = create_layer_from_coordinates(ctx, 'window_edge_suitability', edge)
+    ctx = apply_influence_from_points(ctx, 'symmetry_attraction', [(0, h / 2), (w - 1, h / 2)], sigma=w / 4)
+    ctx = combine_layers(ctx, 'window_base_prob', 'window_edge_suitability', 'symmetry_attraction', mode='multiply')
+    return ctx
+
+
+def _legacy_step(ctx, buffer):
+    normalized_light = safe_normalize(ctx.layers['global_light_map'])
+    darkness_map = 1.0 - normalized_light
+    prob = ctx.layers['window_base_prob'] * darkness_map
+    return prob
+
+
+def _pooled_step(ctx, buffer):
+    prob = safe_normalize(ctx.layers.read('global_light_map'), out=buffer)
+    np.subtract(1.0, prob, out=prob)
+    prob *= ctx.layers.read('window_base_prob')
+    return prob
+
+
+def baseline_size() -> int:
+    """NumPy 类型转换缓冲刚好用满的最小正方形网格边长。"""
+    return math.isqrt(np.getbufsize() - 1) + 1
+
+
+def measure(step, size: int, iterations: int, warmup: int) -> tuple:
+    """返回 (每轮瞬时峰值的最大值 (字节), 缓冲池新分配次数, 复用次数)。"""
+    with quiet_output(logging.ERROR):
+        ctx = _prepare_context(size)
+        buffer = ctx.buffers.acquire((size, size))
+        peaks = []
+        tracemalloc.start()
+        for i in range(warmup + iterations):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+
+            prob = step(ctx, buffer)
+            ctx, window = place_one_grid_object_from_layer(ctx, prob, "WINDOW", (1, 1), blocked_by={"WINDOW"})
+            if window is not None:
+                ctx = apply_influence_to_layer(
+                    ctx, 'global_light_map', [window], sigma=8.0,
+                    strength_multiplier=lambda o: 0.4, mode='add', backend='window'
+                )
+            del prob
+
+            if i >= warmup:
+                peaks.append(tracemalloc.get_traced_memory()[1] - before)
+        tracemalloc.stop()
+    return max(peaks), ctx.buffers.allocations, ctx.buffers.reuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description="迭代放置循环的内存分配检查")
+    parser.add_argument("--size", type=int, default=256, help="正方形网格的边长")
+    parser.add_argument("--iterations", type=int, default=10, help="统计的轮数")
+    parser.add_argument("--warmup", type=int, default=3, help="预热轮数")
+    parser.add_argument("--strict", action="store_true", help="pooled 写法扣除常数基线后每轮瞬时分配仍达到一整张图时以非零状态退出")
+    args = parser.parse_args()
+
+    layer_dtype = np.dtype(Settings.LAYER_DTYPE)
+    grid_bytes = args.size * args.size * layer_dtype.itemsize
+    print(f"网格 {args.size}x{args.size}，一张 {layer_dtype} 整图 = {grid_bytes / 1024:.0f} KB")
+    print(f"{'variant':>8} | {'peak / iter (KB)':>17} | {'grids':>6} | {'pool allocs':>11} | {'pool reuses':>11}")
+    print("-" * 66)
+
+    results = {}
+    for name, step in (("legacy", _legacy_step), ("pooled", _pooled_step)):
+        peak, allocations, reuses = measure(step, args.size, args.iterations, args.warmup)
+        results[name] = peak
+        print(f"{name:>8} | {peak / 1024:>17.1f} | {peak / grid_bytes:>6.2f} | {allocations:>11} | {reuses:>11}")
+
+    if args.strict:
+        ref = baseline_size()
+        if args.size <= ref:
+            parser.error(f"--strict 需要 --size 大于 {ref}")
+        baseline = measure(_pooled_step, ref, args.iterations, args.warmup)[0]
+        excess = (results["pooled"] - baseline) / (grid_bytes - ref * ref * layer_dtype.itemsize)
+        print(f"常数基线 (pooled, {ref}x{ref}) = {baseline / 1024:.1f} KB，扣除后 pooled 每轮约 {excess:.2f} 张整图")
+        if excess >= 1.0:
+            raise SystemExit("pooled 写法在稳定状态下仍然分配了整张网格大小的数组")
+
+
+if __name__ == "__main__":
+    main()
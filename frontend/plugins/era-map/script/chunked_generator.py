@@ -0,0 +1,480 @@
+"""
+分块生成超大世界。
+
+世界被切成 CHUNK_TILE_SIZE × CHUNK_TILE_SIZE 的块，每块向外多生成一圈光环 (halo)，
+光环宽度不小于最大的影响半径。每块在自己的 GenerationContext (网格 = 核心 + 光环) 上运行完整的管道，
+只保留锚点落在核心内的对象。为了让结果在接缝处连续：
+  - 噪声按世界坐标采样，噪声流从世界级种子派生，所有块拿到同一张噪声 (见 apply_perlin_noise)；
+  - 影响图在分块模式下按固定尺度归一化 (见 modifiers._apply_influence)；
+  - 块按 2×2 奇偶性分成 4 组依次生成，同组的块互不相邻，可以并行；生成一块之前，
+    已完成的相邻块落在光环内的对象先放进它的上下文，占用、排斥、间距和光照都能看到它们；
+  - 导出的光照场在所有对象放好之后按块重新计算，再用全世界的最小/最大值归一化。
+
+每块的种子由世界种子和块坐标确定，相同的种子和参数总是得到相同的世界 (与并行进程数无关)。
+每块的对象保存在 tiles/ 下的 npz 中，光照场和脏污粒子密度直接写入世界大小的 .npy 内存映射文件，
+对象逐块追加到 objects.jsonl，因此世界大小只受磁盘限制，而不受内存限制。
+
+Settings 中的对象数量 (NUM_TABLES 等) 被解释为每 GRID_WIDTH × GRID_HEIGHT 面积上的密度，
+窗户和火把的数量则按世界外墙的长度折算。
+
+用法:
+    python chunked_generator.py --width 512 --height 512 --out world_out
+    python chunked_generator.py --width 4096 --height 4096 --seed 7 --workers 4 --out world_out
+"""
+import argparse
+import contextlib
+import glob
+import json
+import logging
+import math
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from core_types import GenerationContext
+from influence import DEFAULT_TRUNCATE
+from instrumentation import quiet_output
+from io_and_vis import _iter_object_dicts
+from layer_graph import normalize_tolerance
+from layer_storage import COPY_BLOCK_ELEMENTS
+from main_generator import create_generation_context, run_pipelines, GRIME_PARTICLE_TYPE, GRIME_PARTICLE_SEED
+from modifiers import reserve_grid_margin, bind_floating_objects_to_grid, ensure_layer_exists, apply_influence_to_layer
+from object_store import ObjectTable
+from prototype import Settings
+
+# 按面积折算到每块的数量，以及按外墙长度折算的数量
+AREA_SCALED_COUNTS = (
+    'NUM_TABLES', 'GRIME_SPLATTER_COUNT', 'NUM_LARGE_GRIME_PATCHES',
+    'NUM_ELVES', 'NUM_DWARVES', 'NUM_MUSHROOM_PEOPLE'
+)
+EDGE_SCALED_COUNTS = ('NUM_WINDOWS', 'NUM_TORCHES')
+
+Columns = Dict[str, np.ndarray]
+
+
+@dataclass(frozen=True)
+class Tile:
+    """一个分块：[x0, x1) × [y0, y1) 是核心 (世界坐标)，[rx0, rx1) × [ry0, ry1) 是加上光环并裁剪到世界范围后的网格。"""
+    tx: int
+    ty: int
+    x0: int
+    y0: int
+    x1: int
+    y1: int
+    rx0: int
+    ry0: int
+    rx1: int
+    ry1: int
+
+    @property
+    def key(self) -> Tuple[int, int]:
+        return self.tx, self.ty
+
+    @property
+    def color(self) -> int:
+        """2×2 奇偶着色：同色的块之间至少隔着一整块，只要光环不超过块边长，同色块之间就互不影响。"""
+        return (self.tx % 2) + 2 * (self.ty % 2)
+
+    @property
+    def origin(self) -> Tuple[int, int]:
+        return self.rx0, self.ry0
+
+    @property
+    def region_size(self) -> Tuple[int, int]:
+        return self.rx1 - self.rx0, self.ry1 - self.ry0
+
+    @property
+    def core_slices(self) -> Tuple[slice, slice]:
+        """核心在块网格中的下标范围。"""
+        return slice(self.x0 - self.rx0, self.x1 - self.rx0), slice(self.y0 - self.ry0, self.y1 - self.ry0)
+
+    def neighbour_keys(self) -> List[Tuple[int, int]]:
+        return [(self.tx + dx, self.ty + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx or dy]
+
+
+def influence_halo(settings: Settings) -> int:
+    """
+    光环宽度：最大的影响半径 (sigma × 截断倍数)。
+    离核心更远的对象对核心的影响恒为 0，因此光环之外的内容不会改变核心的生成结果。
+    """
+    sigmas = (
+        settings.TABLE_REPULSION_SIGMA, settings.SOCIAL_ATTRACTION_SIGMA, settings.GRIME_CORE_INFLUENCE_RADIUS,
+        settings.WINDOW_LIGHT_SIGMA, settings.TORCH_LIGHT_SIGMA, settings.TORCH_WALL_ATTRACTION_SIGMA
+    )
+    return int(math.ceil(max(DEFAULT_TRUNCATE * max(sigmas), settings.CHARACTER_MIN_SPACING)))
+
+
+def plan_tiles(world_w: int, world_h: int, tile_size: int, halo: int) -> List[Tile]:
+    """把世界切成块 (按行优先顺序返回)。光环不能超过块边长，否则同色的块会互相影响。"""
+    if halo > tile_size:
+        raise ValueError(f"光环宽度 {halo} 超过了块边长 {tile_size}，请增大 CHUNK_TILE_SIZE")
+    tiles = []
+    for ty, y0 in enumerate(range(0, world_h, tile_size)):
+        for tx, x0 in enumerate(range(0, world_w, tile_size)):
+            x1, y1 = min(x0 + tile_size, world_w), min(y0 + tile_size, world_h)
+            tiles.append(Tile(
+                tx, ty, x0, y0, x1, y1,
+                max(0, x0 - halo), max(0, y0 - halo), min(world_w, x1 + halo), min(world_h, y1 + halo)
+            ))
+    return tiles
+
+
+def _world_edge_cells(tile: Tile, world_w: int, world_h: int) -> int:
+    """块网格中落在世界外墙 (最外一圈) 上的格子数。"""
+    xs = np.arange(tile.rx0, tile.rx1)
+    ys = np.arange(tile.ry0, tile.ry1)
+    on_edge = ((xs == 0) | (xs == world_w - 1))[:, None] | ((ys == 0) | (ys == world_h - 1))[None, :]
+    return int(np.count_nonzero(on_edge))
+
+
+def tile_settings(settings: Settings, tile: Tile, world_w: int, world_h: int) -> type:
+    """为一块派生 Settings：网格尺寸为块网格的尺寸，对象数量按面积 (窗户和火把按外墙长度) 折算。"""
+    base = settings if isinstance(settings, type) else type(settings)
+    w, h = tile.region_size
+    area_factor = (w * h) / (settings.GRID_WIDTH * settings.GRID_HEIGHT)
+    edge_factor = _world_edge_cells(tile, world_w, world_h) / (2 * (settings.GRID_WIDTH + settings.GRID_HEIGHT) - 4)
+
+    overrides = {'GRID_WIDTH': w, 'GRID_HEIGHT': h}
+    for name in AREA_SCALED_COUNTS:
+        overrides[name] = int(round(getattr(settings, name) * area_factor))
+    for name in EDGE_SCALED_COUNTS:
+        overrides[name] = int(round(getattr(settings, name) * edge_factor))
+    return type(f"TileSettings_{tile.tx}_{tile.ty}", (base,), overrides)
+
+
+def create_tile_context(settings: type, world_seed: int, world_size: Tuple[int, int], tile: Tile) -> GenerationContext:
+    """
+    用 tile_settings 派生的 Settings 创建一块的生成上下文：
+    块自己的种子由 (世界种子, 块坐标) 确定，噪声等世界级的流从世界种子派生。
+    """
+    ctx = create_generation_context(settings)
+    ctx.origin = tile.origin
+    ctx.world_size = tuple(world_size)
+    ctx.seed_sequence = np.random.SeedSequence(world_seed, spawn_key=tile.key)
+    ctx.world_seed_sequence = np.random.SeedSequence(world_seed)
+    return ctx
+
+
+# --- 对象列的搬运 ---
+
+def _tile_objects_path(tiles_dir: str, key: Tuple[int, int]) -> str:
+    return os.path.join(tiles_dir, f"tile_{key[0]}_{key[1]}.npz")
+
+
+def save_tile_objects(tiles_dir: str, tile: Tile, columns: Columns):
+    np.savez(_tile_objects_path(tiles_dir, tile.key), **columns)
+
+
+def load_tile_objects(tiles_dir: str, keys: Iterable[Tuple[int, int]]) -> Optional[Columns]:
+    """读取并拼接若干块已保存的对象 (世界坐标)；还没有生成的块直接跳过，一块都没有时返回 None。"""
+    parts = []
+    for key in keys:
+        path = _tile_objects_path(tiles_dir, key)
+        if os.path.exists(path):
+            with np.load(path) as data:
+                parts.append({name: data[name] for name in data.files})
+    if not parts:
+        return None
+    return {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+
+
+def _select_columns(columns: Columns, mask: np.ndarray) -> Columns:
+    return {name: column[mask] for name, column in columns.items()}
+
+
+def _shift_columns(columns: Columns, dx: int, dy: int) -> Columns:
+    """平移对象的视觉位置和网格位置 (没有网格位置的对象保持 -1)。"""
+    shifted = dict(columns)
+    shifted['visual_pos'] = columns['visual_pos'] + np.array([dx, dy], dtype=columns['visual_pos'].dtype)
+    grid_pos = columns['grid_pos'] + np.array([dx, dy], dtype=columns['grid_pos'].dtype)
+    shifted['grid_pos'] = np.where(columns['has_grid_pos'][:, None], grid_pos, -1)
+    return shifted
+
+
+def _add_neighbour_objects(ctx: GenerationContext, columns: Optional[Columns]) -> int:
+    """
+    把相邻块已经生成的对象放进块的上下文：平移到局部坐标，只保留落在块网格内 (或网格对象的占地与之相交) 的，
+    登记到对象表，网格对象同时登记到占用网格。返回加入的对象数。
+    """
+    if columns is None:
+        return 0
+    w, h = ctx.grid_width, ctx.grid_height
+    local = _shift_columns(columns, -ctx.origin[0], -ctx.origin[1])
+    lo = np.where(local['has_grid_pos'][:, None], local['grid_pos'], np.floor(local['visual_pos']))
+    hi = lo + np.maximum(np.where(local['has_grid_size'][:, None], local['grid_size'], 1), 1)
+    inside = (hi[:, 0] > 0) & (lo[:, 0] < w) & (hi[:, 1] > 0) & (lo[:, 1] < h)
+    selection = ctx.objects.extend_columns(_select_columns(local, inside))
+
+    table = ctx.objects
+    for row in selection.rows[table.has_grid_pos[selection.rows] & table.has_grid_size[selection.rows]]:
+        ctx.update_occupancy(table[int(row)])
+    return len(selection)
+
+
+@contextlib.contextmanager
+def _maybe_quiet(verbose: bool):
+    """管道的逐步输出在几百块上没有意义，默认只保留错误。"""
+    if verbose:
+        yield
+    else:
+        with quiet_output(logging.ERROR):
+            yield
+
+
+# --- 每块的两个阶段 (在工作进程中运行) ---
+
+def generate_tile(
+        settings: Settings,
+        world_seed: int,
+        world_size: Tuple[int, int],
+        tiles_dir: str,
+        tile: Tile,
+        verbose: bool = False
+) -> Columns:
+    """
+    生成一块：放入已完成的相邻块的对象，运行所有管道，绑定网格，
+    返回本块新生成的、锚点落在核心内的对象 (世界坐标)。
+    """
+    with _maybe_quiet(verbose):
+        settings = tile_settings(settings, tile, *world_size)
+        ctx = create_tile_context(settings, world_seed, world_size, tile)
+        ctx = reserve_grid_margin(ctx, margin_width=1)
+        _add_neighbour_objects(ctx, load_tile_objects(tiles_dir, tile.neighbour_keys()))
+        last_neighbour_uid = int(ctx.objects.uids.max()) if len(ctx.objects) else 0
+
+        ctx = run_pipelines(ctx, settings)
+        ctx = bind_floating_objects_to_grid(ctx)
+
+    table = ctx.objects
+    cx, cy = tile.core_slices
+    gx, gy = table.grid_pos[:, 0], table.grid_pos[:, 1]
+    own = (
+            (table.uids > last_neighbour_uid)
+            & (gx >= cx.start) & (gx < cx.stop) & (gy >= cy.start) & (gy < cy.stop)
+    )
+    columns = _shift_columns(table.columns(np.flatnonzero(own)), *tile.origin)
+    ctx.storage.close()
+    return columns
+
+
+def light_tile(
+        settings: Settings,
+        world_seed: int,
+        world_size: Tuple[int, int],
+        tiles_dir: str,
+        tile: Tile,
+        verbose: bool = False
+) -> np.ndarray:
+    """
+    所有对象都放好之后，按块网格内的全部窗户和火把重新计算光照 (未归一化)，返回核心部分。
+    与 lighting_pipeline 相同的核和强度，并且按固定尺度归一化，因此相邻块在接缝处的光照完全一致。
+    """
+    with _maybe_quiet(verbose):
+        ctx = create_tile_context(tile_settings(settings, tile, *world_size), world_seed, world_size, tile)
+        keys = [tile.key] + tile.neighbour_keys()
+        columns = load_tile_objects(tiles_dir, keys)
+        if columns is not None:
+            lights = np.isin(columns['obj_type'], ('WINDOW', 'TORCH'))
+            ctx.objects.extend_columns(_shift_columns(_select_columns(columns, lights), -tile.rx0, -tile.ry0))
+
+        ctx = ensure_layer_exists(ctx, 'global_light_map', fill_value=0.0)
+        ctx = apply_influence_to_layer(
+            ctx, 'global_light_map', ctx.objects.select("WINDOW"),
+            sigma=settings.WINDOW_LIGHT_SIGMA, strength_multiplier={"WINDOW": 0.4}, mode='add', backend='window'
+        )
+        ctx = apply_influence_to_layer(
+            ctx, 'global_light_map', ctx.objects.select("TORCH"),
+            sigma=settings.TORCH_LIGHT_SIGMA, strength_multiplier={"TORCH": 1.2}, mode='add', backend='window'
+        )
+    return np.array(ctx.layers.read('global_light_map')[tile.core_slices])
+
+
+# --- 输出 ---
+
+class WorldWriter:
+    """
+    把分块结果增量写到输出目录：
+      - tiles/tile_X_Y.npz: 每块的对象 (世界坐标，包括小脏污)，生成相邻块时读取
+      - objects.jsonl: 除小脏污以外的对象，每行一个，格式与 export_context_to_json 中的对象相同
+      - light_level.npy / grime.npy: 世界大小的光照场和脏污粒子密度 (内存映射写入)
+      - world.json: 元数据和上述文件的索引
+    """
+
+    def __init__(self, out_dir: str, world_w: int, world_h: int, field_dtype):
+        self.out_dir = out_dir
+        self.tiles_dir = os.path.join(out_dir, 'tiles')
+        os.makedirs(self.tiles_dir, exist_ok=True)
+        # 相邻块的对象按文件是否存在来判断是否已经生成，上次运行 (可能是不同的种子或参数) 留下的块必须先删掉
+        stale = glob.glob(os.path.join(self.tiles_dir, 'tile_*_*.npz'))
+        for path in stale:
+            os.remove(path)
+        if stale:
+            print(f"--- 删除了输出目录中上次运行留下的 {len(stale)} 个分块文件 ---")
+        self.world_size = (world_w, world_h)
+
+        # 新建的 .npy 文件内容全为 0
+        self.light = np.lib.format.open_memmap(
+            os.path.join(out_dir, 'light_level.npy'), mode='w+', dtype=np.dtype(field_dtype), shape=self.world_size
+        )
+        self.grime = np.lib.format.open_memmap(
+            os.path.join(out_dir, 'grime.npy'), mode='w+', dtype=np.int32, shape=self.world_size
+        )
+        self._objects_file = open(os.path.join(out_dir, 'objects.jsonl'), 'w', encoding='utf-8')
+        self._next_uid = 1
+        self.type_counts = Counter()
+        self.light_min = math.inf
+        self.light_max = -math.inf
+
+    def add_tile_objects(self, tile: Tile, columns: Columns):
+        save_tile_objects(self.tiles_dir, tile, columns)
+
+        is_grime = columns['obj_type'] == 'GRIME_SMALL'
+        gx, gy = columns['grid_pos'][is_grime].T
+        np.add.at(self.grime, (gx, gy), 1)
+        self.type_counts['GRIME_SMALL'] += int(np.count_nonzero(is_grime))
+
+        table = ObjectTable()
+        table.extend_columns(_select_columns(columns, ~is_grime))
+        for obj_dict in _iter_object_dicts(table):
+            obj_dict["uid"] = self._next_uid
+            self._next_uid += 1
+            self.type_counts[obj_dict["obj_type"]] += 1
+            self._objects_file.write(json.dumps(obj_dict) + "\n")
+        self._objects_file.flush()
+
+    def add_tile_light(self, tile: Tile, light: np.ndarray):
+        self.light[tile.x0:tile.x1, tile.y0:tile.y1] = light
+        if light.size:
+            self.light_min = min(self.light_min, float(light.min()))
+            self.light_max = max(self.light_max, float(light.max()))
+
+    def _normalize_light(self):
+        """按全世界的最小/最大值把光照场归一化到 [0, 1] (与 safe_normalize 相同的规则)，分块原地进行。"""
+        data_range = self.light_max - self.light_min
+        flat = not data_range > normalize_tolerance(self.light_min, self.light_max, self.light.dtype)
+        step = max(1, COPY_BLOCK_ELEMENTS // max(1, self.world_size[1]))
+        for x0 in range(0, self.world_size[0], step):
+            block = self.light[x0:x0 + step]
+            if flat:
+                block.fill(0)
+            else:
+                block -= self.light_min
+                block /= data_range
+
+    def finish(self, meta: dict):
+        self._normalize_light()
+        self.light.flush()
+        self.grime.flush()
+        self._objects_file.close()
+
+        index = {
+            "meta": meta,
+            "objects": "objects.jsonl",
+            "fields": {"light_level": {"file": "light_level.npy", "dtype": self.light.dtype.name}},
+            "particles": {
+                GRIME_PARTICLE_TYPE: {"type": GRIME_PARTICLE_TYPE, "seed": GRIME_PARTICLE_SEED, "file": "grime.npy"}
+            },
+        }
+        with open(os.path.join(self.out_dir, 'world.json'), 'w', encoding='utf-8') as f:
+            json.dump(index, f, indent=2)
+        del self.light, self.grime
+
+
+def _map_tiles(executor: Optional[ProcessPoolExecutor], func, tiles: List[Tile]):
+    """按 tiles 的顺序产生结果；有进程池时并行计算。"""
+    if executor is None:
+        return map(func, tiles)
+    return executor.map(func, tiles)
+
+
+def generate_world(
+        settings: Settings,
+        world_w: int,
+        world_h: int,
+        out_dir: str,
+        tile_size: Optional[int] = None,
+        halo: Optional[int] = None,
+        workers: Optional[int] = None,
+        seed: Optional[int] = None,
+        verbose: bool = False
+) -> dict:
+    """
+    分块生成一个 world_w × world_h 的世界并写入 out_dir，返回元数据 (同 world.json 中的 meta)。
+    未指定的参数取 Settings 中的 CHUNK_* 和 SEED；光环宽度两处都没有指定时按 influence_halo 自动确定。
+    """
+    tile_size = tile_size or settings.CHUNK_TILE_SIZE
+    if halo is None:
+        halo = settings.CHUNK_HALO if settings.CHUNK_HALO is not None else influence_halo(settings)
+    workers = workers or settings.CHUNK_WORKERS
+    if seed is None:
+        seed = settings.SEED
+    world_seed = seed if seed is not None else np.random.SeedSequence().entropy
+    world_size = (world_w, world_h)
+
+    tiles = plan_tiles(world_w, world_h, tile_size, halo)
+    print(f"--- 分块生成: 世界 {world_w}x{world_h}，{len(tiles)} 块 (边长 {tile_size}，光环 {halo})，随机种子: {world_seed} ---")
+
+    writer = WorldWriter(out_dir, world_w, world_h, settings.FIELD_DTYPE)
+    start = time.perf_counter()
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        # 阶段 1: 按颜色分组生成对象，同组的块互不相邻，可以并行
+        for color in range(4):
+            batch = [tile for tile in tiles if tile.color == color]
+            if not batch:
+                continue
+            print(f"--- 第 {color + 1}/4 组: {len(batch)} 块 ---")
+            func = partial(generate_tile, settings, world_seed, world_size, writer.tiles_dir, verbose=verbose)
+            for tile, columns in zip(batch, _map_tiles(executor, func, batch)):
+                writer.add_tile_objects(tile, columns)
+                print(f"  - 块 ({tile.tx}, {tile.ty}): {len(columns['obj_type'])} 个对象")
+
+        # 阶段 2: 所有对象都已确定，逐块重新计算光照场
+        print("--- 计算光照场 ---")
+        func = partial(light_tile, settings, world_seed, world_size, writer.tiles_dir, verbose=verbose)
+        for tile, light in zip(tiles, _map_tiles(executor, func, tiles)):
+            writer.add_tile_light(tile, light)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    meta = {
+        "gridWidth": world_w,
+        "gridHeight": world_h,
+        "tileSize": tile_size,
+        "halo": halo,
+        "seed": int(world_seed),
+        "tiles": len(tiles),
+        "objectCounts": dict(writer.type_counts),
+    }
+    writer.finish(meta)
+    print(f"--- 世界已写入 {out_dir} (用时 {time.perf_counter() - start:.1f}s，对象 {sum(writer.type_counts.values())} 个) ---")
+    return meta
+
+
+def main():
+    parser = argparse.ArgumentParser(description="分块生成超大世界")
+    parser.add_argument("--width", type=int, required=True, help="世界宽度 (格)")
+    parser.add_argument("--height", type=int, required=True, help="世界高度 (格)")
+    parser.add_argument("--out", required=True, help="输出目录")
+    parser.add_argument("--seed", type=int, default=None, help="世界种子 (默认使用 Settings.SEED)")
+    parser.add_argument("--tile-size", type=int, default=None, help="块边长 (默认 Settings.CHUNK_TILE_SIZE)")
+    parser.add_argument("--halo", type=int, default=None, help="光环宽度 (默认按最大影响半径自动确定)")
+    parser.add_argument("--workers", type=int, default=None, help="并行进程数 (默认 Settings.CHUNK_WORKERS)")
+    parser.add_argument("--verbose", action="store_true", help="输出每块管道的详细日志")
+    args = parser.parse_args()
+
+    generate_world(
+        Settings, args.width, args.height, args.out,
+        tile_size=args.tile_size, halo=args.halo, workers=args.workers, seed=args.seed, verbose=args.verbose
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -4,12 +4,24 @@ import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 from perlin_noise import PerlinNoise
-import random
-import time
+import threading
+import zlib
 from scipy.ndimage import gaussian_filter
 import json
+import logging
 from dataclasses import dataclass, field
-from typing import List, Dict, Tuple, Callable
+from typing import List, Dict, Tuple, Callable, Set
+
+from buffer_pool import BufferPool
+from instrumentation import Profiler, instrumented
+from layer_graph import DtypePolicy, LayerStore
+from layer_storage import LayerStorage
+from noise_bank import NoiseBank
+from object_store import ObjectTable, ObjectSelection
+from occupancy import OccupancyIndex
+from spatial_index import SpatialHash
+
+LOGGER = logging.getLogger('era_map.core_types')
 
 @dataclass
 class ParticleLayer:
@@ -28,8 +40,8 @@ class GameObject:
     grid_pos: Optional[np.ndarray] = None
     grid_size: Optional[np.ndarray] = None
 
-    # 唯一ID，用于引用
-    uid: int = field(default_factory=lambda: id(GameObject))
+    # 唯一ID，用于引用。由对象表在追加时分配 (单调递增)，-1 表示尚未加入任何对象表
+    uid: int = -1
 
     # 为了简化，我们可以添加一些辅助属性
     @property
@@ -45,32 +57,129 @@ class GenerationContext:
     grid_height: int
 
     # 用于生成过程中的临时数据层 (e.g., 'table_suitability', 'grime_probability')
-    layers: Dict[str, np.ndarray]
+    # 可以是 LayerStore (支持惰性求值)；传入普通字典时会被包装成非惰性的 LayerStore
+    layers: LayerStore
 
     # 用于最终导出的、描述世界状态的持久化数据场 (e.g., 'light_level', 'temperature')
     fields: Dict[str, np.ndarray]
 
     particles: Dict[str, ParticleLayer]
 
-    # 存储所有已生成的游戏对象
-    objects: List[GameObject]
+    # 存储所有已生成的游戏对象 (列式存储，迭代时得到与 GameObject 接口一致的视图)
+    objects: ObjectTable
+
+    # 逻辑网格，用于快速碰撞检测：每个格子一个按对象类型分配比特位的掩码
+    occupancy: OccupancyIndex
+
+    # 可选的预计算噪声库，设置后 apply_perlin_noise 直接从中截取窗口
+    noise_bank: Optional[NoiseBank] = None
+
+    # 根随机种子序列。所有随机数都从这里按名字派生，相同的种子和 Settings 会得到完全相同的布局
+    seed_sequence: np.random.SeedSequence = field(default_factory=np.random.SeedSequence)
+
+    # 分块生成时，本上下文的网格是世界中的一块：origin 是它在世界坐标中的起点，world_size 是整个世界的尺寸
+    # (None 表示网格就是整个世界)。world_seed_sequence 是世界级的种子序列，spawn_rng(..., world=True)
+    # 从它派生，所有分块得到同一个流，按世界坐标采样的噪声因此在分块接缝处连续
+    origin: Tuple[int, int] = (0, 0)
+    world_size: Optional[Tuple[int, int]] = None
+    world_seed_sequence: Optional[np.random.SeedSequence] = None
+
+    # 每个随机数流名字已经派生过的次数，同名的多次调用依次得到不同但确定的流
+    rng_counters: Dict[str, int] = field(default_factory=dict)
+    _rng_lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
 
-    # 逻辑网格，用于快速碰撞检测，存储 GameObject 的引用
-    occupancy_grid: np.ndarray
+    # 临时数组缓冲池，迭代放置循环从这里借用与网格同尺寸的临时图
+    buffers: BufferPool = field(default_factory=BufferPool, repr=False, compare=False)
 
-    # 辅助方法，用于在放置对象后更新 occupancy_grid
+    # 层和场的数值类型策略 (默认 float32 计算和存储)，会同步给 layers，由它负责存储时的类型转换
+    dtype_policy: DtypePolicy = field(default_factory=DtypePolicy)
+
+    # 层、场和粒子密度网格的存储后端 (内存或 memmap)，同样会同步给 layers
+    storage: LayerStorage = field(default_factory=LayerStorage, repr=False, compare=False)
+
+    # 对象视觉位置上的空间哈希，用于半径查询和最近邻查询；查询时自动与对象表同步
+    spatial_index: Optional[SpatialHash] = field(default=None, repr=False, compare=False)
+
+    # 性能分析器：设置后，被 @instrumented 包装的修改器、放置策略和管道的每次调用都会被记录 (见 instrumentation.py)
+    profiler: Optional[Profiler] = field(default=None, repr=False, compare=False)
+
+    # 统计：放置策略抽样的次数 (候选格子数)，供性能分析使用
+    samples_drawn: int = 0
+
+    def __post_init__(self):
+        if not isinstance(self.layers, LayerStore):
+            self.layers = LayerStore(self.layers)
+        self.layers.dtype_policy = self.dtype_policy
+        self.layers.storage = self.storage
+        if self.spatial_index is None:
+            self.spatial_index = SpatialHash(self.objects, self.grid_width, self.grid_height)
+
+    @property
+    def world_width(self) -> int:
+        return self.grid_width if self.world_size is None else self.world_size[0]
+
+    @property
+    def world_height(self) -> int:
+        return self.grid_height if self.world_size is None else self.world_size[1]
+
+    @property
+    def is_tile(self) -> bool:
+        """网格是否只是世界中的一块 (分块生成)。"""
+        return (self.origin != (0, 0)
+                or (self.world_width, self.world_height) != (self.grid_width, self.grid_height))
+
+    def spawn_rng(self, *stream_key: Any, world: bool = False) -> np.random.Generator:
+        """
+        为一个修改器或放置策略派生独立的随机数生成器。
+
+        流由 (名字, 同名调用序号) 唯一确定，而不是由全局调用顺序确定，
+        因此各阶段无论串行、多线程还是在其他进程中执行，拿到的随机数都完全一致。
+        world=True 时从世界级种子序列派生 (非分块生成时与 seed_sequence 相同)。
+        """
+        name = ":".join(str(k) for k in stream_key)
+        with self._rng_lock:
+            index = self.rng_counters.get(name, 0)
+            self.rng_counters[name] = index + 1
+
+        root = self.world_seed_sequence if world and self.world_seed_sequence is not None else self.seed_sequence
+        # crc32 是稳定的哈希 (不同于 Python 内置 hash，它不受进程随机化影响)
+        child = np.random.SeedSequence(
+            entropy=root.entropy,
+            spawn_key=tuple(root.spawn_key) + (zlib.crc32(name.encode('utf-8')), index),
+        )
+        return np.random.Generator(np.random.PCG64(child))
+
+    # 辅助方法，用于在放置对象后更新 occupancy
     def update_occupancy(self, obj: GameObject):
         if obj.grid_pos is not None and obj.grid_size is not None:
             x, y = obj.grid_pos
             w, h = obj.grid_size
-            for i in range(x, x + w):
-                for j in range(y, y + h):
-                    # 确保坐标在边界内
-                    if 0 <= i < self.grid_width and 0 <= j < self.grid_height:
-                        # self.occupancy_grid[i, j] 是一个列表
-                        cell_list = cast(List[GameObject], self.occupancy_grid[i, j])
-                        cell_list.append(obj)
+            # 超出边界的部分会被自动裁掉
+            self.occupancy.stamp(x, y, w, h, obj.obj_type, uid=obj.uid)
+
+    def add_floating_objects(self, obj_type: str, positions: np.ndarray) -> ObjectSelection:
+        """批量添加一组只有视觉位置的浮动对象 (例如角色、脏污)，positions 形状为 (N, 2)。"""
+        return self.objects.extend_floating(obj_type, positions)
+
+    def objects_within(self, point, radius: float, types=None) -> ObjectSelection:
+        """返回视觉位置距离 point 不超过 radius 的对象 (可按类型过滤)。"""
+        return ObjectSelection(self.objects, self.spatial_index.query_radius(point, radius, types))
+
+    def nearest_objects(self, point, k: int = 1, max_radius: Optional[float] = None, types=None) -> Tuple[ObjectSelection, np.ndarray]:
+        """返回距离 point 最近的至多 k 个对象及其距离，按距离升序。"""
+        rows, distances = self.spatial_index.nearest(point, k, max_radius, types)
+        return ObjectSelection(self.objects, rows), distances
 
+    @property
+    def occupancy_version(self) -> int:
+        """占用状态的版本号，每次放置对象都会递增。"""
+        return self.occupancy.version
+
+    def valid_mask(self, blocked_by: Set[str], footprint: Tuple[int, int] = (1, 1)) -> np.ndarray:
+        """带缓存的有效锚点掩码，详见 OccupancyIndex.valid_mask。"""
+        return self.occupancy.valid_mask(blocked_by, footprint)
+
+@instrumented('modifier')
 def convert_objects_to_particles(
         ctx: GenerationContext,
         object_type_to_convert: str,
@@ -79,37 +188,32 @@ def convert_objects_to_particles(
 ) -> GenerationContext:
     """
     查找指定类型的GameObject，将它们转换为一个ParticleLayer，
-    并从主对象列表中移除它们。
+    并从对象表中移除它们。
     """
-    print(f"--- 开始将 '{object_type_to_convert}' 对象转换为粒子层 '{target_particle_type}' ---")
-
-    # 1. 初始化一个空的密度网格
-    density_grid = np.zeros((ctx.grid_width, ctx.grid_height), dtype=int)
-
-    # 2. 筛选出需要转换的对象和需要保留的对象
-    objects_to_convert = []
-    objects_to_keep = []
-    for obj in ctx.objects:
-        if obj.obj_type == object_type_to_convert:
-            objects_to_convert.append(obj)
-        else:
-            objects_to_keep.append(obj)
-
-    if not objects_to_convert:
-        print(f"--- 未找到类型为 '{object_type_to_convert}' 的对象，跳过粒子转换。---")
+    LOGGER.info("--- 开始将 '%s' 对象转换为粒子层 '%s' ---", object_type_to_convert, target_particle_type)
+
+    # 1. 初始化一个空的密度网格 (按粒子类型名选择存储后端)
+    density_grid = ctx.storage.allocate(target_particle_type, (ctx.grid_width, ctx.grid_height), np.int32, fill_value=0)
+
+    # 2. 筛选出需要转换的对象 (按类型编码的一次向量化比较)
+    rows = ctx.objects.indices_of(object_type_to_convert)
+
+    if len(rows) == 0:
+        LOGGER.info("--- 未找到类型为 '%s' 的对象，跳过粒子转换。---", object_type_to_convert)
         return ctx
 
-    # 3. 遍历需要转换的对象，填充密度网格
+    # 3. 把需要转换的对象按网格坐标累加到密度网格
     #    我们使用对象的 grid_pos，因此这个函数应该在 bind_floating_objects_to_grid 之后调用
-    for obj in objects_to_convert:
-        if obj.grid_pos is not None:
-            gx, gy = obj.grid_pos
-            # 确保坐标在网格范围内
-            if 0 <= gx < ctx.grid_width and 0 <= gy < ctx.grid_height:
-                density_grid[gx, gy] += 1
-        else:
-            # 这是一个安全警告，理论上不应该发生
-            print(f"警告: 对象 (uid={obj.uid}, type={obj.obj_type}) 没有 grid_pos，无法转换为粒子。")
+    bound = ctx.objects.has_grid_pos[rows]
+    if not np.all(bound):
+        # 这是一个安全警告，理论上不应该发生
+        LOGGER.warning(
+            "%s 个 '%s' 对象没有 grid_pos，无法转换为粒子。", int(np.count_nonzero(~bound)), object_type_to_convert
+        )
+    gx, gy = ctx.objects.grid_pos[rows[bound]].T
+    # 确保坐标在网格范围内
+    inside = (gx >= 0) & (gx < ctx.grid_width) & (gy >= 0) & (gy < ctx.grid_height)
+    np.add.at(density_grid, (gx[inside], gy[inside]), 1)
 
     # 4. 创建新的 ParticleLayer 实例
     new_particle_layer = ParticleLayer(
@@ -121,12 +225,10 @@ def convert_objects_to_particles(
     # 5. 将新的粒子层添加到上下文中
     ctx.particles[target_particle_type] = new_particle_layer
 
-    # 6. 更新上下文中的对象列表，移除已转换的对象
-    original_count = len(ctx.objects)
-    ctx.objects = objects_to_keep
-    converted_count = original_count - len(ctx.objects)
+    # 6. 从对象表中批量移除已转换的对象
+    converted_count = ctx.objects.remove(rows)
 
-    print(f"--- 转换完成: {converted_count} 个对象被转换为粒子。剩余对象: {len(ctx.objects)} ---")
+    LOGGER.info("--- 转换完成: %s 个对象被转换为粒子。剩余对象: %s ---", converted_count, len(ctx.objects))
 
     return ctx
 
@@ -0,0 +1,79 @@
+import os
+import tempfile
+from typing import Callable, List, Optional
+
+
+class LruDirectory:
+    """
+    一个按总大小限额、最近最少使用 (LRU) 淘汰的磁盘缓存目录。
+
+    访问时间记录在文件的 mtime 上，因此多个进程共享同一个目录时也能得到一致的淘汰顺序，
+    不需要额外的索引文件。写入通过“临时文件 + os.replace”完成，保证其他进程永远看不到半写入的文件。
+    """
+
+    def __init__(self, root_dir: str, size_budget_bytes: int, suffix: str = ".npy"):
+        self.root_dir = root_dir
+        self.size_budget_bytes = size_budget_bytes
+        self.suffix = suffix
+        os.makedirs(root_dir, exist_ok=True)
+
+    def path_for(self, name: str) -> str:
+        return os.path.join(self.root_dir, name + self.suffix)
+
+    def contains(self, name: str) -> bool:
+        return os.path.exists(self.path_for(name))
+
+    def touch(self, name: str):
+        """标记一个条目刚被使用过。"""
+        try:
+            os.utime(self.path_for(name))
+        except OSError:
+            pass  # 可能刚被其他进程淘汰，下次访问时会重新生成
+
+    def store(self, name: str, writer: Callable[[str], None]) -> str:
+        """
+        通过 writer(临时路径) 写入一个条目，原子地移动到最终位置，然后按限额淘汰旧条目。
+        返回最终路径。
+        """
+        final_path = self.path_for(name)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root_dir, suffix=".tmp" + self.suffix)
+        os.close(fd)
+        try:
+            writer(tmp_path)
+            os.replace(tmp_path, final_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict(keep=final_path)
+        return final_path
+
+    def entries(self) -> List[os.DirEntry]:
+        """按最近使用时间从旧到新列出所有条目。"""
+        entries = [
+            e for e in os.scandir(self.root_dir)
+            if e.is_file() and e.name.endswith(self.suffix) and ".tmp" not in e.name
+        ]
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        return entries
+
+    def total_bytes(self) -> int:
+        return sum(e.stat().st_size for e in self.entries())
+
+    def evict(self, keep: Optional[str] = None) -> int:
+        """淘汰最久未使用的条目，直到总大小不超过限额。返回淘汰的条目数。"""
+        entries = self.entries()
+        total = sum(e.stat().st_size for e in entries)
+        evicted = 0
+        for entry in entries:
+            if total <= self.size_budget_bytes:
+                break
+            if keep is not None and os.path.abspath(entry.path) == os.path.abspath(keep):
+                continue
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except OSError:
+                continue  # Windows 下仍被映射的文件无法删除，跳过即可
+            total -= size
+            evicted += 1
+        return evicted
@@ -0,0 +1,266 @@
+import math
+from functools import lru_cache
+
+import numpy as np
+from scipy.ndimage import gaussian_filter
+from scipy.signal import fftconvolve
+
+# 高斯核截断半径 (单位: sigma)。exp(-4^2/2) ≈ 3e-4，在归一化后的影响图上不可见
+DEFAULT_TRUNCATE = 4.0
+
+# 核半径超过这个格数时，auto 后端改用 FFT 卷积 (直接卷积的代价随半径线性增长)
+FFT_RADIUS_THRESHOLD = 48
+
+# FFT 卷积按行/列分块时，每块的复数频谱最多包含的元素数 (complex128 下约 64MB)
+FFT_CHUNK_ELEMENTS = 1 << 22
+
+# 窗口盖章模式的截断半径 (单位: sigma) 与亚格子相位的量化级数
+WINDOW_TRUNCATE = 3.0
+WINDOW_SUBCELL_STEPS = 16
+
+
+def splat_bilinear(
+        positions: np.ndarray,
+        strengths: np.ndarray,
+        shape: tuple,
+        pad: int,
+        dtype=np.float64
+) -> np.ndarray:
+    """
+    把一组亚格子精度的点源按双线性权重“泼溅”到一张 (带 pad 边距的) 密度网格上。
+    网格 (i, j) 对应坐标 (i - pad, j - pad)；落在边距之外的源会被丢弃。
+    """
+    w, h = shape
+    density = np.zeros((w + 2 * pad, h + 2 * pad), dtype=dtype)
+    if len(positions) == 0:
+        return density
+
+    coords = positions + pad
+    base = np.floor(coords)
+    frac = coords - base
+    base = base.astype(np.int64)
+
+    for dx in (0, 1):
+        wx = frac[:, 0] if dx else 1.0 - frac[:, 0]
+        for dy in (0, 1):
+            wy = frac[:, 1] if dy else 1.0 - frac[:, 1]
+            ix = base[:, 0] + dx
+            iy = base[:, 1] + dy
+            inside = (ix >= 0) & (ix < density.shape[0]) & (iy >= 0) & (iy < density.shape[1])
+            np.add.at(density, (ix[inside], iy[inside]), (strengths * wx * wy)[inside])
+    return density
+
+
+def _influence_direct(w: int, h: int, positions: np.ndarray, strengths: np.ndarray, sigma: float, dtype) -> np.ndarray:
+    """旧实现：对每个源在整张网格上计算一次高斯，O(N·W·H)。"""
+    influence = np.zeros((w, h), dtype=dtype)
+    xs = np.arange(w)[:, None]
+    ys = np.arange(h)[None, :]
+    two_sigma_sq = 2 * sigma ** 2
+    for (px, py), strength in zip(positions, strengths):
+        distance_sq = (xs - px) ** 2 + (ys - py) ** 2
+        influence += np.exp(-distance_sq / two_sigma_sq) * strength
+    return influence
+
+
+def _source_overhang(w: int, h: int, positions: np.ndarray) -> float:
+    """源超出网格范围的最大距离 (所有源都在网格内时为 0)。"""
+    if len(positions) == 0:
+        return 0.0
+    return max(
+        0.0,
+        -float(positions[:, 0].min()), float(positions[:, 0].max()) - (w - 1),
+        -float(positions[:, 1].min()), float(positions[:, 1].max()) - (h - 1)
+    )
+
+
+def _source_pad(w: int, h: int, positions: np.ndarray, radius: int) -> int:
+    """
+    密度网格需要的边距：只要能容纳网格外、但仍在核半径内的源即可。
+    所有源都在网格内时不需要边距 (零边界的卷积结果与带零边距时完全相同)，大网格上可以省下数倍的内存。
+    """
+    overhang = _source_overhang(w, h, positions)
+    if overhang == 0.0:
+        return 0
+    # 双线性泼溅会占用源所在格子的下一格，因此多留一格
+    return min(radius, max(w, h), int(math.ceil(overhang)) + 1)
+
+
+def _influence_convolution(w, h, positions, strengths, sigma, truncate, dtype) -> np.ndarray:
+    """泼溅到密度网格后做一次可分离的高斯滤波，O(W·H·sigma)。"""
+    radius = int(math.ceil(truncate * sigma))
+    pad = _source_pad(w, h, positions, radius)
+    density = splat_bilinear(positions, strengths, (w, h), pad, dtype)
+    blurred = gaussian_filter(density, sigma, mode='constant', cval=0.0, truncate=truncate)
+    return blurred[pad:pad + w, pad:pad + h]
+
+
+def _influence_fft(w, h, positions, strengths, sigma, truncate, dtype) -> np.ndarray:
+    """
+    泼溅到密度网格后用 FFT 与高斯核卷积，代价与 sigma 无关，适合大半径。
+    高斯核是可分离的，因此沿两个轴各做一次一维 FFT 卷积，不需要构造 (2r+1)×(2r+1) 的二维核。
+    """
+    radius = int(math.ceil(truncate * sigma))
+    pad = _source_pad(w, h, positions, radius)
+    density = splat_bilinear(positions, strengths, (w, h), pad, dtype)
+
+    # 网格内任意两点的距离不会超过密度网格的尺寸，更大的核没有意义
+    rx = min(radius, density.shape[0] - 1)
+    ry = min(radius, density.shape[1] - 1)
+    kx = np.exp(-np.arange(-rx, rx + 1) ** 2 / (2 * sigma ** 2))
+    ky = np.exp(-np.arange(-ry, ry + 1) ** 2 / (2 * sigma ** 2))
+    _fft_convolve_axis_inplace(density, kx.astype(dtype), axis=0)
+    _fft_convolve_axis_inplace(density, ky.astype(dtype), axis=1)
+    return density[pad:pad + w, pad:pad + h]
+
+
+def _fft_convolve_axis_inplace(data: np.ndarray, kernel: np.ndarray, axis: int):
+    """
+    沿 axis 对 data 做 'same' 模式的一维 FFT 卷积，结果原地写回。
+    沿另一个轴分块进行 (每块读完再写回，互不重叠)，频谱等中间结果的大小与整张图无关。
+    """
+    fft_length = data.shape[axis] + len(kernel) - 1
+    step = max(1, FFT_CHUNK_ELEMENTS // fft_length)
+    other = 1 - axis
+    kernel = kernel[:, None] if axis == 0 else kernel[None, :]
+    for start in range(0, data.shape[other], step):
+        block = (slice(None), slice(start, start + step)) if axis == 0 else (slice(start, start + step), slice(None))
+        data[block] = fftconvolve(data[block], kernel, mode='same', axes=axis)
+
+
+def compute_influence_map(
+        w: int,
+        h: int,
+        positions: np.ndarray,
+        strengths: np.ndarray,
+        sigma: float,
+        backend: str = 'auto',  # 'auto', 'direct', 'convolution', 'fft'
+        truncate: float = DEFAULT_TRUNCATE,
+        dtype=np.float64
+) -> np.ndarray:
+    """
+    计算一组点源在 w×h 网格上叠加的 (未归一化的) 高斯影响。
+    positions 形状为 (N, 2)，strengths 形状为 (N,)。
+    """
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+    strengths = np.asarray(strengths, dtype=np.float64).reshape(-1)
+
+    if backend == 'auto':
+        if _source_overhang(w, h, positions) > max(w, h) and truncate * sigma > max(w, h):
+            # 远在网格之外的源放不进密度网格的边距 (分块生成时的世界级吸引点)，只有直接求值能算到它们
+            backend = 'direct'
+        else:
+            backend = 'fft' if truncate * sigma > FFT_RADIUS_THRESHOLD else 'convolution'
+
+    if backend == 'direct':
+        return _influence_direct(w, h, positions, strengths, sigma, dtype)
+    if backend == 'convolution':
+        return _influence_convolution(w, h, positions, strengths, sigma, truncate, dtype)
+    if backend == 'fft':
+        return _influence_fft(w, h, positions, strengths, sigma, truncate, dtype)
+    raise ValueError(f"未知的影响计算后端 '{backend}'。")
+
+
+@lru_cache(maxsize=256)
+def gaussian_kernel_1d(sigma: float, phase_step: int, truncate: float = WINDOW_TRUNCATE) -> np.ndarray:
+    """
+    缓存的一维截断高斯核，长度为 2 * ceil(truncate * sigma) + 1。
+    phase_step / WINDOW_SUBCELL_STEPS 是源点相对于整数格的亚格子偏移，
+    这样同一个 sigma 只需缓存少量核，就能准确处理任意小数位置的源。
+    返回的数组是只读的，调用方不要修改。
+    """
+    radius = int(math.ceil(truncate * sigma))
+    offsets = np.arange(-radius, radius + 1) - phase_step / WINDOW_SUBCELL_STEPS
+    kernel = np.exp(-offsets ** 2 / (2 * sigma ** 2))
+    kernel.setflags(write=False)
+    return kernel
+
+
+def stamp_influence_windows(
+        shape: tuple,
+        positions: np.ndarray,
+        strengths: np.ndarray,
+        sigma: float,
+        truncate: float = WINDOW_TRUNCATE,
+        dtype=np.float64
+) -> tuple:
+    """
+    只在受影响的窗口内累加截断高斯核 (每个源 O(sigma^2))，而不是对整张网格求值。
+
+    返回 (influence, x0, y0)：influence 是覆盖所有源窗口的最小包围盒内的影响值，
+    (x0, y0) 是包围盒在网格中的起点。没有任何源落在网格内时返回 (None, 0, 0)。
+    """
+    w, h = shape
+    radius = int(math.ceil(truncate * sigma))
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+    strengths = np.asarray(strengths, dtype=np.float64).reshape(-1)
+
+    # 最近的整数格作为核中心，剩余的小数部分量化为相位
+    centers = np.floor(positions + 0.5).astype(np.int64)
+    phases = np.rint((positions - centers) * WINDOW_SUBCELL_STEPS).astype(np.int64)
+
+    lo = np.maximum(centers - radius, 0)
+    hi = np.minimum(centers + radius + 1, (w, h))
+    visible = np.all(hi > lo, axis=1) & (strengths != 0)
+    if not np.any(visible):
+        return None, 0, 0
+
+    x0, y0 = lo[visible].min(axis=0)
+    x1, y1 = hi[visible].max(axis=0)
+    influence = np.zeros((x1 - x0, y1 - y0), dtype=dtype)
+
+    for i in np.flatnonzero(visible):
+        kx = gaussian_kernel_1d(sigma, int(phases[i, 0]), truncate)
+        ky = gaussian_kernel_1d(sigma, int(phases[i, 1]), truncate)
+        (lx, ly), (ux, uy) = lo[i], hi[i]
+        cx, cy = centers[i]
+        # 核的下标 0 对应 center - radius
+        stamp = np.multiply.outer(
+            kx[lx - cx + radius:ux - cx + radius],
+            ky[ly - cy + radius:uy - cy + radius]
+        )
+        stamp *= strengths[i]
+        influence[lx - x0:ux - x0, ly - y0:uy - y0] += stamp
+    return influence, int(x0), int(y0)
+
+
+def merge_influence_window(
+        target_layer: np.ndarray,
+        influence: np.ndarray,
+        x0: int,
+        y0: int,
+        mode: str
+) -> bool:
+    """
+    把窗口盖章得到的影响 (已归一化到最大值为 1) 合并到目标层。
+    窗口外的影响恒为 0：对 add/subtract/multiply_inverse 而言无需处理，
+    只有 multiply 需要把窗口外清零 (此时代价仍是 O(W·H))。
+    """
+    x1, y1 = x0 + influence.shape[0], y0 + influence.shape[1]
+    if mode == 'multiply':
+        window = target_layer[x0:x1, y0:y1].copy()
+        target_layer.fill(0)
+        target_layer[x0:x1, y0:y1] = window
+    return merge_influence(target_layer[x0:x1, y0:y1], influence, mode)
+
+
+def merge_influence(target_layer: np.ndarray, influence_map: np.ndarray, mode: str) -> bool:
+    """
+    按模式把 (已归一化的) 影响图原地合并到目标层。
+    未知模式返回 False，由调用方给出警告。
+    """
+    if mode == 'add':
+        target_layer += influence_map
+    elif mode == 'subtract':
+        target_layer -= influence_map
+    elif mode == 'multiply':
+        target_layer *= influence_map
+    elif mode == 'multiply_inverse':
+        target_layer *= (1.0 - influence_map)
+    else:
+        return False
+
+    # 防止减法产生负值
+    if mode == 'subtract' or mode == 'multiply_inverse':
+        np.clip(target_layer, 0, None, out=target_layer)
+    return True
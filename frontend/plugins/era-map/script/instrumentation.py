@@ -0,0 +1,326 @@
+"""
+生成流程的插桩：按阶段记录耗时、内存和计数器，输出结构化报告。
+
+@instrumented(kind) 包装修改器、放置策略和管道函数 (它们的第一个参数都是生成上下文)。
+上下文上没有挂 Profiler (ctx.profiler 为 None) 时，包装层只多一次属性判断，可以一直保留在代码里；
+挂上 Profiler 之后，每次调用记录为一个区间 (span)：
+  - 墙钟时间和本线程的 CPU 时间
+  - tracemalloc 峰值 (只在 trace_memory=True 时记录；跟踪内存会让整个流程慢数倍)
+  - 计数器的增量：数组分配、抽样次数、有效掩码重算次数、放置的对象数
+
+区间按调用关系嵌套 (管道 -> 修改器 / 放置策略)，计数器和峰值都包含子区间。
+阶段调度器会把并发运行的阶段挂在发起它们的管道下面；计数器取自共享的上下文，
+并发阶段重叠运行时会互相计入 (放置策略总是串行的，抽样、掩码和对象数不受影响)。
+
+流程中的消息都记录到 'era_map' 下各模块的 logger (例如 'era_map.modifiers')，级别在调用处指定：
+失败为 ERROR，警告为 WARNING，管道和阶段的标题与汇总为 INFO，每次修改器调用和逐个对象的进度为 DEBUG。
+默认情况下 'era_map' 把所有级别的消息原样写到 sys.stdout (与直接 print 的效果相同)；
+quiet_output(level) 在 with 块内改为只记录 level 及以上的消息，并交给应用自己的 logging 配置。
+低于该级别的消息在 isEnabledFor 判断处就被丢弃，不会格式化字符串，循环中的进度消息也先做这个判断。
+"""
+import contextlib
+import functools
+import json
+import logging
+import sys
+import threading
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+LOGGER = logging.getLogger('era_map')
+
+# 计数器的名字 (也是报告中的键)
+ARRAY_ALLOCATIONS = 'arrayAllocations'
+SAMPLES_DRAWN = 'samplesDrawn'
+MASK_RECOMPUTATIONS = 'maskRecomputations'
+OBJECTS_PLACED = 'objectsPlaced'
+COUNTERS = (ARRAY_ALLOCATIONS, SAMPLES_DRAWN, MASK_RECOMPUTATIONS, OBJECTS_PLACED)
+
+
+def counter_snapshot(ctx) -> Tuple[int, ...]:
+    """从上下文中读出各计数器的当前值 (顺序同 COUNTERS)。"""
+    return (
+        ctx.buffers.allocations + ctx.layers.arrays_stored + ctx.storage.memmaps_created,
+        ctx.samples_drawn,
+        ctx.occupancy.mask_recomputations,
+        ctx.objects.appended,
+    )
+
+
+@dataclass
+class Span:
+    """一次被插桩的调用。start 是相对于 Profiler 创建时刻的秒数。"""
+    id: int
+    parent: Optional[int]
+    kind: str
+    name: str
+    detail: Optional[str]
+    thread: str
+    start: float
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    peak_bytes: Optional[int] = None
+    counters: Dict[str, int] = field(default_factory=dict)
+    # tracemalloc 的基线和区间内见过的最高占用 (绝对值)
+    _base_bytes: int = field(default=0, repr=False)
+    _max_bytes: int = field(default=0, repr=False)
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "parent": self.parent,
+            "kind": self.kind,
+            "name": self.name,
+            "detail": self.detail,
+            "thread": self.thread,
+            "start": round(self.start, 6),
+            "wallSeconds": round(self.wall_seconds, 6),
+            "cpuSeconds": round(self.cpu_seconds, 6),
+            "peakBytes": self.peak_bytes,
+            **self.counters,
+        }
+
+
+class Profiler:
+    """
+    收集区间并生成报告。把它挂到 ctx.profiler 上即开始记录 (run_generation(profiler=...) 会代为挂上)。
+    trace_memory=True 时，在 with 块内启用 tracemalloc (块外或未启用时峰值记为 None)。
+
+    用法:
+        with Profiler(trace_memory=True) as profiler:
+            ctx = run_generation(settings, profiler=profiler)
+        profiler.write_json('profile.json')
+        print(profiler.summary_table())
+    """
+
+    def __init__(self, trace_memory: bool = False):
+        self.trace_memory = trace_memory
+        self.spans: List[Span] = []
+        self._origin = time.perf_counter()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._started_tracing = False
+
+    def __enter__(self) -> 'Profiler':
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        return False
+
+    # --- 区间 ---
+
+    def _stack(self) -> List[Span]:
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def current(self) -> Optional[Span]:
+        """本线程中最内层的未结束区间。"""
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    @contextlib.contextmanager
+    def attach(self, parent: Optional[Span]) -> Iterator[None]:
+        """在其他线程中把 parent 当作当前区间 (阶段调度器用它把并发阶段挂到发起它们的管道下面)。"""
+        if parent is None:
+            yield
+            return
+        stack = self._stack()
+        stack.append(parent)
+        try:
+            yield
+        finally:
+            stack.pop()
+
+    @contextlib.contextmanager
+    def span(self, kind: str, name: str, ctx=None, detail: Optional[str] = None) -> Iterator[Span]:
+        """记录一个区间；传入 ctx 时同时记录计数器的增量。"""
+        stack = self._stack()
+        parent = stack[-1] if stack else None
+        with self._lock:
+            span = Span(
+                id=len(self.spans), parent=None if parent is None else parent.id, kind=kind, name=name,
+                detail=detail, thread=threading.current_thread().name, start=time.perf_counter() - self._origin
+            )
+            self.spans.append(span)
+
+        tracing = self.trace_memory and tracemalloc.is_tracing()
+        if tracing:
+            self._fold_peak(stack)
+            span._base_bytes = span._max_bytes = tracemalloc.get_traced_memory()[0]
+        before = counter_snapshot(ctx) if ctx is not None else None
+        stack.append(span)
+        wall_start, cpu_start = time.perf_counter(), time.thread_time()
+        try:
+            yield span
+        finally:
+            span.wall_seconds = time.perf_counter() - wall_start
+            span.cpu_seconds = time.thread_time() - cpu_start
+            if before is not None:
+                span.counters = {
+                    name: after - start for name, start, after in zip(COUNTERS, before, counter_snapshot(ctx))
+                }
+            if tracing:
+                self._fold_peak(stack)
+                span.peak_bytes = span._max_bytes - span._base_bytes
+            stack.pop()
+
+    @staticmethod
+    def _fold_peak(open_spans: List[Span]):
+        # tracemalloc 只有一个全局峰值：把它计入所有未结束的区间后清零，嵌套的区间因此互不干扰
+        peak = tracemalloc.get_traced_memory()[1]
+        for span in open_spans:
+            span._max_bytes = max(span._max_bytes, peak)
+        tracemalloc.reset_peak()
+
+    # --- 报告 ---
+
+    def stage_totals(self) -> List[dict]:
+        """按 (kind, name) 汇总所有区间，按首次出现的顺序排列。"""
+        return aggregate_spans(self.spans)
+
+    def report(self) -> dict:
+        roots = [span for span in self.spans if span.parent is None]
+        return {
+            "traceMemory": self.trace_memory,
+            "wallSeconds": round(sum(span.wall_seconds for span in roots), 6),
+            "stages": self.stage_totals(),
+            "spans": [span.to_dict() for span in self.spans],
+        }
+
+    def write_json(self, filename: str):
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, indent=2, ensure_ascii=False)
+        print(f"--- 性能报告已写入 '{filename}' ---")
+
+    def summary_table(self) -> str:
+        return format_stage_table(self.stage_totals())
+
+
+def aggregate_spans(spans: Iterable[Span]) -> List[dict]:
+    totals: Dict[Tuple[str, str], dict] = {}
+    for span in spans:
+        row = totals.get((span.kind, span.name))
+        if row is None:
+            row = totals[(span.kind, span.name)] = {
+                "kind": span.kind, "name": span.name, "calls": 0, "wallSeconds": 0.0, "cpuSeconds": 0.0,
+                "peakBytes": None, **{name: 0 for name in COUNTERS},
+            }
+        _accumulate(row, span.to_dict(), calls=1)
+    return list(totals.values())
+
+
+def merge_stage_totals(reports: Iterable[List[dict]]) -> List[dict]:
+    """把多次运行的 stage_totals() 合并 (批量生成时汇总用)：次数、时间和计数器求和，峰值取最大。"""
+    totals: Dict[Tuple[str, str], dict] = {}
+    for stages in reports:
+        for stage in stages:
+            row = totals.get((stage["kind"], stage["name"]))
+            if row is None:
+                row = totals[(stage["kind"], stage["name"])] = {**stage, "calls": 0, "wallSeconds": 0.0,
+                                                                "cpuSeconds": 0.0, "peakBytes": None,
+                                                                **{name: 0 for name in COUNTERS}}
+            _accumulate(row, stage, calls=stage["calls"])
+    return list(totals.values())
+
+
+def _accumulate(row: dict, values: dict, calls: int):
+    row["calls"] += calls
+    row["wallSeconds"] = round(row["wallSeconds"] + values["wallSeconds"], 6)
+    row["cpuSeconds"] = round(row["cpuSeconds"] + values["cpuSeconds"], 6)
+    if values["peakBytes"] is not None:
+        row["peakBytes"] = max(row["peakBytes"] or 0, values["peakBytes"])
+    for name in COUNTERS:
+        row[name] += values.get(name, 0)
+
+
+def format_stage_table(stages: List[dict]) -> str:
+    """把阶段汇总排成一张按墙钟时间降序的表。"""
+    header = (f"{'kind':>9} | {'name':<36} | {'calls':>6} | {'wall (s)':>9} | {'cpu (s)':>9} | "
+              f"{'peak (KB)':>10} | {'allocs':>7} | {'samples':>8} | {'masks':>6} | {'objects':>8}")
+    lines = [header, "-" * len(header)]
+    for stage in sorted(stages, key=lambda s: s["wallSeconds"], reverse=True):
+        peak = '-' if stage["peakBytes"] is None else f"{stage['peakBytes'] / 1024:.1f}"
+        lines.append(
+            f"{stage['kind']:>9} | {stage['name']:<36} | {stage['calls']:>6} | {stage['wallSeconds']:>9.4f} | "
+            f"{stage['cpuSeconds']:>9.4f} | {peak:>10} | {stage[ARRAY_ALLOCATIONS]:>7} | "
+            f"{stage[SAMPLES_DRAWN]:>8} | {stage[MASK_RECOMPUTATIONS]:>6} | {stage[OBJECTS_PLACED]:>8}"
+        )
+    return "\n".join(lines)
+
+
+# --- 包装 ---
+
+def instrumented(kind: str) -> Callable:
+    """
+    把一个以上下文为第一个参数的函数记录为 kind 类区间 ('modifier'、'placement'、'pipeline')。
+    区间的 detail 是第一个字符串参数 (通常是目标层名或概率层名)。
+    """
+    def decorate(func):
+        name = func.__name__
+
+        @functools.wraps(func)
+        def wrapper(ctx, *args, **kwargs):
+            profiler = ctx.profiler
+            if profiler is None:
+                return func(ctx, *args, **kwargs)
+            detail = next((value for value in (*args, *kwargs.values()) if isinstance(value, str)), None)
+            with profiler.span(kind, name, ctx, detail):
+                return func(ctx, *args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+# --- 日志 ---
+
+class _StdoutHandler(logging.StreamHandler):
+    """把消息原样写到当前的 sys.stdout (与 print 相同，contextlib.redirect_stdout 仍然有效)。"""
+
+    def __init__(self):
+        super().__init__()
+        self.setFormatter(logging.Formatter('%(message)s'))
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+# 默认的输出：所有级别的消息都写到 stdout，不经过根 logger
+_STDOUT_HANDLER = _StdoutHandler()
+LOGGER.addHandler(_STDOUT_HANDLER)
+LOGGER.setLevel(logging.DEBUG)
+LOGGER.propagate = False
+
+
+@contextlib.contextmanager
+def quiet_output(level=logging.WARNING) -> Iterator[None]:
+    """
+    在 with 块内只记录 level 及以上的流程消息 (level 可以是数字或 'WARNING' 这样的名字)，
+    并且不再写到 stdout，而是交给根 logger 的处理器 (由调用方用 logging.basicConfig 等配置)。
+    """
+    previous_level, previous_propagate = LOGGER.level, LOGGER.propagate
+    LOGGER.removeHandler(_STDOUT_HANDLER)
+    LOGGER.propagate = True
+    LOGGER.setLevel(level)
+    try:
+        yield
+    finally:
+        LOGGER.setLevel(previous_level)
+        LOGGER.propagate = previous_propagate
+        if not previous_propagate:
+            LOGGER.addHandler(_STDOUT_HANDLER)
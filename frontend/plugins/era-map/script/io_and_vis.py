@@ -1,77 +1,208 @@
 ﻿import json
+import logging
 import math
 
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
-import random
-from typing import List
+from typing import Dict, List, Optional
 
-from core_types import GenerationContext, GameObject
+from core_types import GenerationContext, GameObject, ParticleLayer
+from instrumentation import instrumented
+from layout_binary import write_layout_binary
+from layout_encoding import encode_grid
+from object_store import ObjectTable
 from prototype import Settings
 
+LOGGER = logging.getLogger('era_map.io_and_vis')
+
 # =============================================================================
 # 1. 数据导出 (Data Export)
 # =============================================================================
 
-def  export_context_to_json(context: GenerationContext, settings: Settings, filename="init_layout.json"):
-    """将生成上下文中的所有游戏对象和数据场导出为前端可以使用的JSON文件。"""
-
-    # --- 序列化 Fields ---
-    fields_data = {}
-    for field_name, field_array in context.fields.items():
-        fields_data[field_name] = field_array.tolist()
-
-    # --- 序列化 Particles ---
-    particles_data = {}
-    for particle_name, particle_layer in context.particles.items():
-        particles_data[particle_name] = {
-            "type": particle_layer.type,
-            "seed": particle_layer.seed,
-            "densityGrid": particle_layer.density_grid.tolist(),
-            "particleConfig": particle_layer.particle_config
-        }
-
-    # --- 序列化 Objects ---
-    objects_data = []
-    for obj in context.objects:
+# 导出网格时每次转换为 Python 列表的格子数，memmap 上的场和粒子层按块读取，不会整张读入内存
+EXPORT_BLOCK_CELLS = 1 << 20
+
+# 低于 float64 精度的浮点网格导出时保留的小数位数 (float32 的有效数字约为 7 位，
+# 直接转换为 Python float 会输出 0.30000001192092896 这样冗长的数字)
+EXPORT_FLOAT_DECIMALS = 6
+
+
+def _grid_rows_json(grid: np.ndarray):
+    """逐行产生网格的 JSON 文本 (每行是一个 JSON 数组)，按块读取。"""
+    w = grid.shape[0]
+    step = max(1, EXPORT_BLOCK_CELLS // max(1, grid[0].size)) if w else 1
+    for x0 in range(0, w, step):
+        block = np.asarray(grid[x0:x0 + step])
+        if block.dtype.kind == 'f' and block.dtype.itemsize < 8:
+            block = np.round(block.astype(np.float64), EXPORT_FLOAT_DECIMALS)
+        for row in block.tolist():
+            yield json.dumps(row)
+
+
+def _write_grid(f, grid: np.ndarray, indent: str, encoding: str = 'dense', quantization: Optional[str] = None):
+    """
+    把一张二维网格写成 JSON。dense 编码是嵌套数组 (grid[x][y])，每行一行文本；
+    其他编码 (稀疏、游程、量化，见 layout_encoding) 写成一个带 "encoding" 键的对象。
+    """
+    encoded = encode_grid(grid, encoding, quantization)
+    if encoded is not None:
+        f.write(json.dumps(encoded))
+        return
+    f.write("[")
+    for i, row in enumerate(_grid_rows_json(grid)):
+        f.write(("," if i else "") + "\n" + indent + "  " + row)
+    f.write("\n" + indent + "]")
+
+
+def _iter_object_dicts(objects: ObjectTable):
+    """按列整体转换为 Python 列表，再逐行组装字典，避免为每个对象创建视图和小数组。"""
+    type_names = [objects.type_names[c] for c in objects.type_codes.tolist()]
+    visual_pos = objects.visual_pos.tolist()
+    visual_angle = objects.visual_angle.tolist()
+    uids = objects.uids.tolist()
+    grid_pos = objects.grid_pos.tolist()
+    grid_size = objects.grid_size.tolist()
+    has_grid_pos = objects.has_grid_pos.tolist()
+    has_grid_size = objects.has_grid_size.tolist()
+
+    for i in range(len(objects)):
         obj_dict = {
-            "obj_type": obj.obj_type,
-            # 将 numpy 数组转换为列表以便 JSON 序列化
-            "visual_pos": obj.visual_pos.tolist(),
-            "visual_angle": obj.visual_angle,
+            "obj_type": type_names[i],
+            "visual_pos": visual_pos[i],
+            "visual_angle": visual_angle[i],
             # 添加 uid
-            "uid": obj.uid
+            "uid": uids[i]
         }
 
         # 可选属性：只有存在时才添加
-        if obj.grid_pos is not None:
-            obj_dict["grid_pos"] = obj.grid_pos.tolist()
-        if obj.grid_size is not None:
-            obj_dict["grid_size"] = obj.grid_size.tolist()
-
-        objects_data.append(obj_dict)
-
-
-    # --- 构建最终的JSON结构 ---
-    meta_data = {
+        if has_grid_pos[i]:
+            obj_dict["grid_pos"] = grid_pos[i]
+        if has_grid_size[i]:
+            obj_dict["grid_size"] = grid_size[i]
+
+        yield obj_dict
+
+
+def write_layout_json(
+        filename: str,
+        meta_data: dict,
+        objects: ObjectTable,
+        fields: Dict[str, np.ndarray],
+        particles: Dict[str, ParticleLayer],
+        encoding: str = 'dense',
+        encodings: Optional[Dict[str, str]] = None,
+        quantization: Optional[str] = None
+):
+    """
+    把对象、数据场和粒子层按前端的布局格式流式写入 filename。
+    对象逐个序列化，场和粒子密度网格逐行 (或按块编码后) 序列化，因此 memmap 上的超大网格也不会被整张转换为 Python 列表或读入内存。
+    encoding 是场和粒子密度网格的默认编码，encodings 按场名 / 粒子层名覆盖；quantization 是 'auto' 编码允许的量化类型。
+    """
+    encodings = encodings or {}
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write('{\n  "meta": ' + json.dumps(meta_data) + ',\n')
+
+        # --- 序列化 Objects ---
+        f.write('  "objects": [')
+        for i, obj_dict in enumerate(_iter_object_dicts(objects)):
+            f.write(("," if i else "") + "\n    " + json.dumps(obj_dict))
+        f.write('\n  ],\n')
+
+        # --- 序列化 Fields ---
+        f.write('  "fields": {')
+        for i, (field_name, field_array) in enumerate(fields.items()):
+            f.write(("," if i else "") + "\n    " + json.dumps(field_name) + ": ")
+            _write_grid(f, field_array, "    ", encodings.get(field_name, encoding), quantization)
+        f.write('\n  },\n')
+
+        # --- 序列化 Particles ---
+        f.write('  "particles": {')
+        for i, (particle_name, particle_layer) in enumerate(particles.items()):
+            header = {"type": particle_layer.type, "seed": particle_layer.seed}
+            f.write(("," if i else "") + "\n    " + json.dumps(particle_name) + ": ")
+            f.write(json.dumps(header)[:-1] + ', "densityGrid": ')
+            _write_grid(f, particle_layer.density_grid, "    ", encodings.get(particle_name, encoding), quantization)
+            f.write("}")
+        f.write('\n  }\n}\n')
+
+
+def _layout_meta(settings: Settings) -> dict:
+    return {
         "gridWidth": settings.GRID_WIDTH,
         "gridHeight": settings.GRID_HEIGHT,
     }
 
-    output_data = {
-        "meta": meta_data,
-        "objects": objects_data,
-        "fields": fields_data,
-        "particles": particles_data,
+
+def layout_encoding_options(settings: Settings) -> dict:
+    """Settings 中网格编码的配置，作为 write_layout_json 的关键字参数。"""
+    return {
+        "encoding": settings.LAYOUT_GRID_ENCODING,
+        "encodings": settings.LAYOUT_GRID_ENCODINGS,
+        "quantization": settings.LAYOUT_QUANTIZATION,
     }
 
+
+@instrumented('export')
+def  export_context_to_json(context: GenerationContext, settings: Settings, filename="init_layout.json"):
+    """
+    将生成上下文中的所有游戏对象和数据场导出为前端可以使用的JSON文件 (流式写入，见 write_layout_json)。
+    场和粒子密度网格按 settings.LAYOUT_GRID_ENCODING 编码，默认 'auto' 为每张网格选择最短的编码。
+    """
+    try:
+        write_layout_json(
+            filename, _layout_meta(settings), context.objects, context.fields, context.particles,
+            **layout_encoding_options(settings)
+        )
+        LOGGER.info("--- 布局成功导出到文件: %s ---", filename)
+    except Exception as e:
+        LOGGER.error("!!! 导出到JSON时发生错误: %s !!!", e)
+
+
+@instrumented('export')
+def export_context_to_binary(
+        context: GenerationContext,
+        settings: Settings,
+        filename="init_layout.bin",
+        compression: Optional[str] = None
+):
+    """
+    将生成上下文导出为二进制布局 (与 export_context_to_json 的信息相同，格式见 layout_binary)。
+    compression 可以是 None、'gzip' 或 'brotli'。
+    """
     try:
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(output_data, f, indent=2)
-        print(f"--- 布局成功导出到文件: {filename} ---")
+        write_layout_binary(
+            filename, _layout_meta(settings), context.objects, context.fields, context.particles,
+            compression=compression
+        )
+        LOGGER.info("--- 布局成功导出到二进制文件: %s ---", filename)
     except Exception as e:
-        print(f"!!! 导出到JSON时发生错误: {e} !!!")
+        LOGGER.error("!!! 导出到二进制布局时发生错误: %s !!!", e)
+
+
+def layout_filenames(settings: Settings, basename: str) -> Dict[str, str]:
+    """
+    按 settings.LAYOUT_FORMAT 确定要写出的布局文件：'json' 写 basename.json，
+    'binary' 写 basename.bin (按 LAYOUT_COMPRESSION 压缩时加 .gz / .br)，'both' 两者都写。
+    """
+    if settings.LAYOUT_FORMAT not in ('json', 'binary', 'both'):
+        raise ValueError(f"未知的布局格式 '{settings.LAYOUT_FORMAT}'，可选: 'json', 'binary', 'both'")
+    filenames = {}
+    if settings.LAYOUT_FORMAT in ('json', 'both'):
+        filenames['json'] = f"{basename}.json"
+    if settings.LAYOUT_FORMAT in ('binary', 'both'):
+        suffix = {'gzip': '.gz', 'brotli': '.br'}.get(settings.LAYOUT_COMPRESSION, '')
+        filenames['binary'] = f"{basename}.bin{suffix}"
+    return filenames
+
+
+def export_layout(context: GenerationContext, settings: Settings, basename="layout"):
+    """按 settings.LAYOUT_FORMAT 导出 JSON 和 / 或二进制布局 (文件名见 layout_filenames)。"""
+    filenames = layout_filenames(settings, basename)
+    if 'json' in filenames:
+        export_context_to_json(context, settings, filenames['json'])
+    if 'binary' in filenames:
+        export_context_to_binary(context, settings, filenames['binary'], compression=settings.LAYOUT_COMPRESSION)
 
 # =============================================================================
 # 2. 可视化 (Visualization)
@@ -81,30 +212,39 @@ class Visualizer:
     def __init__(self, settings: Settings):
         self.settings = settings
         self.colors = settings.COLORS # 沿用Settings中的颜色配置
+        # 只影响绘图效果的随机数，使用固定种子，保证同一布局每次绘制结果一致
+        self.rng = np.random.default_rng(0)
+
+    def request_retention(self, context: GenerationContext):
+        """
+        调试模式：要求上下文保留所有中间层 (不随管道作用域释放，也不因内存预算被驱逐)，
+        这样 plot_layout_and_layers 可以画出生成过程中的每一张层。需要在运行管道之前调用。
+        """
+        context.layers.retain_all = True
 
-    def _draw_objects(self, ax: plt.Axes, objects: List[GameObject]):
+    def _draw_objects(self, ax: plt.Axes, objects: ObjectTable):
         """在给定的 Axes 上绘制所有游戏对象。"""
         # 为了正确的绘制顺序，我们先绘制脏污，再绘制家具，最后绘制角色
 
         # 脏污
-        grime_small = [o for o in objects if o.obj_type == "GRIME_SMALL"]
-        grime_large = [o for o in objects if o.obj_type == "GRIME_LARGE"]
+        grime_small = objects.select("GRIME_SMALL")
+        grime_large = objects.select("GRIME_LARGE")
 
         # 环境装置类别
-        fixtures = [o for o in objects if o.obj_type in ["WINDOW", "TORCH"]]
-        characters = [o for o in objects if o.obj_type in ["ELF", "DWARF", "MUSHROOM_PERSON"]]
+        fixtures = objects.select(["WINDOW", "TORCH"])
+        characters = objects.select(["ELF", "DWARF", "MUSHROOM_PERSON"])
 
         if grime_small:
-            positions = np.array([o.visual_pos for o in grime_small])
+            positions = grime_small.visual_pos
             ax.scatter(positions[:, 0], positions[:, 1], s=0.2*20, c=self.colors["GRIME_SMALL"], alpha=0.6, marker='o', edgecolors='none', zorder=0)
 
         if grime_large:
             for obj in grime_large:
-                size = random.uniform(0.8, 1.5) * 5
+                size = self.rng.uniform(0.8, 1.5) * 5
                 ax.scatter(obj.visual_pos[0], obj.visual_pos[1], s=size*20, c=self.colors["GRIME_LARGE"], alpha=0.6, marker='o', edgecolors='none', zorder=1)
 
         # 家具 (桌子和椅子)
-        furniture = [o for o in objects if o.obj_type in ["TABLE", "CHAIR"]]
+        furniture = objects.select(["TABLE", "CHAIR"])
         for obj in furniture:
             if obj.grid_size is not None:
                 w, h = obj.grid_size
@@ -149,7 +289,7 @@ class Visualizer:
         num_layers = len(drawable_layers)
 
         if num_layers == 0:
-            print("--- 可视化: 未找到任何可绘制的数据。只显示最终布局。---")
+            LOGGER.info("--- 可视化: 未找到任何可绘制的数据。只显示最终布局。---")
             fig, ax_main = plt.subplots(figsize=(12, 8))
             ax_main.set_title("Final Generated Layout")
             self._setup_main_ax(ax_main)
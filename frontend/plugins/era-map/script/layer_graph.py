@@ -0,0 +1,663 @@
+import logging
+import os
+import re
+import tempfile
+import threading
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+
+from layer_storage import LayerStorage, is_disk_backed
+
+LOGGER = logging.getLogger('era_map.layer_graph')
+
+# 层的生命周期
+#   temporary: 管道内的中间层，最后一个声明的消费者运行后 (或所在作用域结束时) 释放，超出内存预算时可被换出到磁盘
+#   pinned:    常驻内存，既不会被释放也不会被换出
+#   field:     之后会被提升为场的层，不会被作用域释放，但超出预算时同样可以换出到磁盘
+TEMPORARY = 'temporary'
+PINNED = 'pinned'
+FIELD = 'field'
+LIFECYCLES = (TEMPORARY, PINNED, FIELD)
+
+# 分块求值时每块包含的格子数 (float64 下约 512KB)，让一条融合后的逐元素链条在缓存内完成
+FUSED_BLOCK_CELLS = 64 * 1024
+
+
+def normalize_tolerance(min_val, max_val, dtype) -> float:
+    """
+    归一化时判定“层是平坦的”所用的阈值。
+    除了绝对的 1e-9，还考虑数值量级：float32 下幅值很大的层，几个 ulp 以内的起伏只是舍入噪声。
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind != 'f':
+        return 1e-9
+    scale = max(abs(float(min_val)), abs(float(max_val)))
+    return max(1e-9, 4 * float(np.finfo(dtype).eps) * scale)
+
+
+def upcast_half(values: np.ndarray) -> np.ndarray:
+    """float16 的精度和取值范围都不足以安全地做减法和除法，归一化之前先提升到 float32。"""
+    return values.astype(np.float32) if values.dtype == np.float16 else values
+
+
+class LayerExpr:
+    """
+    惰性层表达式 DAG 的节点。
+
+    节点只记录“如何计算”，不持有结果；支持与标量或其他节点做 + - * / ** 运算，
+    因此 combine_layers 之类的修改器可以对数组和节点使用同一段算术代码。
+    求值时整条逐元素链条按行分块、一块一块地融合计算，不会为中间步骤分配整张网格。
+    """
+
+    shape: Tuple[int, int]
+    # 节点对应的层名 (只有直接从 LayerStore 取出的节点才有)，用于追踪依赖
+    layer_name: Optional[str] = None
+    # 所在的层被求值后缓存的结果，仍引用这个节点的其他表达式直接从中读取
+    _result: Optional[np.ndarray] = None
+
+    # 让 ndarray (+-*/) LayerExpr 交给 LayerExpr 的反向运算符处理
+    __array_ufunc__ = None
+
+    def children(self) -> Tuple['LayerExpr', ...]:
+        return ()
+
+    def _block(self, rows: slice, memo: Dict[int, np.ndarray]) -> np.ndarray:
+        raise NotImplementedError
+
+    def block(self, rows: slice, memo: Dict[int, np.ndarray]) -> np.ndarray:
+        """计算第 rows 行的结果。同一块内被多处引用的节点只计算一次。"""
+        if self._result is not None:
+            return self._result[rows]
+        key = id(self)
+        result = memo.get(key)
+        if result is None:
+            result = self._block(rows, memo)
+            memo[key] = result
+        return result
+
+    def evaluate(self, out: Optional[np.ndarray] = None, dtype=np.float64) -> np.ndarray:
+        """分块求值整个表达式，写入 out (或新分配的 dtype 数组)。"""
+        w, h = self.shape
+        if out is None:
+            out = np.empty((w, h), dtype=dtype)
+        step = max(1, FUSED_BLOCK_CELLS // max(1, h))
+        for x0 in range(0, w, step):
+            rows = slice(x0, min(w, x0 + step))
+            out[rows] = self.block(rows, {})
+        return out
+
+    # --- 运算符 ---
+
+    def __add__(self, other): return _BinaryOp(np.add, self, other)
+    def __radd__(self, other): return _BinaryOp(np.add, other, self)
+    def __sub__(self, other): return _BinaryOp(np.subtract, self, other)
+    def __rsub__(self, other): return _BinaryOp(np.subtract, other, self)
+    def __mul__(self, other): return _BinaryOp(np.multiply, self, other)
+    def __rmul__(self, other): return _BinaryOp(np.multiply, other, self)
+    def __truediv__(self, other): return _BinaryOp(np.true_divide, self, other)
+    def __pow__(self, other): return _BinaryOp(np.power, self, other)
+
+    def normalized(self) -> 'LayerExpr':
+        """与 safe_normalize 相同语义的归一化节点。"""
+        return _Normalize(self)
+
+    def clipped(self, lower: Optional[float], upper: Optional[float]) -> 'LayerExpr':
+        return _Clip(self, lower, upper)
+
+
+class ArrayLeaf(LayerExpr):
+    """引用一个已经存在的数组。"""
+
+    def __init__(self, array: np.ndarray, layer_name: Optional[str] = None):
+        self.array = array
+        self.shape = array.shape
+        self.layer_name = layer_name
+
+    def _block(self, rows, memo):
+        return self.array[rows]
+
+
+class FullLeaf(LayerExpr):
+    """常数层，求值前不占用任何内存。"""
+
+    def __init__(self, shape: Tuple[int, int], value: float, dtype=np.float64):
+        self.shape = tuple(shape)
+        self.value = float(value)
+        self.dtype = np.dtype(dtype)
+
+    def _block(self, rows, memo):
+        return np.full((rows.stop - rows.start, self.shape[1]), self.value, dtype=self.dtype)
+
+
+class _BinaryOp(LayerExpr):
+    def __init__(self, func, a, b):
+        self.func = func
+        self.a = a
+        self.b = b
+        self.shape = a.shape if isinstance(a, LayerExpr) else b.shape
+
+    def children(self):
+        return tuple(x for x in (self.a, self.b) if isinstance(x, LayerExpr))
+
+    def _block(self, rows, memo):
+        a = self.a.block(rows, memo) if isinstance(self.a, LayerExpr) else self.a
+        b = self.b.block(rows, memo) if isinstance(self.b, LayerExpr) else self.b
+        return self.func(a, b)
+
+
+class _Clip(LayerExpr):
+    def __init__(self, child: LayerExpr, lower, upper):
+        self.child = child
+        self.lower = lower
+        self.upper = upper
+        self.shape = child.shape
+
+    def children(self):
+        return (self.child,)
+
+    def _block(self, rows, memo):
+        return np.clip(self.child.block(rows, memo), self.lower, self.upper)
+
+
+class _Normalize(LayerExpr):
+    """
+    归一化需要整张图的最小/最大值，是融合链条中唯一的“全局”步骤：
+    第一次求值时先对子表达式分块扫描一遍求出统计量 (同样不分配整张网格)，之后缓存在节点上。
+    """
+
+    def __init__(self, child: LayerExpr):
+        self.child = child
+        self.shape = child.shape
+        self._stats: Optional[Tuple[float, float]] = None
+
+    def children(self):
+        return (self.child,)
+
+    def stats(self) -> Tuple[float, float]:
+        if self._stats is None:
+            w, h = self.shape
+            step = max(1, FUSED_BLOCK_CELLS // max(1, h))
+            lo, hi = np.inf, -np.inf
+            for x0 in range(0, w, step):
+                values = upcast_half(self.child.block(slice(x0, min(w, x0 + step)), {}))
+                lo, hi = min(lo, values.min()), max(hi, values.max())
+            self._stats = (lo, hi)
+        return self._stats
+
+    def _block(self, rows, memo):
+        min_val, max_val = self.stats()
+        data_range = max_val - min_val
+        values = upcast_half(self.child.block(rows, memo))
+        if data_range > normalize_tolerance(min_val, max_val, values.dtype):
+            return (values - min_val) / data_range
+        return np.zeros_like(values)
+
+
+@dataclass
+class DtypePolicy:
+    """
+    层和场的数值类型策略。
+
+    compute 是修改器创建新层、计算影响图和噪声时使用的类型；概率图和适宜度图不需要 float64 的精度，
+    默认的 float32 让每一次整层运算的内存和带宽减半。
+    half_layers 中列出的层以 float16 存储 (读取次数少、只用作权重的层)，归一化时会先提升到 float32。
+    field_dtype 是 promote_layer_to_field 写入 ctx.fields 时使用的类型。
+    """
+    compute: np.dtype = np.dtype(np.float32)
+    half_layers: Set[str] = field(default_factory=set)
+    field_dtype: np.dtype = np.dtype(np.float32)
+
+    def __post_init__(self):
+        self.compute = np.dtype(self.compute)
+        self.field_dtype = np.dtype(self.field_dtype)
+        self.half_layers = set(self.half_layers)
+
+    def storage_dtype(self, name: str) -> np.dtype:
+        """名为 name 的层在 LayerStore 中的存储类型。"""
+        return np.dtype(np.float16) if name in self.half_layers else self.compute
+
+
+class LayerStore(MutableMapping):
+    """
+    ctx.layers 的存储。默认 (lazy=False) 时就是一个普通的 名字 -> 数组 映射。
+
+    lazy=True 时，修改器可以用 set_lazy 存入表达式节点，而不是立刻计算出整张数组；
+    只有在真正读取 (放置策略、导出、可视化) 时才会分块融合求值，并把结果缓存为普通数组。
+    从未被读取的中间层永远不会分配内存。
+
+    写屏障：通过 store[name] 取得的数组可能被原地修改，因此在交出它之前，
+    所有仍然引用该层的惰性表达式会先被求值，保证它们看到的是修改前的数据。
+    只读访问请用 read()，它不触发写屏障。
+
+    设置了 dtype_policy 时，存入的浮点数组会被转换为该层的存储类型 (类型相同时不复制)，
+    惰性层也直接求值到存储类型的数组中。
+    设置了 storage 时，存入的数组按层名放到对应的后端 (内存或 memmap，见 LayerStorage)；
+    allocate() 直接在目标后端上分配新层，惰性层也分块求值到目标后端的数组中。
+
+    生命周期：每个层都有一个生命周期 (默认 temporary，见 LIFECYCLES)。
+    在 scope() 作用域内创建的临时层会在最后一个声明的消费者运行后、或作用域结束时被释放。
+    设置了 memory_budget_bytes 时，常驻数组的总大小超出预算后，最久未使用的非 pinned 层
+    会被逐出内存、换出到 spill_dir (之后访问时自动读回)；没有设置 spill_dir 时使用系统临时目录。
+    retain_all 为 True 时 (可视化调试模式) 作用域不会释放任何层，超出预算的层仍然可能被换出。
+    换出只替换存储中的引用：调用方已经拿到的数组仍然有效，但在它被换出之后做的原地修改不会写回，
+    因此原地修改应当紧跟在 store[name] 之后，中间不要再访问其他层。
+
+    线程安全：存储的所有读写都在一把可重入锁内完成，多个并发阶段 (见 stage_scheduler) 可以同时读写不同的层。
+    并发阶段原地修改层期间，用 hold() 保护这些层不被其他线程触发的预算检查换出。
+    """
+
+    def __init__(
+            self,
+            initial: Optional[Dict[str, np.ndarray]] = None,
+            lazy: bool = False,
+            dtype_policy: Optional[DtypePolicy] = None,
+            memory_budget_bytes: Optional[int] = None,
+            spill_dir: Optional[str] = None,
+            storage: Optional[LayerStorage] = None
+    ):
+        self.lazy = lazy
+        self.dtype_policy = dtype_policy
+        self.storage = storage
+        self.memory_budget_bytes = memory_budget_bytes
+        self.spill_dir = spill_dir
+        self.retain_all = False
+        self._data: Dict[str, object] = dict(initial or {})
+        # 惰性层 -> 它直接或间接引用的层名
+        self._deps: Dict[str, Set[str]] = {}
+        # 不是 temporary 的层的生命周期 (未列出的层都是 temporary)
+        self._lifecycles: Dict[str, str] = {}
+        # 每个层最近一次被访问时的逻辑时钟，用于 LRU
+        self._last_use: Dict[str, int] = {}
+        self._clock = 0
+        # 没有指定 spill_dir 时按需创建的临时目录，随存储一起被清理
+        self._spill_tmpdir: Optional[tempfile.TemporaryDirectory] = None
+        self._scopes: List['LayerScope'] = []
+        # 正在被并发阶段使用、不能换出的层 -> 持有次数
+        self._held: Dict[str, int] = {}
+        self._lock = threading.RLock()
+        # 统计 (arrays_stored: 存入的新数组个数，同一个数组重复存入同名层不计)
+        self.spills = 0
+        self.reloads = 0
+        self.arrays_stored = 0
+
+    # --- 惰性接口 ---
+
+    def node(self, name: str) -> LayerExpr:
+        """以表达式节点的形式取出一个层，不触发求值 (已换出的层会先读回)。"""
+        with self._lock:
+            value = self._data[name]
+            if isinstance(value, _SpilledLayer):
+                value = self._materialize(name)
+            if isinstance(value, LayerExpr):
+                return value
+            return ArrayLeaf(value, layer_name=name)
+
+    def set_lazy(self, name: str, expr: LayerExpr):
+        """把表达式存为一个惰性层。非惰性模式下立即求值。"""
+        if not self.lazy:
+            self[name] = expr.evaluate(out=self.allocate(name, expr.shape))
+            return
+        with self._lock:
+            # 覆盖一个层之前，先让仍然引用它当前内容的惰性层求值
+            self._materialize_dependents(name)
+            self._discard_spill(name)
+            is_new = name not in self._data
+            expr.layer_name = name
+            self._data[name] = expr
+            self._deps[name] = _collect_layer_names(expr) - {name}
+            self._after_write(name, is_new)
+
+    def storage_dtype(self, name: str) -> np.dtype:
+        """层 name 的存储类型；没有设置 dtype_policy 时为 float64。"""
+        if self.dtype_policy is None:
+            return np.dtype(np.float64)
+        return self.dtype_policy.storage_dtype(name)
+
+    def allocate(self, name: str, shape: Tuple[int, int], fill_value: Optional[float] = None) -> np.ndarray:
+        """
+        为层 name 分配一个存储类型、存储后端都符合要求的数组 (只分配，不存入)。
+        fill_value 为 None 时内容未定义。修改器创建新层时应当用它代替 np.full / np.zeros，
+        这样 memmap 后端的层从一开始就在磁盘上，存入时也不需要再复制。
+        """
+        dtype = self.storage_dtype(name)
+        if self.storage is not None:
+            return self.storage.allocate(name, shape, dtype, fill_value)
+        if fill_value is None:
+            return np.empty(shape, dtype=dtype)
+        return np.full(shape, fill_value, dtype=dtype)
+
+    def is_materialized(self, name: str) -> bool:
+        """层是否以数组的形式驻留在内存中 (惰性层和已换出的层都不是)。"""
+        return isinstance(self._data[name], np.ndarray)
+
+    def read(self, name: str) -> np.ndarray:
+        """返回层的只读视图 (必要时求值)，不触发写屏障。"""
+        with self._lock:
+            view = self._materialize(name).view()
+        view.setflags(write=False)
+        return view
+
+    def materialize_all(self):
+        with self._lock:
+            for name in list(self._data):
+                self._materialize(name)
+
+    def _materialize(self, name: str) -> np.ndarray:
+        value = self._data[name]
+        self._touch(name)
+        if isinstance(value, _SpilledLayer):
+            value = value.load()
+            self._data[name] = value
+            self.reloads += 1
+            self._enforce_budget(protect=name)
+        elif isinstance(value, LayerExpr):
+            expr = value
+            value = expr.evaluate(out=self.allocate(name, expr.shape))
+            expr._result = value
+            self._data[name] = value
+            self._deps.pop(name, None)
+            self._enforce_budget(protect=name)
+        return value
+
+    def _materialize_dependents(self, name: str):
+        for other in [n for n, deps in self._deps.items() if name in deps]:
+            self._materialize(other)
+
+    # --- 生命周期 ---
+
+    def set_lifecycle(self, name: str, lifecycle: str):
+        """设置层的生命周期 (层可以尚不存在，之后创建时生效)。"""
+        if lifecycle not in LIFECYCLES:
+            raise ValueError(f"未知的层生命周期 '{lifecycle}'，可选: {LIFECYCLES}")
+        if lifecycle == TEMPORARY:
+            self._lifecycles.pop(name, None)
+        else:
+            self._lifecycles[name] = lifecycle
+
+    def lifecycle(self, name: str) -> str:
+        return self._lifecycles.get(name, TEMPORARY)
+
+    def pin(self, *names: str):
+        for name in names:
+            self.set_lifecycle(name, PINNED)
+
+    def scope(self, name: str) -> 'LayerScope':
+        """管道作用域：with store.scope('tables') as scope: ...，详见 LayerScope。"""
+        return LayerScope(self, name)
+
+    def declare_consumers(self, layer_name: str, consumers: Iterable[str]):
+        """在最内层的作用域中声明 layer_name 的消费者 (见 LayerScope.declare)；不在任何作用域内时什么都不做。"""
+        with self._lock:
+            if self._scopes:
+                self._scopes[-1].declare(layer_name, consumers)
+
+    def mark_done(self, consumer: str):
+        """通知所有作用域一个消费者已经运行 (见 LayerScope.mark_done)。"""
+        with self._lock:
+            for scope in list(self._scopes):
+                scope.mark_done(consumer)
+
+    def release(self, name: str) -> int:
+        """
+        如果 name 是一个临时层，则把它从存储中删除，返回释放的 (常驻) 字节数。
+        pinned / field 层以及调试保留模式下不做任何事，返回 0。
+        """
+        with self._lock:
+            if name not in self._data or self.retain_all or self.lifecycle(name) != TEMPORARY:
+                return 0
+            value = self._data[name]
+            freed = value.nbytes if isinstance(value, np.ndarray) else 0
+            # 不需要先对依赖它的惰性层求值：那些表达式直接引用着这个层的数组或节点，
+            # 删除名字不会改变它们看到的数据，数组的内存在它们求值后才会真正释放
+            self._discard_spill(name)
+            self._forget(name)
+            del self._data[name]
+            return freed
+
+    @contextmanager
+    def hold(self, names: Iterable[str]) -> Iterator[None]:
+        """
+        在 with 块内保护 names 中的层不被换出 (层可以尚不存在)。
+        并发阶段拿到层数组后会在锁外原地修改它，期间其他线程的写入可能触发预算检查，
+        被换出的层上的修改会丢失，因此阶段调度器在每个阶段运行期间持有它读写的层。
+        """
+        names = list(names)
+        with self._lock:
+            for name in names:
+                self._held[name] = self._held.get(name, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                for name in names:
+                    count = self._held.pop(name) - 1
+                    if count:
+                        self._held[name] = count
+
+    @property
+    def resident_bytes(self) -> int:
+        """所有常驻内存的层数组的总大小 (惰性层、已换出的层和 memmap 层不计)。"""
+        with self._lock:
+            return sum(v.nbytes for v in self._data.values() if _is_resident(v))
+
+    @property
+    def spilled_bytes(self) -> int:
+        with self._lock:
+            return sum(v.nbytes for v in self._data.values() if isinstance(v, _SpilledLayer))
+
+    def _touch(self, name: str):
+        self._clock += 1
+        self._last_use[name] = self._clock
+
+    def _after_write(self, name: str, is_new: bool):
+        self._touch(name)
+        for scope in list(self._scopes):
+            scope._on_write(name, created=is_new and scope is self._scopes[-1])
+        self._enforce_budget(protect=name)
+
+    def _enforce_budget(self, protect: Optional[str] = None):
+        """常驻数组超出预算时，按最久未使用的顺序把层换出到磁盘，直到回到预算以内。"""
+        if self.memory_budget_bytes is None:
+            return
+        resident = self.resident_bytes
+        if resident <= self.memory_budget_bytes:
+            return
+        # 仍被惰性层引用的数组不处理：那些表达式持有它的引用，换出也释放不了内存
+        referenced = set().union(*self._deps.values()) if self._deps else set()
+        candidates = sorted(
+            (n for n, v in self._data.items()
+             if _is_resident(v) and n != protect and n not in referenced
+             and n not in self._held and self.lifecycle(n) != PINNED),
+            key=lambda n: self._last_use.get(n, 0)
+        )
+        for name in candidates:
+            if resident <= self.memory_budget_bytes:
+                break
+            value = self._data[name]
+            self._data[name] = _SpilledLayer.save(self._spill_path(), name, value)
+            self.spills += 1
+            resident -= value.nbytes
+
+    def _spill_path(self) -> str:
+        if self.spill_dir is not None:
+            return self.spill_dir
+        if self._spill_tmpdir is None:
+            self._spill_tmpdir = tempfile.TemporaryDirectory(prefix='era-map-layers-')
+        return self._spill_tmpdir.name
+
+    def _discard_spill(self, name: str):
+        value = self._data.get(name)
+        if isinstance(value, _SpilledLayer):
+            value.discard()
+
+    def _forget(self, name: str):
+        self._deps.pop(name, None)
+        self._last_use.pop(name, None)
+
+    # --- MutableMapping ---
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        with self._lock:
+            value = self._materialize(name)
+            # 写屏障：调用方可能原地修改这个数组
+            self._materialize_dependents(name)
+            return value
+
+    def __setitem__(self, name: str, value: np.ndarray):
+        if isinstance(value, LayerExpr):
+            self.set_lazy(name, value)
+            return
+        if isinstance(value, np.ndarray):
+            dtype = value.dtype
+            if self.dtype_policy is not None and dtype.kind == 'f':
+                dtype = self.dtype_policy.storage_dtype(name)
+            if self.storage is not None:
+                value = self.storage.store(name, value, dtype)
+            else:
+                value = value.astype(dtype, copy=False)
+        with self._lock:
+            is_new = name not in self._data
+            if not is_new:
+                self._materialize_dependents(name)
+                self._discard_spill(name)
+            if isinstance(value, np.ndarray) and self._data.get(name) is not value:
+                self.arrays_stored += 1
+            self._deps.pop(name, None)
+            self._data[name] = value
+            self._after_write(name, is_new)
+
+    def __delitem__(self, name: str):
+        with self._lock:
+            self._materialize_dependents(name)
+            self._discard_spill(name)
+            self._forget(name)
+            del self._data[name]
+
+    def __contains__(self, name) -> bool:
+        return name in self._data
+
+    def __iter__(self) -> Iterator[str]:
+        # 先取快照：其他线程可能正在增删层
+        with self._lock:
+            return iter(list(self._data))
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class LayerScope:
+    """
+    管道作用域。作用域内首次创建的临时层在作用域结束时全部释放；
+    用 declare() 声明了消费者的层，会在最后一个消费者运行后立即释放，不必等到作用域结束。
+
+    消费者是一个任意的标签：向存储中写入同名的层即视为该消费者已运行
+    (最常见的情况，例如 'table_noise' 的消费者是 'initial_table_suitability')，
+    也可以用 mark_done() 显式标记 (例如一个只读取概率图的放置步骤)。
+    pinned / field 层和调试保留模式下的层不会被释放。
+    """
+
+    def __init__(self, store: LayerStore, name: str):
+        self.store = store
+        self.name = name
+        self.created: List[str] = []
+        self._consumers: Dict[str, Set[str]] = {}
+        self._done: Set[str] = set()
+        self.freed_layers: List[str] = []
+        self.freed_bytes = 0
+
+    def declare(self, layer_name: str, consumers: Iterable[str]) -> 'LayerScope':
+        """声明 layer_name 会被哪些消费者读取；全部运行过后释放它。"""
+        pending = set(consumers) - self._done
+        if pending:
+            self._consumers[layer_name] = pending
+        else:
+            self._free(layer_name)
+        return self
+
+    def mark_done(self, consumer: str):
+        """标记一个消费者已经运行。"""
+        self._done.add(consumer)
+        for layer_name, pending in list(self._consumers.items()):
+            pending.discard(consumer)
+            if not pending:
+                del self._consumers[layer_name]
+                self._free(layer_name)
+
+    def _on_write(self, name: str, created: bool):
+        if created and name not in self.created:
+            self.created.append(name)
+        self.mark_done(name)
+
+    def _free(self, name: str):
+        if name not in self.store:
+            return
+        freed = self.store.release(name)
+        if name not in self.store:
+            self.freed_layers.append(name)
+            self.freed_bytes += freed
+
+    def __enter__(self) -> 'LayerScope':
+        self.store._scopes.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.store._scopes.remove(self)
+        for name in self.created:
+            self._free(name)
+        if self.freed_layers:
+            LOGGER.info(
+                "--- 作用域 '%s' 释放了 %s 个临时层 (%.1f MB) ---",
+                self.name, len(self.freed_layers), self.freed_bytes / 1024 / 1024
+            )
+        return False
+
+
+class _SpilledLayer:
+    """一个被换出到磁盘的层 (.npy 文件)，访问时整体读回内存并删除文件。"""
+
+    def __init__(self, path: str, nbytes: int):
+        self.path = path
+        self.nbytes = nbytes
+
+    @classmethod
+    def save(cls, spill_dir: str, name: str, array: np.ndarray) -> '_SpilledLayer':
+        os.makedirs(spill_dir, exist_ok=True)
+        prefix = re.sub(r'[^0-9A-Za-z_.-]', '_', name) + '-'
+        fd, path = tempfile.mkstemp(dir=spill_dir, prefix=prefix, suffix='.npy')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, array)
+        return cls(path, array.nbytes)
+
+    def load(self) -> np.ndarray:
+        array = np.load(self.path)
+        self.discard()
+        return array
+
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def _is_resident(value) -> bool:
+    # memmap 层由操作系统按页换入换出，不计入内存预算
+    return isinstance(value, np.ndarray) and not is_disk_backed(value)
+
+
+def _collect_layer_names(expr: LayerExpr) -> Set[str]:
+    names = set()
+    stack, seen = [expr], set()
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        if node.layer_name is not None and node is not expr:
+            names.add(node.layer_name)
+        stack.extend(node.children())
+    return names
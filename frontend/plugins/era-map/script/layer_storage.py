@@ -0,0 +1,131 @@
+import os
+import tempfile
+from typing import Iterable, Optional, Tuple
+
+import numpy as np
+
+MEMORY = 'memory'
+MEMMAP = 'memmap'
+BACKENDS = (MEMORY, MEMMAP)
+
+# 分块复制时每块包含的元素数，写入 memmap 时不会产生整张图大小的临时数组
+COPY_BLOCK_ELEMENTS = 1 << 22
+
+
+class LayerStorage:
+    """
+    层和场的存储后端。
+
+    memory 后端就是普通的 numpy 数组；memmap 后端把数组放在临时目录下的文件中 (np.memmap)，
+    由操作系统按需换入换出页面，因此几千万格以上的地图也不必让所有层同时驻留在内存里。
+    memmap 数组是 ndarray 的子类，修改器和放置策略对它们的读写与普通数组完全相同。
+
+    后端可以整体设置 (default)，也可以按层名单独指定 (overrides)。
+    POSIX 系统上文件在映射后立即从目录中删除，映射被释放时磁盘空间自动回收；
+    其他系统上则留到 close() (或对象被回收) 时随临时目录一起删除。
+    """
+
+    def __init__(
+            self,
+            default: str = MEMORY,
+            memmap_names: Iterable[str] = (),
+            root_dir: Optional[str] = None
+    ):
+        if default not in BACKENDS:
+            raise ValueError(f"未知的存储后端 '{default}'，可选: {BACKENDS}")
+        self.default = default
+        self.overrides = {name: MEMMAP for name in memmap_names}
+        self._root_dir = root_dir
+        self._tmpdir: Optional[tempfile.TemporaryDirectory] = None
+        # 统计：创建过的 memmap 数组个数和总字节数
+        self.memmaps_created = 0
+        self.memmap_bytes = 0
+
+    def set_backend(self, name: str, backend: str):
+        """为单个层 (或场) 指定存储后端。"""
+        if backend not in BACKENDS:
+            raise ValueError(f"未知的存储后端 '{backend}'，可选: {BACKENDS}")
+        self.overrides[name] = backend
+
+    def backend_for(self, name: str) -> str:
+        return self.overrides.get(name, self.default)
+
+    @property
+    def root_dir(self) -> str:
+        """memmap 文件所在的目录 (没有指定时按需创建一个临时目录)。"""
+        if self._tmpdir is None:
+            if self._root_dir is not None:
+                os.makedirs(self._root_dir, exist_ok=True)
+            self._tmpdir = tempfile.TemporaryDirectory(
+                prefix='era-map-memmap-', dir=self._root_dir, ignore_cleanup_errors=True
+            )
+        return self._tmpdir.name
+
+    def allocate(self, name: str, shape: Tuple[int, ...], dtype=np.float64, fill_value: Optional[float] = None) -> np.ndarray:
+        """按 name 的后端分配一个数组；fill_value 为 None 时内容未初始化 (memmap 新文件总是全零)。"""
+        if self.backend_for(name) == MEMORY:
+            if fill_value is None:
+                return np.empty(shape, dtype=dtype)
+            return np.full(shape, fill_value, dtype=dtype)
+
+        fd, path = tempfile.mkstemp(dir=self.root_dir, prefix=_safe_prefix(name), suffix='.dat')
+        os.close(fd)
+        array = np.memmap(path, dtype=dtype, mode='w+', shape=tuple(shape))
+        try:
+            os.remove(path)
+        except OSError:
+            pass  # 不能删除已映射文件的系统上，留给临时目录清理
+        if fill_value is not None and fill_value != 0:
+            array.fill(fill_value)
+        self.memmaps_created += 1
+        self.memmap_bytes += array.nbytes
+        return array
+
+    def store(self, name: str, array: np.ndarray, dtype=None) -> np.ndarray:
+        """
+        把 array 转换为 name 的后端和 dtype 下的数组。已经符合要求的数组原样返回 (不复制)；
+        写入 memmap 时分块复制，不会分配整张图大小的临时数组。
+        """
+        dtype = array.dtype if dtype is None else np.dtype(dtype)
+        if self.backend_for(name) == MEMORY:
+            if is_disk_backed(array):
+                return np.array(array, dtype=dtype)
+            return array.astype(dtype, copy=False)
+
+        if self.owns(array) and array.dtype == dtype:
+            return array
+        target = self.allocate(name, array.shape, dtype)
+        copy_blocks(target, array)
+        return target
+
+    def owns(self, array: np.ndarray) -> bool:
+        """array 是否是由这个存储分配的 memmap。"""
+        return (
+                is_disk_backed(array) and self._tmpdir is not None
+                and os.path.dirname(array.filename) == os.path.abspath(self._tmpdir.name)
+        )
+
+    def close(self):
+        if self._tmpdir is not None:
+            self._tmpdir.cleanup()
+            self._tmpdir = None
+
+
+def is_disk_backed(array) -> bool:
+    """array 是否真的映射着磁盘文件 (对 memmap 做运算或 copy() 得到的 np.memmap 实例其实在内存中)。"""
+    return isinstance(array, np.memmap) and array.filename is not None
+
+
+def copy_blocks(target: np.ndarray, source: np.ndarray):
+    """按第一维分块把 source 复制 (并转换类型) 到 target。"""
+    if target.ndim == 0 or target.size == 0:
+        target[...] = source
+        return
+    row_elements = max(1, target.size // target.shape[0])
+    step = max(1, COPY_BLOCK_ELEMENTS // row_elements)
+    for start in range(0, target.shape[0], step):
+        target[start:start + step] = source[start:start + step]
+
+
+def _safe_prefix(name: str) -> str:
+    return ''.join(c if c.isalnum() or c in '_-.' else '_' for c in name) + '-'
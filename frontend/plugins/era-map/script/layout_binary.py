@@ -0,0 +1,239 @@
+"""
+二进制布局格式 (与 JSON 布局携带相同的信息，前端用 TypedArray 直接映射，无需解析数字文本)。
+
+文件结构 (所有整数均为小端序):
+    0   4 字节   魔数 b'ERAM'
+    4   uint16   格式版本 (BINARY_LAYOUT_VERSION)
+    6   uint16   保留，写 0
+    8   uint32   头部长度 N (字节)
+    12  N 字节   UTF-8 编码的 JSON 头部
+    ... 填充到 8 字节对齐的数据区起点，之后是各个数组段，每段都从 8 字节对齐的位置开始
+
+头部:
+    {
+      "meta": {"gridWidth": ..., "gridHeight": ...},
+      "objectTypes": ["TABLE", ...],               # 对象类型表，对象的 obj_type 列是其中的下标
+      "objects": {"count": n, "columns": {"obj_type": 段, "visual_pos": 段, "visual_angle": 段, "uid": 段,
+                                          "grid_pos": 段, "has_grid_pos": 段, "grid_size": 段, "has_grid_size": 段}},
+      "fields": {"light_level": 段, ...},
+      "particles": {"grime": {"type": ..., "seed": ..., "densityGrid": 段}, ...}
+    }
+    段 = {"dtype": "float32", "shape": [...], "offset": 相对数据区起点的字节偏移}
+
+网格与 JSON 一样按 grid[x][y] 排列 (C 顺序，x 为第一维)。dtype 只使用 JavaScript 有对应 TypedArray 的类型：
+float16 写成 float32，bool 写成 uint8，int64 在取值范围允许时写成 int32 (否则写成 float64)。
+
+整个文件可以再用 gzip 或 brotli 压缩 (compression='gzip' / 'brotli'，后者需要安装 brotli 包)。
+gzip 文件可以按魔数识别；brotli 没有魔数，读取时按扩展名 '.br' 识别，网页上通常由服务器以 Content-Encoding: br 传输。
+"""
+import gzip
+import json
+import struct
+from typing import Dict, Optional
+
+import numpy as np
+
+from core_types import ParticleLayer
+from object_store import ObjectTable
+
+BINARY_LAYOUT_MAGIC = b'ERAM'
+BINARY_LAYOUT_VERSION = 1
+BINARY_LAYOUT_ALIGNMENT = 8
+_PREAMBLE = struct.Struct('<4sHHI')
+
+# 写入网格时每次转换字节序 / 类型的格子数，memmap 上的场和粒子层按块读取，不会整张读入内存
+BINARY_BLOCK_CELLS = 1 << 20
+
+# 前端可以直接映射为 TypedArray 的类型
+PORTABLE_DTYPES = ('uint8', 'int8', 'uint16', 'int16', 'uint32', 'int32', 'float32', 'float64')
+
+COMPRESSIONS = (None, 'gzip', 'brotli')
+
+
+def _align(n: int) -> int:
+    return -(-n // BINARY_LAYOUT_ALIGNMENT) * BINARY_LAYOUT_ALIGNMENT
+
+
+def portable_dtype(array: np.ndarray) -> np.dtype:
+    """数组在二进制布局中使用的 (小端序) 类型。"""
+    dtype = array.dtype
+    if dtype == np.bool_:
+        dtype = np.dtype(np.uint8)
+    elif dtype.kind == 'f' and dtype.itemsize < 4:
+        dtype = np.dtype(np.float32)
+    elif dtype.kind in 'iu' and dtype.itemsize == 8:
+        info = np.iinfo(np.int32)
+        fits = array.size == 0 or (int(array.min()) >= info.min and int(array.max()) <= info.max)
+        dtype = np.dtype(np.int32 if fits else np.float64)
+    if dtype.name not in PORTABLE_DTYPES:
+        raise TypeError(f"类型为 {array.dtype} 的数组无法写入二进制布局")
+    return dtype.newbyteorder('<')
+
+
+class _Section:
+    """一个待写入的数组段。"""
+
+    def __init__(self, array: np.ndarray, offset: int):
+        self.array = array
+        self.dtype = portable_dtype(array)
+        self.offset = offset
+        self.nbytes = array.size * self.dtype.itemsize
+
+    def descriptor(self) -> dict:
+        return {"dtype": self.dtype.name, "shape": list(self.array.shape), "offset": self.offset}
+
+    def write(self, f):
+        array = self.array
+        if array.ndim < 2:
+            f.write(np.ascontiguousarray(array, dtype=self.dtype).tobytes())
+            return
+        step = max(1, BINARY_BLOCK_CELLS // max(1, array[0].size))
+        for x0 in range(0, array.shape[0], step):
+            f.write(np.ascontiguousarray(array[x0:x0 + step], dtype=self.dtype).tobytes())
+
+
+class _Layout:
+    """收集数组段并分配对齐的偏移。"""
+
+    def __init__(self):
+        self.sections = []
+        self.size = 0
+
+    def add(self, array: np.ndarray) -> dict:
+        section = _Section(array, _align(self.size))
+        self.sections.append(section)
+        self.size = section.offset + section.nbytes
+        return section.descriptor()
+
+
+def _open_output(filename: str, compression: Optional[str]):
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"未知的压缩方式 '{compression}'，可选: {COMPRESSIONS}")
+    if compression == 'gzip':
+        return gzip.open(filename, 'wb', compresslevel=6)
+    if compression == 'brotli':
+        return _BrotliWriter(filename)
+    return open(filename, 'wb')
+
+
+class _BrotliWriter:
+    """流式的 brotli 压缩文件 (brotli 包没有提供文件对象接口)。"""
+
+    def __init__(self, filename: str):
+        import brotli
+        self._file = open(filename, 'wb')
+        self._compressor = brotli.Compressor(quality=5)
+
+    def write(self, data: bytes):
+        self._file.write(self._compressor.process(data))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            if exc[0] is None:
+                self._file.write(self._compressor.finish())
+        finally:
+            self._file.close()
+
+
+def write_layout_binary(
+        filename: str,
+        meta_data: dict,
+        objects: ObjectTable,
+        fields: Dict[str, np.ndarray],
+        particles: Dict[str, ParticleLayer],
+        compression: Optional[str] = None
+):
+    """
+    把对象、数据场和粒子层写成二进制布局 (格式见模块说明)。
+    数组段的偏移只取决于数组的形状和类型，因此头部可以先写出，各个网格再按块流式写入。
+    """
+    layout = _Layout()
+    columns = {
+        "obj_type": layout.add(objects.type_codes),
+        "visual_pos": layout.add(objects.visual_pos),
+        "visual_angle": layout.add(objects.visual_angle),
+        "uid": layout.add(objects.uids),
+        "grid_pos": layout.add(objects.grid_pos),
+        "has_grid_pos": layout.add(objects.has_grid_pos),
+        "grid_size": layout.add(objects.grid_size),
+        "has_grid_size": layout.add(objects.has_grid_size),
+    }
+    header = {
+        "meta": meta_data,
+        "objectTypes": list(objects.type_names),
+        "objects": {"count": len(objects), "columns": columns},
+        "fields": {name: layout.add(array) for name, array in fields.items()},
+        "particles": {
+            name: {"type": layer.type, "seed": layer.seed, "densityGrid": layout.add(layer.density_grid)}
+            for name, layer in particles.items()
+        },
+    }
+
+    header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    data_start = _align(_PREAMBLE.size + len(header_bytes))
+    with _open_output(filename, compression) as f:
+        f.write(_PREAMBLE.pack(BINARY_LAYOUT_MAGIC, BINARY_LAYOUT_VERSION, 0, len(header_bytes)))
+        f.write(header_bytes)
+        position = _PREAMBLE.size + len(header_bytes)
+        for section in layout.sections:
+            target = data_start + section.offset
+            f.write(b'\0' * (target - position))
+            section.write(f)
+            position = target + section.nbytes
+
+
+def read_layout_binary(filename: str) -> dict:
+    """
+    读取二进制布局，返回与 JSON 布局结构相同的字典 (对象为字典列表，网格为 grid[x][y] 的 NumPy 数组)。
+    主要用于校验两种格式携带的信息是否一致；数组直接映射在读入的缓冲区上，不做复制。
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if data[:2] == b'\x1f\x8b':
+        data = gzip.decompress(data)
+    elif filename.endswith('.br'):
+        import brotli
+        data = brotli.decompress(data)
+
+    magic, version, _, header_length = _PREAMBLE.unpack_from(data)
+    if magic != BINARY_LAYOUT_MAGIC:
+        raise ValueError(f"'{filename}' 不是二进制布局文件")
+    if version > BINARY_LAYOUT_VERSION:
+        raise ValueError(f"'{filename}' 的格式版本 {version} 高于支持的版本 {BINARY_LAYOUT_VERSION}")
+    header = json.loads(data[_PREAMBLE.size:_PREAMBLE.size + header_length].decode('utf-8'))
+    data_start = _align(_PREAMBLE.size + header_length)
+
+    def section(descriptor: dict) -> np.ndarray:
+        dtype = np.dtype(descriptor["dtype"]).newbyteorder('<')
+        shape = tuple(descriptor["shape"])
+        count = int(np.prod(shape, dtype=np.int64))
+        return np.frombuffer(data, dtype=dtype, count=count, offset=data_start + descriptor["offset"]).reshape(shape)
+
+    columns = {name: section(descriptor).tolist() for name, descriptor in header["objects"]["columns"].items()}
+    type_names = header["objectTypes"]
+    objects = []
+    for i in range(header["objects"]["count"]):
+        obj_dict = {
+            "obj_type": type_names[columns["obj_type"][i]],
+            "visual_pos": columns["visual_pos"][i],
+            "visual_angle": columns["visual_angle"][i],
+            "uid": columns["uid"][i],
+        }
+        if columns["has_grid_pos"][i]:
+            obj_dict["grid_pos"] = columns["grid_pos"][i]
+        if columns["has_grid_size"][i]:
+            obj_dict["grid_size"] = columns["grid_size"][i]
+        objects.append(obj_dict)
+
+    return {
+        "meta": header["meta"],
+        "objects": objects,
+        "fields": {name: section(descriptor) for name, descriptor in header["fields"].items()},
+        "particles": {
+            name: {"type": layer["type"], "seed": layer["seed"], "densityGrid": section(layer["densityGrid"])}
+            for name, layer in header["particles"].items()
+        },
+    }
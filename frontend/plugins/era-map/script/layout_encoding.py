@@ -0,0 +1,202 @@
+"""
+布局 JSON 中场和粒子密度网格的紧凑编码。
+
+默认的 'dense' 编码就是 grid[x][y] 的嵌套数组。其余编码写成带 "encoding" 键的对象，都按 C 顺序
+(x 为第一维，下标 i = x * height + y) 把网格展平:
+    'coo'       {"encoding": "coo", "dtype": ..., "shape": [w, h], "index": [i, ...], "values": [v, ...]}
+                只记录非零格子，适合大部分为 0 的粒子密度网格
+    'rle'       {"encoding": "rle", "dtype": ..., "shape": [w, h], "values": [v, ...], "lengths": [n, ...]}
+                游程编码，适合大片相同取值的网格
+    'uint8' / 'uint16'
+                {"encoding": "quantized", "dtype": "uint8", "shape": [w, h], "scale": s, "offset": o, "data": base64}
+                有损量化：value ≈ offset + q * scale，q 为小端序无符号整数，按 base64 存放。
+                offset 和 scale 由网格的最小值和最大值确定，误差不超过 scale / 2
+'auto' 在允许的编码中选择文本最短的一种：整数网格只考虑无损编码，浮点网格还考虑 quantization 指定的量化。
+网格按块读取 (EXPORT_BLOCK_CELLS)，memmap 上的超大网格不会被整张读入内存。
+"""
+import base64
+import json
+from typing import Iterator, Optional, Tuple, Union
+
+import numpy as np
+
+# 每次读取的格子数，是 3 的倍数，使得量化数据的 base64 可以按块拼接
+ENCODE_BLOCK_CELLS = 3 << 18
+
+GRID_ENCODINGS = ('auto', 'dense', 'coo', 'rle', 'uint8', 'uint16')
+QUANTIZATIONS = (None, 'uint8', 'uint16')
+
+# 稀疏 / 游程编码的条目数超过格子数的这个比例时，不可能比 dense 更短，不再实际构建
+_COMPACT_ENTRY_LIMIT = 0.25
+
+# 只有这些类型的数组 dtype 名会写入编码 (与前端的 TypedArray 对应)
+_PORTABLE_DTYPES = {
+    'bool': 'uint8', 'float16': 'float32', 'int64': 'float64', 'uint64': 'float64',
+}
+
+
+def _portable_dtype_name(dtype: np.dtype) -> str:
+    return _PORTABLE_DTYPES.get(dtype.name, dtype.name)
+
+
+def _flat_blocks(grid: np.ndarray) -> Iterator[Tuple[int, np.ndarray]]:
+    """按 C 顺序逐块产生 (起始下标, 展平的块)。块的格子数是 3 的倍数 (最后一块除外)。"""
+    flat = grid.reshape(-1)
+    for start in range(0, flat.size, ENCODE_BLOCK_CELLS):
+        yield start, np.asarray(flat[start:start + ENCODE_BLOCK_CELLS])
+
+
+def _is_integral(grid: np.ndarray) -> bool:
+    return grid.dtype.kind in 'biu'
+
+
+def _json_number(value: np.ndarray):
+    """数组元素转换为 JSON 数字 (低于 float64 精度的浮点与 dense 编码一样保留 6 位小数)。"""
+    if value.dtype.kind == 'f' and value.dtype.itemsize < 8:
+        return np.round(value.astype(np.float64), 6).tolist()
+    return value.tolist()
+
+
+def _digit_count(values: np.ndarray) -> int:
+    """整数数组写成十进制文本的总字符数。"""
+    if values.size == 0:
+        return 0
+    magnitude = np.abs(values.astype(np.int64))
+    digits = np.floor(np.log10(np.maximum(magnitude, 1))).astype(np.int64) + 1
+    return int(digits.sum() + np.count_nonzero(values < 0))
+
+
+def dense_length(grid: np.ndarray) -> int:
+    """dense 编码的文本长度 (整数网格是准确值；浮点网格按每个非零格子 10 个字符估计)。"""
+    total = 0
+    for _, block in _flat_blocks(grid):
+        if _is_integral(block):
+            total += _digit_count(block)
+        else:
+            zeros = int(np.count_nonzero(block == 0))
+            total += 3 * zeros + 10 * (block.size - zeros)
+        total += 2 * block.size  # 分隔符 ", "
+    return total
+
+
+def encode_coo(grid: np.ndarray, limit: Optional[int] = None) -> Optional[dict]:
+    """稀疏编码。非零格子数超过 limit 时返回 None。"""
+    index, values = [], []
+    count = 0
+    for start, block in _flat_blocks(grid):
+        nonzero = np.flatnonzero(block)
+        count += nonzero.size
+        if limit is not None and count > limit:
+            return None
+        index.extend((nonzero + start).tolist())
+        values.extend(_json_number(block[nonzero]))
+    return {
+        "encoding": "coo", "dtype": _portable_dtype_name(grid.dtype), "shape": list(grid.shape),
+        "index": index, "values": values,
+    }
+
+
+def encode_rle(grid: np.ndarray, limit: Optional[int] = None) -> Optional[dict]:
+    """游程编码。游程数超过 limit 时返回 None。"""
+    values, lengths = [], []
+    for _, block in _flat_blocks(grid):
+        starts = np.flatnonzero(np.concatenate(([True], block[1:] != block[:-1])))
+        run_lengths = np.diff(np.append(starts, block.size)).tolist()
+        run_values = _json_number(block[starts])
+        # 与上一块的最后一个游程相接
+        if values and run_values and run_values[0] == values[-1]:
+            lengths[-1] += run_lengths.pop(0)
+            run_values.pop(0)
+        values.extend(run_values)
+        lengths.extend(run_lengths)
+        if limit is not None and len(values) > limit:
+            return None
+    return {
+        "encoding": "rle", "dtype": _portable_dtype_name(grid.dtype), "shape": list(grid.shape),
+        "values": values, "lengths": lengths,
+    }
+
+
+def encode_quantized(grid: np.ndarray, dtype: str) -> dict:
+    """量化编码 (dtype 为 'uint8' 或 'uint16')。"""
+    levels = np.iinfo(dtype).max
+    low, high = np.inf, -np.inf
+    for _, block in _flat_blocks(grid):
+        if block.size:
+            low = min(low, float(block.min()))
+            high = max(high, float(block.max()))
+    if not np.isfinite(low):
+        low = high = 0.0
+    scale = (high - low) / levels if high > low else 0.0
+
+    chunks = []
+    for _, block in _flat_blocks(grid):
+        q = np.zeros(block.shape, dtype=np.float64) if scale == 0 else (block.astype(np.float64) - low) / scale
+        chunks.append(base64.b64encode(np.rint(q).astype(np.dtype(dtype).newbyteorder('<')).tobytes()).decode('ascii'))
+    return {
+        "encoding": "quantized", "dtype": dtype, "shape": list(grid.shape),
+        "scale": scale, "offset": low, "data": "".join(chunks),
+    }
+
+
+def _quantized_length(grid: np.ndarray, dtype: str) -> int:
+    return 4 * -(-grid.size * np.dtype(dtype).itemsize // 3) + 120
+
+
+def encode_grid(
+        grid: np.ndarray,
+        encoding: str = 'auto',
+        quantization: Optional[str] = 'uint16'
+) -> Optional[dict]:
+    """
+    按 encoding 编码网格，返回 JSON 对象；返回 None 表示使用 dense 编码 (由调用方逐行流式写出)。
+    encoding 为 'auto' 时，quantization 是浮点网格允许使用的量化类型 (None 表示只用无损编码)。
+    """
+    if encoding not in GRID_ENCODINGS:
+        raise ValueError(f"未知的网格编码 '{encoding}'，可选: {GRID_ENCODINGS}")
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"未知的量化类型 '{quantization}'，可选: {QUANTIZATIONS}")
+    if encoding == 'dense':
+        return None
+    if encoding == 'coo':
+        return encode_coo(grid)
+    if encoding == 'rle':
+        return encode_rle(grid)
+    if encoding in ('uint8', 'uint16'):
+        return encode_quantized(grid, encoding)
+
+    best, best_length = None, dense_length(grid)
+    if quantization is not None and not _is_integral(grid):
+        length = _quantized_length(grid, quantization)
+        if length < best_length:
+            best, best_length = quantization, length
+    limit = int(grid.size * _COMPACT_ENTRY_LIMIT)
+    for encoder in (encode_coo, encode_rle):
+        encoded = encoder(grid, limit=limit)
+        if encoded is not None:
+            length = len(json.dumps(encoded))
+            if length < best_length:
+                best, best_length = encoded, length
+    if isinstance(best, str):
+        return encode_quantized(grid, best)
+    return best
+
+
+def decode_grid(value: Union[list, dict]) -> np.ndarray:
+    """把布局 JSON 中的一张网格 (任意编码) 还原为 grid[x][y] 的数组。"""
+    if isinstance(value, list):
+        return np.asarray(value)
+    shape = tuple(value["shape"])
+    size = int(np.prod(shape, dtype=np.int64))
+    encoding = value["encoding"]
+    if encoding == "coo":
+        flat = np.zeros(size, dtype=value["dtype"])
+        flat[np.asarray(value["index"], dtype=np.int64)] = value["values"]
+    elif encoding == "rle":
+        flat = np.repeat(np.asarray(value["values"], dtype=value["dtype"]), value["lengths"])
+    elif encoding == "quantized":
+        q = np.frombuffer(base64.b64decode(value["data"]), dtype=np.dtype(value["dtype"]).newbyteorder('<'))
+        flat = (value["offset"] + q * value["scale"]).astype(np.float32)
+    else:
+        raise ValueError(f"未知的网格编码 '{encoding}'")
+    return flat.reshape(shape)
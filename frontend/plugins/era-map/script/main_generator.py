@@ -1,44 +1,70 @@
-﻿import random
-from typing import List
+﻿import contextlib
+import logging
+from typing import Callable, Optional
 
 import numpy as np
 
-from core_types import GenerationContext, GameObject, convert_objects_to_particles
-from io_and_vis import export_context_to_json, Visualizer
+from core_types import GenerationContext, convert_objects_to_particles
+from instrumentation import Profiler, instrumented, quiet_output
+from io_and_vis import export_layout, Visualizer
+from layer_graph import DtypePolicy, LayerStore, FIELD
+from layer_storage import LayerStorage
+from noise_bank import NoiseBank
+from object_store import ObjectTable
+from occupancy import OccupancyIndex
 from modifiers import (
     apply_perlin_noise,
     apply_visual_jitter,
     bind_floating_objects_to_grid, reserve_grid_margin, apply_influence_to_layer, combine_layers, create_uniform_layer,
     apply_influence_from_points, adjust_layer_contrast, create_layer_from_coordinates, ensure_layer_exists, safe_normalize,
-    promote_layer_to_field, normalize_layer
+    promote_layer_to_field, normalize_layer, clip_layer
 )
 from placement_strategies import (
     place_floating_objects_from_layer, place_one_grid_object_from_layer, place_grid_objects_from_layer
 )
 from prototype import Settings
+from stage_cache import StageCache
+from stage_scheduler import StageGraph
+
+LOGGER = logging.getLogger('era_map.main_generator')
+
+# 小脏污最终被转换为的粒子层
+GRIME_PARTICLE_TYPE = "grime"
+GRIME_PARTICLE_SEED = 19260817  # 使用你喜欢的种子
 
 
 # 这是一个更高级的“管道”函数，它组合了多个修改器和放置器
+@instrumented('pipeline')
 def table_generation_pipeline(ctx: GenerationContext, settings: Settings) -> GenerationContext:
     """
     使用原子化操作和迭代排斥来生成桌子。
     """
-    print("\n--- [管道] 开始生成桌子 ---")
+    LOGGER.info("--- [管道] 开始生成桌子 ---")
+
+    # 中间层在最后一个消费者运行后即可释放 (只在管道作用域内生效，见 LayerStore.scope)
+    ctx.layers.declare_consumers('table_base_suitability', ['table_suitability_with_attraction'])
+    ctx.layers.declare_consumers('center_attraction', ['table_suitability_with_attraction'])
+    ctx.layers.declare_consumers('table_suitability_with_attraction', ['initial_table_suitability'])
+    ctx.layers.declare_consumers('table_noise', ['initial_table_suitability'])
+    ctx.layers.declare_consumers('initial_table_suitability', ['place_tables'])
+    ctx.layers.declare_consumers('current_table_suitability', ['place_tables'])
 
     # --- 阶段 1: 创建初始的全局适宜度地图 ---
+    # 这些步骤只通过各自读写的层相互依赖，交给阶段调度器：基础层、中心吸引力和噪声可以同时计算
+    stages = StageGraph('tables')
     # 1.1: 创建一个全1的基础层
-    ctx = create_uniform_layer(ctx, 'table_base_suitability', 1.0)
+    stages.call(create_uniform_layer, 'table_base_suitability', 1.0)
 
-    # 1.2: 创建中心吸引力层
-    center_point = (ctx.grid_width / 2, ctx.grid_height / 2)
-    ctx = apply_influence_from_points(
-        ctx, 'center_attraction', [center_point],
-        sigma=max(ctx.grid_width, ctx.grid_height)  # sigma 较大以产生缓和的梯度
+    # 1.2: 创建中心吸引力层 (世界的中心；分块生成时它可能在本块之外)
+    center_point = (ctx.world_width / 2 - ctx.origin[0], ctx.world_height / 2 - ctx.origin[1])
+    stages.call(
+        apply_influence_from_points, 'center_attraction', [center_point],
+        sigma=max(ctx.world_width, ctx.world_height)  # sigma 较大以产生缓和的梯度
     )
 
     # 1.3: 将基础层和吸引力层混合
-    ctx = combine_layers(
-        ctx, 'table_suitability_with_attraction',
+    stages.call(
+        combine_layers, 'table_suitability_with_attraction',
         'table_base_suitability', 'center_attraction',
         mode='weighted_sum',
         weight_a=1.0,  # 基础权重
@@ -47,21 +73,26 @@ def table_generation_pipeline(ctx: GenerationContext, settings: Settings) -> Gen
 
     # 1.4: 应用柏林噪声增加随机性
     # 我们把噪声作为一个独立的层，再混合进去，这样更清晰
-    ctx = apply_perlin_noise(
-        ctx,
+    stages.call(
+        apply_perlin_noise,
         'table_noise',
         settings.NOISE_SCALE,
         1.0)
-    ctx = combine_layers(
-        ctx, 'initial_table_suitability',
+    stages.call(
+        combine_layers, 'initial_table_suitability',
         'table_suitability_with_attraction', 'table_noise',
         mode='multiply'  # 使用乘法混合噪声
     )
+    ctx = stages.run(ctx, max_workers=settings.STAGE_WORKERS)
 
     # --- 阶段 2: 迭代放置桌子 ---
+    # 分块生成时相邻块的椅子已经在占用索引中，桌子要避开它们 (单张地图上桌子先于椅子放置，不受影响)
+    table_blocked_by = {"TABLE", "WALL_RESERVED"} | ({"CHAIR"} if ctx.is_tile else set())
     placed_tables = []
     for i in range(settings.NUM_TABLES):
-        print(f"放置桌子 {i + 1}/{settings.NUM_TABLES}...")
+        # 逐个对象的进度只在 DEBUG 级别输出，批量生成时连参数都不必准备
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug("放置桌子 %s/%s...", i + 1, settings.NUM_TABLES)
 
         # 1. 准备本次迭代的概率图
         current_suitability_map_name = 'current_table_suitability'
@@ -69,11 +100,14 @@ def table_generation_pipeline(ctx: GenerationContext, settings: Settings) -> Gen
         ctx.layers[current_suitability_map_name] = ctx.layers['initial_table_suitability'].copy()
 
         # 2. 如果已经有桌子了，就直接在当前概率图上应用排斥力
-        if placed_tables:
+        #    (分块生成时也包括相邻块已经放好的桌子；按类型选择的源和字典强度全程向量化)
+        repelling_tables = ctx.objects.select("TABLE") if ctx.is_tile else placed_tables
+        if repelling_tables:
             ctx = apply_influence_to_layer(
                 ctx,
                 target_layer_name=current_suitability_map_name,  # 直接修改当前适宜度图
-                source_objects=placed_tables,
+                source_objects=repelling_tables,
+                strength_multiplier={} if ctx.is_tile else (lambda obj: 1.0),
                 sigma=settings.TABLE_REPULSION_SIGMA,
                 mode='multiply_inverse'  # 使用新的、清晰的排斥模式
             )
@@ -82,29 +116,31 @@ def table_generation_pipeline(ctx: GenerationContext, settings: Settings) -> Gen
         ctx, new_table = place_one_grid_object_from_layer(
             ctx, 'current_table_suitability',
             "TABLE", settings.TABLE_SIZE,
-            blocked_by={"TABLE", "WALL_RESERVED"}
+            blocked_by=table_blocked_by
         )
 
         if new_table:
             placed_tables.append(new_table)
         else:
-            print("空间不足，无法放置更多桌子。")
+            LOGGER.info("空间不足，无法放置更多桌子。")
             break
 
-    print(f"--- 桌子生成完毕，共放置 {len(placed_tables)} 个 ---")
+    ctx.layers.mark_done('place_tables')
+    LOGGER.info("--- 桌子生成完毕，共放置 %s 个 ---", len(placed_tables))
     return ctx
 
 
+@instrumented('pipeline')
 def chair_placement_pipeline(ctx: GenerationContext, settings: Settings) -> GenerationContext:
     """
     数据驱动的椅子放置管道。
     """
-    print("\n--- [管道] 开始放置椅子 ---")
+    LOGGER.info("--- [管道] 开始放置椅子 ---")
 
     # 1. 找出所有桌子
-    tables = [obj for obj in ctx.objects if obj.obj_type == "TABLE"]
+    tables = ctx.objects.select("TABLE")
     if not tables:
-        print("没有桌子，跳过椅子放置。")
+        LOGGER.info("没有桌子，跳过椅子放置。")
         return ctx
 
     # 2. 计算所有可能的椅子放置点
@@ -135,10 +171,13 @@ def chair_placement_pipeline(ctx: GenerationContext, settings: Settings) -> Gene
         'chair_suitability_map',
         all_chair_spots
     )
+    ctx.layers.declare_consumers('chair_suitability_map', ['place_chairs'])
 
     # 4. 使用通用的放置函数，在适宜度地图上放置椅子
     # 我们需要计算总共要放多少椅子
-    num_chairs_total = sum(random.randint(*settings.CHAIRS_PER_TABLE_RANGE) for _ in tables)
+    rng = ctx.spawn_rng('chair_placement_pipeline')
+    low, high = settings.CHAIRS_PER_TABLE_RANGE
+    num_chairs_total = int(rng.integers(low, high + 1, size=len(tables)).sum())
 
     # 我们使用 place_grid_objects_from_layer (之前叫 place_by_weighted_sampling)
     ctx, _ = place_grid_objects_from_layer(
@@ -149,38 +188,48 @@ def chair_placement_pipeline(ctx: GenerationContext, settings: Settings) -> Gene
         grid_size=settings.CHAIR_SIZE,
         blocked_by={"TABLE", "CHAIR", "WALL_RESERVED"}
     )
+    ctx.layers.mark_done('place_chairs')
 
-    print("--- 椅子放置完毕 ---")
+    LOGGER.info("--- 椅子放置完毕 ---")
     return ctx
 
 
+@instrumented('pipeline')
 def grime_generation_pipeline(ctx: GenerationContext, settings: Settings) -> GenerationContext:
     """
     使用原子化操作管道生成脏污的完整流程。
     """
-    print("\n--- [管道] 开始生成脏污 ---")
+    LOGGER.info("--- [管道] 开始生成脏污 ---")
+
+    furniture_objects = ctx.objects.select(["TABLE", "CHAIR"])
 
-    furniture_objects = [obj for obj in ctx.objects if obj.obj_type in ["TABLE", "CHAIR"]]
+    ctx.layers.declare_consumers('furniture_occlusion', ['grime_base_probability'])
+    ctx.layers.declare_consumers('grime_splatter_noise', ['grime_base_probability'])
+    ctx.layers.declare_consumers('grime_base_probability', ['grime_small_final_prob'])
+    ctx.layers.declare_consumers('grime_core_influence', ['grime_small_final_prob'])
+    ctx.layers.declare_consumers('grime_small_final_prob', ['place_grime_small'])
 
+    # 遮蔽层和噪声层互不依赖，由阶段调度器同时计算
+    stages = StageGraph('grime')
     # 步骤 1: 创建物体遮蔽层。桌椅等家具为其周围赋予“脏污潜力”。
-    ctx = apply_influence_to_layer(
-        ctx,
+    stages.call(
+        apply_influence_to_layer,
         target_layer_name='furniture_occlusion',
         source_objects=furniture_objects,
         sigma=2.0  # 可移至 Settings
     )
 
     # 步骤 2: 创建一个独立的柏林噪声层
-    ctx = apply_perlin_noise(
-        ctx,
+    stages.call(
+        apply_perlin_noise,
         target_layer_name='grime_splatter_noise',
         scale=settings.GRIME_SPLATTER_NOISE_SCALE,
         strength=1.0  # strength 为1.0表示纯噪声
     )
 
     # 步骤 3: 将遮蔽层和噪声层混合，得到基础的脏污潜力图
-    ctx = combine_layers(
-        ctx,
+    stages.call(
+        combine_layers,
         target_layer_name='grime_base_probability',
         layer_a_name='furniture_occlusion',
         layer_b_name='grime_splatter_noise',
@@ -188,6 +237,7 @@ def grime_generation_pipeline(ctx: GenerationContext, settings: Settings) -> Gen
         weight_a=0.6,  # 遮蔽影响占 60%
         weight_b=0.4  # 随机噪声占 40%
     )
+    ctx = stages.run(ctx, max_workers=settings.STAGE_WORKERS)
 
     # 步骤 4: 使用基础概率图，放置大脏污核心
     ctx, large_grime_patches = place_floating_objects_from_layer(
@@ -230,147 +280,197 @@ def grime_generation_pipeline(ctx: GenerationContext, settings: Settings) -> Gen
         obj_type='GRIME_SMALL',
         blocked_by=set()
     )
+    ctx.layers.mark_done('place_grime_small')
 
-    print("--- [管道] 脏污生成完毕 ---")
+    LOGGER.info("--- [管道] 脏污生成完毕 ---")
     return ctx
 
 
+@instrumented('pipeline')
 def lighting_pipeline(ctx: GenerationContext, settings: Settings) -> GenerationContext:
     """
     一个集成的光照生成管道，使用迭代式放置，逐个安放窗户和火把，
     以实现更智能、更均匀的布局。
     """
-    print("\n--- [集成管道] 开始生成光照系统 (迭代式) ---")
+    LOGGER.info("--- [集成管道] 开始生成光照系统 (迭代式) ---")
     w, h = ctx.grid_width, ctx.grid_height
+    ox, oy = ctx.origin
+    world_w, world_h = ctx.world_width, ctx.world_height
 
     # --- 阶段 1: 确保全局光照图存在 ---
-    ctx = ensure_layer_exists(ctx, 'global_light_map', fill_value=0.0)
-
-    # =================================================
-    # --- 阶段 2: 迭代式放置窗户 ---
-    # =================================================
-    print("--- [光照] 阶段 2: 迭代式放置窗户 ---")
+    # 光照图最后会被提升为场，不能随管道作用域释放
+    ctx.layers.set_lifecycle('global_light_map', FIELD)
+    # 光照图、窗户的两张基础图和火把的墙壁吸引力图互不依赖，由阶段调度器同时准备
+    stages = StageGraph('lighting')
+    stages.call(ensure_layer_exists, 'global_light_map', fill_value=0.0)
+    if ctx.is_tile:
+        # 分块生成时，相邻块已经放好的窗户和火把先照亮本块
+        stages.call(
+            apply_influence_to_layer, 'global_light_map', ctx.objects.select("WINDOW"),
+            sigma=settings.WINDOW_LIGHT_SIGMA, strength_multiplier={"WINDOW": 0.4}, mode='add', backend='window'
+        )
+        stages.call(
+            apply_influence_to_layer, 'global_light_map', ctx.objects.select("TORCH"),
+            sigma=settings.TORCH_LIGHT_SIGMA, strength_multiplier={"TORCH": 1.2}, mode='add', backend='window'
+        )
+    # 分块生成时窗户和火把还要避开相邻块已经放好的同类 (它们可能落在本块的光环里)
+    window_blocked_by = {"TABLE", "CHAIR"} | ({"WINDOW"} if ctx.is_tile else set())
+    torch_blocked_by = {"TABLE", "CHAIR", "WINDOW"} | ({"TORCH"} if ctx.is_tile else set())
+    ctx.layers.declare_consumers('window_edge_suitability', ['window_base_prob'])
+    ctx.layers.declare_consumers('symmetry_attraction', ['window_base_prob'])
+    ctx.layers.declare_consumers('window_base_prob', ['place_windows'])
+    ctx.layers.declare_consumers('wall_attraction_map', ['place_torches'])
+    ctx.layers.declare_consumers('temp_torch_prob', ['place_torches'])
 
     # 2.1: 预先计算不变量：边缘位置图和对称吸引力图
+    # 窗户开在世界的外墙上，这里只取落在本网格内的那部分边缘 (非分块生成时就是网格的一圈边缘)
     edge_coords = []
     margin = 0
-    for x in range(margin, w - margin):
-        edge_coords.append((x, margin));
-        edge_coords.append((x, h - 1 - margin))
-    for y in range(margin + 1, h - 1 - margin):
-        edge_coords.append((margin, y));
-        edge_coords.append((w - 1 - margin, y))
-    ctx = create_layer_from_coordinates(ctx, 'window_edge_suitability', edge_coords)
-
-    symmetry_points = [(margin, h / 2), (w - 1 - margin, h / 2), (w / 2, margin), (w / 2, h - 1 - margin)]
-    ctx = apply_influence_from_points(ctx, 'symmetry_attraction', symmetry_points, sigma=w / 4)
-    ctx = combine_layers(ctx, 'window_base_prob', 'window_edge_suitability', 'symmetry_attraction', mode='multiply')
+    xs = range(max(margin, ox), min(world_w - margin, ox + w))
+    for edge_y in (margin, world_h - 1 - margin):
+        if oy <= edge_y < oy + h:
+            edge_coords.extend((x - ox, edge_y - oy) for x in xs)
+    ys = range(max(margin + 1, oy), min(world_h - 1 - margin, oy + h))
+    for edge_x in (margin, world_w - 1 - margin):
+        if ox <= edge_x < ox + w:
+            edge_coords.extend((edge_x - ox, y - oy) for y in ys)
+    stages.call(create_layer_from_coordinates, 'window_edge_suitability', edge_coords)
+
+    symmetry_points = [
+        (margin, world_h / 2), (world_w - 1 - margin, world_h / 2),
+        (world_w / 2, margin), (world_w / 2, world_h - 1 - margin)
+    ]
+    symmetry_points = [(x - ox, y - oy) for x, y in symmetry_points]
+    stages.call(apply_influence_from_points, 'symmetry_attraction', symmetry_points, sigma=world_w / 4)
+    stages.call(combine_layers, 'window_base_prob', 'window_edge_suitability', 'symmetry_attraction', mode='multiply')
+
+    # 3.1: 预先计算火把的基础吸引力图 (墙壁)
+    # 墙壁只来自边缘预留，放置窗户不会改变它，因此可以和窗户的基础图一起提前准备
+    # 分块生成时不贴着世界边界的块里没有墙，吸引力图全为 0，也就不会放置火把
+    wall_cells = np.argwhere(ctx.occupancy.blocked_mask({"WALL_RESERVED"}))
+    stages.call(ensure_layer_exists, 'wall_attraction_map', fill_value=0.0)
+    stages.call(
+        apply_influence_from_points, 'wall_attraction_map', wall_cells,
+        sigma=settings.TORCH_WALL_ATTRACTION_SIGMA, strength=0.3
+    )
+    ctx = stages.run(ctx, max_workers=settings.STAGE_WORKERS)
+
+    # =================================================
+    # --- 阶段 2: 迭代式放置窗户 ---
+    # =================================================
+    LOGGER.info("--- [光照] 阶段 2: 迭代式放置窗户 ---")
 
     placed_windows = []
+    # 每轮的概率图都写在同一块从缓冲池借来的临时数组里，循环中不再分配整张网格
+    window_prob_buffer = ctx.buffers.acquire((w, h), ctx.dtype_policy.compute)
     for i in range(settings.NUM_WINDOWS):
-        # 1. 从上下文中获取当前状态数据
-        current_light_map = ctx.layers['global_light_map']
-        window_base_prob = ctx.layers['window_base_prob']
+        # 1. 从上下文中获取当前状态数据 (只读)
+        current_light_map = ctx.layers.read('global_light_map')
+        window_base_prob = ctx.layers.read('window_base_prob')
 
-        # 2. 在局部变量中执行纯计算，不修改上下文
-        #    这是“显式传递”思想的核心
-        normalized_light = safe_normalize(current_light_map)
-        darkness_map = 1.0 - normalized_light
-        final_window_placement_prob = window_base_prob * darkness_map
+        # 2. 在局部缓冲区中执行纯计算，不修改上下文
+        #    这是“显式传递”思想的核心: base * (1 - normalize(light))
+        final_window_placement_prob = safe_normalize(current_light_map, out=window_prob_buffer)
+        np.subtract(1.0, final_window_placement_prob, out=final_window_placement_prob)
+        final_window_placement_prob *= window_base_prob
 
         # 2.4: 放置 **一个** 窗户
         ctx, new_window = place_one_grid_object_from_layer(
             ctx, final_window_placement_prob, "WINDOW", settings.WINDOW_SIZE,
-            blocked_by={"TABLE", "CHAIR"}
+            blocked_by=window_blocked_by
         )
 
         # 2.5: 如果成功放置，立刻更新全局光照图；否则，跳出循环
         if new_window:
-            print(f"  - 放置窗户 {i + 1}/{settings.NUM_WINDOWS}...")
+            if LOGGER.isEnabledFor(logging.DEBUG):
+                LOGGER.debug("  - 放置窗户 %s/%s...", i + 1, settings.NUM_WINDOWS)
             placed_windows.append(new_window)
             ctx = apply_influence_to_layer(
                 ctx, 'global_light_map', [new_window],  # 注意：只传入新窗户
-                sigma=8.0, strength_multiplier=lambda o: 0.4, mode='add'
+                sigma=settings.WINDOW_LIGHT_SIGMA, strength_multiplier=lambda o: 0.4, mode='add',
+                backend='window'  # 只更新新窗户周围的窗口，而不是整张地图
             )
         else:
-            print("  - 空间不足，无法放置更多窗户。")
+            LOGGER.info("  - 空间不足，无法放置更多窗户。")
             break
-    print(f"--- 共放置了 {len(placed_windows)} 个窗户 ---")
+    ctx.buffers.release(window_prob_buffer)
+    ctx.layers.mark_done('place_windows')
+    LOGGER.info("--- 共放置了 %s 个窗户 ---", len(placed_windows))
 
     # =================================================
     # --- 阶段 3: 迭代式放置火把 ---
     # =================================================
-    print("--- [光照] 阶段 3: 迭代式放置火把 ---")
-
-    # 3.1: 预先计算火把的基础吸引力图 (墙壁)
-    wall_placeholders = []
-    for x in range(w):
-        for y in range(h):
-            if any(o.obj_type == "WALL_RESERVED" for o in ctx.occupancy_grid[x, y]):
-                wall_placeholders.append(GameObject("WALL_RESERVED", np.array([x, y], dtype=float)))
-    ctx = apply_influence_to_layer(ctx, 'wall_attraction_map', wall_placeholders, sigma=6.0, strength_multiplier=lambda o: 0.3)
+    LOGGER.info("--- [光照] 阶段 3: 迭代式放置火把 ---")
 
     placed_torches = []
+    # 这块缓冲区最后作为 'temp_torch_prob' 层留在上下文中，因此不归还给缓冲池
+    torch_prob_buffer = ctx.buffers.acquire((w, h), ctx.dtype_policy.compute)
     for i in range(settings.NUM_TORCHES):
-        # 1. 获取状态
-        current_light_map = ctx.layers['global_light_map']
-        wall_attraction_map = ctx.layers['wall_attraction_map']
-
-        # 2. 纯计算
-        normalized_light = safe_normalize(current_light_map)
-        darkness_map_after_windows = 1.0 - normalized_light
-        final_torch_placement_prob_raw = wall_attraction_map * darkness_map_after_windows
-        # adjust_layer_contrast 也可以被重构为一个纯函数
-        # 但为了最小化改动，我们暂时可以继续使用它，因为它至少会覆写目标层，而不是创建新层
-        ctx.layers['temp_torch_prob'] = final_torch_placement_prob_raw
-        ctx = adjust_layer_contrast(ctx, 'temp_torch_prob', exponent=2.0)
-        final_torch_placement_prob = ctx.layers['temp_torch_prob']
+        # 1. 获取状态 (只读)
+        current_light_map = ctx.layers.read('global_light_map')
+        wall_attraction_map = ctx.layers.read('wall_attraction_map')
+
+        # 2. 纯计算，全部在缓冲区中原地完成: wall * (1 - normalize(light))
+        final_torch_placement_prob = safe_normalize(current_light_map, out=torch_prob_buffer)
+        np.subtract(1.0, final_torch_placement_prob, out=final_torch_placement_prob)
+        final_torch_placement_prob *= wall_attraction_map
+        # adjust_layer_contrast 传入 out 后原地覆写目标层，不会创建新层
+        ctx.layers['temp_torch_prob'] = final_torch_placement_prob
+        ctx = adjust_layer_contrast(ctx, 'temp_torch_prob', exponent=2.0, out=final_torch_placement_prob)
 
         # 3. 传递临时数据
         ctx, new_torch = place_one_grid_object_from_layer(
             ctx, final_torch_placement_prob, "TORCH", settings.TORCH_SIZE,
-            blocked_by={"TABLE", "CHAIR", "WINDOW"}
+            blocked_by=torch_blocked_by
         )
 
         # 3.5: 如果成功放置，立刻更新全局光照图；否则，跳出循环
         if new_torch:
-            print(f"  - 放置火把 {i + 1}/{settings.NUM_TORCHES}...")
+            if LOGGER.isEnabledFor(logging.DEBUG):
+                LOGGER.debug("  - 放置火把 %s/%s...", i + 1, settings.NUM_TORCHES)
             placed_torches.append(new_torch)
             ctx = apply_influence_to_layer(
                 ctx, 'global_light_map', [new_torch],  # 注意：只传入新火把
-                sigma=4.0, strength_multiplier=lambda o: 1.2, mode='add'
+                sigma=settings.TORCH_LIGHT_SIGMA, strength_multiplier=lambda o: 1.2, mode='add',
+                backend='window'
             )
         else:
-            print("  - 空间不足，无法放置更多火把。")
+            LOGGER.info("  - 空间不足，无法放置更多火把。")
             break
 
-    print(f"--- 共放置了 {len(placed_torches)} 个火把 ---")
-    print("--- [集成管道] 光照系统生成完毕 ---")
+    ctx.layers.mark_done('place_torches')
+    LOGGER.info("--- 共放置了 %s 个火把 ---", len(placed_torches))
+    LOGGER.info("--- [集成管道] 光照系统生成完毕 ---")
     return ctx
 
 
+@instrumented('pipeline')
 def character_placement_pipeline(ctx: GenerationContext, settings: Settings) -> GenerationContext:
     """
     负责生成所有角色的放置管道。
     """
-    print("\n--- [管道] 开始放置角色 ---")
+    LOGGER.info("--- [管道] 开始放置角色 ---")
 
-    social_sources = [o for o in ctx.objects if o.obj_type in ['TABLE', 'CHAIR']]
-    grime_sources = [o for o in ctx.objects if 'GRIME' in o.obj_type]
+    social_sources = ctx.objects.select(['TABLE', 'CHAIR'])
+    grime_sources = ctx.objects.select(lambda obj_type: 'GRIME' in obj_type)
 
     # --- 准备基础偏好图 (只需要创建一次) ---
+    # 两张基础图互不依赖；各种族的偏好图只依赖这两张图，不依赖已放置的角色，
+    # 因此全部交给阶段调度器提前准备，之后的放置仍然逐个种族串行进行
+    stages = StageGraph('characters')
     # 社交吸引图
-    ctx = apply_influence_to_layer(
-        ctx, 'social_comfort_map',
+    stages.call(
+        apply_influence_to_layer, 'social_comfort_map',
         source_objects=social_sources,
         sigma=settings.SOCIAL_ATTRACTION_SIGMA
     )
     # 脏污影响图
-    ctx = apply_influence_to_layer(
-        ctx, 'grime_influence_map',
+    stages.call(
+        apply_influence_to_layer, 'grime_influence_map',
         source_objects=grime_sources,
         sigma=2.0,
-        strength_multiplier=lambda o: settings.ELF_LARGE_GRIME_MULTIPLIER if 'LARGE' in o.obj_type else 1.0
+        # 按类型给出强度，整批向量化计算，不必为每个脏污创建对象视图
+        strength_multiplier={t: settings.ELF_LARGE_GRIME_MULTIPLIER for t in ctx.objects.type_names if 'LARGE' in t}
     )
 
     # --- 逐个种族进行放置 ---
@@ -381,13 +481,18 @@ def character_placement_pipeline(ctx: GenerationContext, settings: Settings) ->
         {"type": "MUSHROOM_PERSON", "count": settings.NUM_MUSHROOM_PEOPLE, "social": 1.0, "grime": settings.MUSHROOM_GRIME_ATTRACTION}
     ]
 
-    for config in character_configs:
-        char_type = config["type"]
-        preference_map_name = f"{char_type.lower()}_preference_map"
+    character_types = {config["type"] for config in character_configs}
+
+    preference_map_names = [f"{config['type'].lower()}_preference_map" for config in character_configs]
+    ctx.layers.declare_consumers('social_comfort_map', preference_map_names)
+    ctx.layers.declare_consumers('grime_influence_map', preference_map_names)
+    for config, preference_map_name in zip(character_configs, preference_map_names):
+        ctx.layers.declare_consumers(preference_map_name, [f"place_{config['type']}"])
 
+    for config, preference_map_name in zip(character_configs, preference_map_names):
         # 1. 为该种族混合专属的偏好图
-        ctx = combine_layers(
-            ctx,
+        stages.call(
+            combine_layers,
             target_layer_name=preference_map_name,
             layer_a_name='social_comfort_map',
             layer_b_name='grime_influence_map',
@@ -396,10 +501,14 @@ def character_placement_pipeline(ctx: GenerationContext, settings: Settings) ->
             weight_b=config["grime"]
         )
         # 裁剪掉负值，因为概率不能为负
-        ctx.layers[preference_map_name] = np.clip(ctx.layers[preference_map_name], 0, None)
+        stages.call(clip_layer, preference_map_name, lower=0.0)
 
         # 2. (可选) 锐化偏好，让他们的选择更“坚定”
-        ctx = adjust_layer_contrast(ctx, preference_map_name, exponent=1.5)
+        stages.call(adjust_layer_contrast, preference_map_name, exponent=1.5)
+    ctx = stages.run(ctx, max_workers=settings.STAGE_WORKERS)
+
+    for config, preference_map_name in zip(character_configs, preference_map_names):
+        char_type = config["type"]
 
         # 3. 使用通用的浮动对象放置函数
         ctx, _ = place_floating_objects_from_layer(
@@ -407,61 +516,115 @@ def character_placement_pipeline(ctx: GenerationContext, settings: Settings) ->
             layer_source=preference_map_name,
             num_to_place=config["count"],
             obj_type=char_type,
-            blocked_by={"TABLE", "WALL_RESERVED"}
+            blocked_by={"TABLE", "WALL_RESERVED"},
+            # 角色之间 (包括不同种族) 保持最小间距，避免叠在同一个位置
+            min_spacing=settings.CHARACTER_MIN_SPACING,
+            spacing_against=character_types
         )
+        ctx.layers.mark_done(f"place_{char_type}")
 
     return ctx
 
 
-def create_list_filled_grid(width: int, height: int) -> np.ndarray:
-    grid = np.empty((width, height), dtype=object)
-    for i in range(width):
-        for j in range(height):
-            empty_list: List[GameObject] = []
-            grid[i, j] = empty_list
-    return grid
+# run_pipelines 依次运行的管道：(作用域名, 管道函数, 运行前输出的标题)
+PIPELINES = (
+    ('tables', table_generation_pipeline, None),  # 运行桌子生成管道
+    ('chairs', chair_placement_pipeline, None),
+    # === 阶段三: 混沌感 ===
+    # context = apply_visual_jitter(context, settings.POSITION_JITTER, settings.ANGLE_JITTER_DEGREES)
+    ('lighting', lighting_pipeline, None),  # 添加窗户和火把
+    ('grime', grime_generation_pipeline, "--- 构建脏污概率图 ---"),  # === 阶段四: 脏污 ===
+    ('characters', character_placement_pipeline, "--- 构建角色偏好图 ---"),  # === 阶段五: 角色 ===
+)
 
 
-# 主执行流程
-if __name__ == "__main__":
-    # 假设 Settings 类仍然存在，用于集中管理参数
-    from prototype import Settings  # 沿用你之前的Settings类
+@instrumented('flow')
+def run_pipelines(
+        context: GenerationContext,
+        settings: Settings,
+        cache: Optional[StageCache] = None
+) -> GenerationContext:
+    """
+    按顺序运行桌子、椅子、光照、脏污和角色管道。
+    每个管道都在自己的作用域内运行，结束时释放它创建的临时层。
+    传入 cache 时，输入没有变化的管道直接从磁盘快照恢复 (见 stage_cache.StageCache)。
+    """
+    state = cache.initial_state(context) if cache is not None else None
+    for scope_name, pipeline, banner in PIPELINES:
+        if banner:
+            LOGGER.info(banner)
+        if cache is not None:
+            context, state = cache.run(scope_name, pipeline, context, settings, state)
+        else:
+            with context.layers.scope(scope_name):
+                context = pipeline(context, settings)
 
-    settings = Settings()
+    LOGGER.info("--- 所有阶段执行完毕 ---")
+    LOGGER.info("最终生成对象总数: %s", len(context.objects))
+    return context
 
-    # 1. 初始化生成上下文
-    init_grid = create_list_filled_grid(settings.GRID_WIDTH, settings.GRID_HEIGHT)
-    context = GenerationContext(
+
+def create_generation_context(settings: Settings, seed: Optional[int] = None) -> GenerationContext:
+    """根据 Settings 创建一个空的生成上下文。seed 不为 None 时代替 settings.SEED。"""
+    ctx = GenerationContext(
         grid_width=settings.GRID_WIDTH,
         grid_height=settings.GRID_HEIGHT,
-        layers={},
+        layers=LayerStore(
+            lazy=settings.LAZY_LAYERS,
+            memory_budget_bytes=(
+                None if settings.LAYER_MEMORY_BUDGET_MB is None
+                else settings.LAYER_MEMORY_BUDGET_MB * 1024 * 1024
+            ),
+            spill_dir=settings.LAYER_SPILL_DIR
+        ),
         fields={},
         particles={},
-        objects=[],
-        occupancy_grid=init_grid,
+        objects=ObjectTable(),
+        occupancy=OccupancyIndex(settings.GRID_WIDTH, settings.GRID_HEIGHT),
+        seed_sequence=np.random.SeedSequence(settings.SEED if seed is None else seed),
+        dtype_policy=DtypePolicy(
+            compute=settings.LAYER_DTYPE,
+            half_layers=set(settings.FLOAT16_LAYERS),
+            field_dtype=settings.FIELD_DTYPE
+        ),
+        storage=LayerStorage(
+            default=settings.LAYER_STORAGE,
+            memmap_names=settings.MEMMAP_LAYERS,
+            root_dir=settings.LAYER_STORAGE_DIR
+        ),
     )
-    context = reserve_grid_margin(context, margin_width=1)
-
-    # 2. 运行桌子生成管道
-    context = table_generation_pipeline(context, settings)
-    context = chair_placement_pipeline(context, settings)
-
-    # === 阶段三: 混沌感 ===
-    # context = apply_visual_jitter(context, settings.POSITION_JITTER, settings.ANGLE_JITTER_DEGREES)
-
-    # 添加窗户和火把
-    context = lighting_pipeline(context, settings)
+    if settings.NOISE_BANK_DIR:
+        ctx.noise_bank = NoiseBank(
+            settings.NOISE_BANK_DIR,
+            size_budget_bytes=settings.NOISE_BANK_BUDGET_MB * 1024 * 1024
+        )
+    return ctx
 
-    # === 阶段四: 脏污 ===
-    print("\n--- 构建脏污概率图 ---")
-    context = grime_generation_pipeline(context, settings)
 
-    # === 阶段五: 角色 ===
-    print("\n--- 构建角色偏好图 ---")
-    context = character_placement_pipeline(context, settings)
+def run_generation(
+        settings: Settings,
+        seed: Optional[int] = None,
+        prepare: Optional[Callable[[GenerationContext], None]] = None,
+        profiler: Optional[Profiler] = None
+) -> GenerationContext:
+    """
+    完整的单张布局生成流程 (不导出、不绘图)：创建上下文、预留边缘、运行所有管道、
+    绑定网格、把光照图提升为场、把小脏污转换为粒子层。
+    seed 不为 None 时代替 settings.SEED；prepare 在运行管道之前对上下文做准备 (例如 Visualizer.request_retention)；
+    传入 profiler 时记录每个阶段的耗时和计数器 (见 instrumentation.Profiler)。
+    """
+    # 1. 初始化生成上下文
+    context = create_generation_context(settings, seed)
+    context.profiler = profiler
+    LOGGER.info("--- 随机种子: %s ---", context.seed_sequence.entropy)
+    if prepare is not None:
+        prepare(context)
+    context = reserve_grid_margin(context, margin_width=1)
 
-    print("\n--- 所有阶段执行完毕 ---")
-    print(f"最终生成对象总数: {len(context.objects)}")
+    # 2. 依次运行所有生成管道 (设置了 STAGE_CACHE_DIR 时，输入没有变化的管道从磁盘缓存恢复)
+    # 没有固定种子时每次运行的结果都不同，缓存不可能命中，不使用缓存
+    fixed_seed = seed is not None or settings.SEED is not None
+    context = run_pipelines(context, settings, cache=StageCache.from_settings(settings) if fixed_seed else None)
 
     # === 阶段六: 后处理 - 网格绑定 ===
     context = bind_floating_objects_to_grid(context)
@@ -469,22 +632,48 @@ if __name__ == "__main__":
     # === 阶段七: 数据结构转换 ===
     # 7.1 将光照图从临时层提升为永久场
     if 'global_light_map' in context.layers:
-        print("--- 归一化最终的光照图 ---")
+        LOGGER.info("--- 归一化最终的光照图 ---")
         context = normalize_layer(context, 'global_light_map')
         context = promote_layer_to_field(context, 'global_light_map', 'light_level')
 
     # 7.2 将小脏污 GameObject 转换为粒子层
-
     context = convert_objects_to_particles(
         ctx=context,
         object_type_to_convert="GRIME_SMALL",
-        target_particle_type="grime",
-        seed=19260817,  # 使用你喜欢的种子
+        target_particle_type=GRIME_PARTICLE_TYPE,
+        seed=GRIME_PARTICLE_SEED,
     )
+    return context
 
-    # 导出到 JSON
-    export_context_to_json(context, settings, "layout.json")
 
-    # 可视化结果
+# 主执行流程
+if __name__ == "__main__":
+    # 假设 Settings 类仍然存在，用于集中管理参数
+    from prototype import Settings  # 沿用你之前的Settings类
+
+    settings = Settings()
     visualizer = Visualizer(settings)
+    profiler = Profiler(trace_memory=settings.PROFILE_TRACE_MEMORY) if settings.PROFILE else None
+    output = contextlib.nullcontext()
+    if settings.OUTPUT_LOG_LEVEL is not None:
+        logging.basicConfig(level=settings.OUTPUT_LOG_LEVEL, format='%(levelname)s %(message)s')
+        output = quiet_output(settings.OUTPUT_LOG_LEVEL)
+
+    with profiler if profiler is not None else contextlib.nullcontext(), output:
+        # 1. 运行完整的生成流程
+        # 调试模式：保留所有中间层，供最后的可视化使用
+        context = run_generation(
+            settings,
+            prepare=visualizer.request_retention if settings.DEBUG_RETAIN_LAYERS else None,
+            profiler=profiler
+        )
+
+        # 2. 导出布局 (JSON 和 / 或二进制，见 Settings.LAYOUT_FORMAT)
+        export_layout(context, settings, "layout")
+
+    if profiler is not None:
+        profiler.write_json(settings.PROFILE_REPORT)
+        print(profiler.summary_table())
+
+    # 3. 可视化结果
     visualizer.plot_layout_and_layers(context)
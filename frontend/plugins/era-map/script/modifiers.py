@@ -1,30 +1,64 @@
-﻿import random
-import time
-from typing import List, Callable, Tuple, Optional, Union
+﻿import logging
+from typing import List, Callable, Tuple, Optional, Union, Dict, Iterable
 
 import numpy as np
-from perlin_noise import PerlinNoise
 
 from core_types import GenerationContext, GameObject
+from object_store import ObjectSelection
+from layer_graph import LayerExpr, FullLeaf, normalize_tolerance, upcast_half
+from layer_storage import copy_blocks
+from influence import compute_influence_map, merge_influence, stamp_influence_windows, merge_influence_window
+from noise import NOISE_BACKENDS
+from stage_scheduler import declares, OBJECTS, FIELDS
+from instrumentation import instrumented
+
+LOGGER = logging.getLogger('era_map.modifiers')
 
 
 # --- 一些辅助函数 ---
-def safe_normalize(data_map):
-    """安全地将一个2D numpy数组归一化到[0, 1]范围，处理分母为零的情况。"""
+def safe_normalize(data_map, out: Optional[np.ndarray] = None):
+    """
+    安全地将一个2D numpy数组归一化到[0, 1]范围，处理分母为零的情况。
+    传入 out 时结果写入 out (可以就是 data_map 本身)，不分配新数组。
+    float16 的层先提升到 float32 再计算；float32 的层直接以 float32 计算。
+    """
+    if isinstance(data_map, LayerExpr):
+        return data_map.normalized()
+
+    data_map = upcast_half(np.asarray(data_map))
     min_val = np.min(data_map)
     max_val = np.max(data_map)
     data_range = max_val - min_val
 
-    # 使用一个小的epsilon来安全地比较浮点数
-    if data_range > 1e-9:
-        return (data_map - min_val) / data_range
+    # 使用随类型和量级调整的epsilon来安全地比较浮点数
+    if data_range > normalize_tolerance(min_val, max_val, data_map.dtype):
+        if out is None:
+            return (data_map - min_val) / data_range
+        np.subtract(data_map, min_val, out=out)
+        out /= data_range
+        return out
     else:
         # 如果数组是平坦的，返回一个全零数组
-        return np.zeros_like(data_map)
+        if out is None:
+            return np.zeros_like(data_map)
+        out.fill(0)
+        return out
+
+
+def _layer_operand(ctx: GenerationContext, layer_name: str):
+    """
+    取出修改器的输入层。惰性模式下返回表达式节点 (不触发求值)，否则返回数组。
+    两者支持相同的算术运算，修改器的计算代码因此不需要区分模式。
+    """
+    if ctx.layers.lazy:
+        return ctx.layers.node(layer_name)
+    return ctx.layers[layer_name]
 
 
 # --- 修改器 (Modifiers) ---
 
+@declares(reads=('layer_name',), writes=('target_layer_name',))
+@instrumented('modifier')
 def normalize_layer(
         ctx: GenerationContext,
         layer_name: str,
@@ -35,39 +69,65 @@ def normalize_layer(
     这是一个独立的、意图明确的原子操作。
     """
     if layer_name not in ctx.layers:
-        print(f"警告: 层 '{layer_name}' 不存在，无法归一化。")
+        LOGGER.warning("层 '%s' 不存在，无法归一化。", layer_name)
         return ctx
 
     if target_layer_name is None:
         target_layer_name = layer_name
 
-    ctx.layers[target_layer_name] = safe_normalize(ctx.layers[layer_name])
-    print(f"--- 已显式归一化层 '{layer_name}' -> '{target_layer_name}' ---")
+    ctx.layers[target_layer_name] = safe_normalize(_layer_operand(ctx, layer_name))
+    LOGGER.debug("--- 已显式归一化层 '%s' -> '%s' ---", layer_name, target_layer_name)
     return ctx
 
+@declares(reads=('base_layer_name',), writes=('target_layer_name',))
+@instrumented('modifier')
 def apply_perlin_noise(
         ctx: GenerationContext,
         target_layer_name: str,
         scale: float,
         strength: float,
-        base_layer_name: str = None
+        base_layer_name: str = None,
+        octaves: int = 1,
+        backend: str = 'numpy',  # 'numpy', 'reference'
+        rng: Optional[np.random.Generator] = None
 ) -> GenerationContext:
-    """在指定层上应用或创建一个柏林噪声层。"""
+    """
+    在指定层上应用或创建一个柏林噪声层。
+    backend='numpy' 使用向量化的梯度噪声，'reference' 为逐格调用 PerlinNoise 的旧实现。
+    如果上下文配置了噪声库 (ctx.noise_bank)，则直接从预计算的平铺纹理中截取随机窗口。
+    未显式传入 rng 时，从上下文派生一个以目标层命名的世界级随机数流。
+
+    噪声总是按世界坐标 (ctx.origin + 网格下标) 采样。分块生成时各块拿到相同的偏移和噪声种子，
+    并且按固定值域 [-1, 1] 而不是本块的最小/最大值归一化，因此噪声在分块接缝处连续。
+    """
     w, h = ctx.grid_width, ctx.grid_height
+    ox, oy = ctx.origin
 
-    # 创建一个巨大的随机偏移量来打破采样规则性
-    # 这样即使用户输入 0.5 或 1.0 这样的“魔数”也能正常工作
-    random.seed(time.time())  # 确保每次运行的偏移量都不同
-    offset_x = random.random() * 10000
-    offset_y = random.random() * 10000
+    noise_func = NOISE_BACKENDS.get(backend)
+    if noise_func is None:
+        LOGGER.warning("未知的噪声后端 '%s'。", backend)
+        return ctx
 
-    # 使用与时间相关的种子，确保每次运行的噪声都不同
-    noise_gen = PerlinNoise(octaves=4, seed=int(time.time()))
+    if rng is None:
+        rng = ctx.spawn_rng('apply_perlin_noise', target_layer_name, world=True)
 
-    # 在采样时应用偏移量
-    noise = np.array([[noise_gen([(i * scale) + offset_x, (j * scale) + offset_y]) for j in range(h)] for i in range(w)])
+    if ctx.noise_bank is not None:
+        # 噪声库中的纹理是平铺的，随机窗口本身就起到了随机偏移的作用
+        noise = ctx.noise_bank.sample_window(w, h, scale, octaves, rng=rng, origin=(ox, oy))
+    else:
+        # 创建一个巨大的随机偏移量来打破采样规则性
+        # 这样即使用户输入 0.5 或 1.0 这样的“魔数”也能正常工作
+        offset_x, offset_y = rng.random(2) * 10000
 
-    noise_norm = safe_normalize(noise)
+        # 在采样时应用偏移量，噪声种子同样来自随机数流
+        xs = (np.arange(w) + ox) * scale + offset_x
+        ys = (np.arange(h) + oy) * scale + offset_y
+        noise = noise_func(xs, ys, octaves=octaves, seed=int(rng.integers(2 ** 31)), dtype=ctx.dtype_policy.compute)
+
+    if ctx.is_tile:
+        noise_norm = np.clip(noise * 0.5 + 0.5, 0, 1)
+    else:
+        noise_norm = safe_normalize(noise)
 
     if base_layer_name and base_layer_name in ctx.layers:
         base_layer = ctx.layers[base_layer_name]
@@ -77,10 +137,12 @@ def apply_perlin_noise(
         ctx.layers[target_layer_name] = noise_norm
 
     np.clip(ctx.layers[target_layer_name], 0, 1, out=ctx.layers[target_layer_name])
-    print(f"--- 应用柏林噪声到层 '{target_layer_name}' ---")
+    LOGGER.debug("--- 应用柏林噪声到层 '%s' ---", target_layer_name)
     return ctx
 
 
+@declares(writes=('target_layer_name',))
+@instrumented('modifier')
 def create_uniform_layer(
         ctx: GenerationContext,
         target_layer_name: str,
@@ -88,11 +150,17 @@ def create_uniform_layer(
 ) -> GenerationContext:
     """创建一个填充了均匀值的层。"""
     w, h = ctx.grid_width, ctx.grid_height
-    ctx.layers[target_layer_name] = np.full((w, h), fill_value=value)
-    print(f"--- 创建了值为 {value} 的均匀层 '{target_layer_name}' ---")
+    if ctx.layers.lazy:
+        # 常数层在被读取之前不占用内存
+        ctx.layers[target_layer_name] = FullLeaf((w, h), value, dtype=ctx.dtype_policy.compute)
+    else:
+        ctx.layers[target_layer_name] = ctx.layers.allocate(target_layer_name, (w, h), fill_value=value)
+    LOGGER.debug("--- 创建了值为 %s 的均匀层 '%s' ---", value, target_layer_name)
     return ctx
 
 
+@declares(writes=('target_layer_name',))
+@instrumented('modifier')
 def create_layer_from_coordinates(
         ctx: GenerationContext,
         target_layer_name: str,
@@ -107,52 +175,136 @@ def create_layer_from_coordinates(
     if base_layer is not None:
         new_map = base_layer.copy()
     else:
-        new_map = np.zeros((w, h))
+        new_map = ctx.layers.allocate(target_layer_name, (w, h), fill_value=0.0)
 
     for x, y in coordinates:
         if 0 <= x < w and 0 <= y < h:
             new_map[x, y] = value
 
     ctx.layers[target_layer_name] = new_map
-    print(f"--- 从 {len(coordinates)} 个坐标点创建了层 '{target_layer_name}' ---")
+    LOGGER.debug("--- 从 %s 个坐标点创建了层 '%s' ---", len(coordinates), target_layer_name)
     return ctx
 
 
+@declares(reads=('layer_name',), writes=('target_layer_name',))
+@instrumented('modifier')
 def adjust_layer_contrast(
         ctx: GenerationContext,
         layer_name: str,
         exponent: float,
-        target_layer_name: str = None
+        target_layer_name: str = None,
+        out: Optional[np.ndarray] = None
 ) -> GenerationContext:
     """
     通过幂运算调整一个层的对比度。
     exponent > 1: 增加对比度 (使高峰更突出)
     0 < exponent < 1: 降低对比度 (使分布更平缓)
+    传入 out 时整个计算在 out 中原地完成 (out 可以就是源层本身)，结果层即为 out。
     """
     if layer_name not in ctx.layers:
-        print(f"警告: 层 '{layer_name}' 不存在，无法调整对比度。")
+        LOGGER.warning("层 '%s' 不存在，无法调整对比度。", layer_name)
         return ctx
 
     if target_layer_name is None:
         target_layer_name = layer_name
 
+    if out is not None:
+        # 归一化 -> 幂 -> 再归一化，全部写在 out 里
+        safe_normalize(ctx.layers.read(layer_name), out=out)
+        np.power(out, exponent, out=out)
+        ctx.layers[target_layer_name] = safe_normalize(out, out=out)
+        LOGGER.debug("--- 调整层 '%s' 的对比度 (指数: %s) -> '%s' ---", layer_name, exponent, target_layer_name)
+        return ctx
+
     # 确保层的值在 [0, 1] 范围内
-    layer_data = safe_normalize(ctx.layers[layer_name])
+    layer_data = safe_normalize(_layer_operand(ctx, layer_name))
 
-    adjusted_map = np.power(layer_data, exponent)
+    adjusted_map = layer_data ** exponent
 
     ctx.layers[target_layer_name] = safe_normalize(adjusted_map)  # 再次归一化
-    print(f"--- 调整层 '{layer_name}' 的对比度 (指数: {exponent}) -> '{target_layer_name}' ---")
+    LOGGER.debug("--- 调整层 '%s' 的对比度 (指数: %s) -> '%s' ---", layer_name, exponent, target_layer_name)
     return ctx
 
 
+@declares(reads=('layer_name',), writes=('target_layer_name',))
+@instrumented('modifier')
+def clip_layer(
+        ctx: GenerationContext,
+        layer_name: str,
+        lower: Optional[float] = 0.0,
+        upper: Optional[float] = None,
+        target_layer_name: Optional[str] = None
+) -> GenerationContext:
+    """把一个层的值裁剪到 [lower, upper] 范围 (None 表示该侧不限制)。"""
+    if layer_name not in ctx.layers:
+        LOGGER.warning("层 '%s' 不存在，无法裁剪。", layer_name)
+        return ctx
+
+    if target_layer_name is None:
+        target_layer_name = layer_name
+
+    layer_data = _layer_operand(ctx, layer_name)
+    if isinstance(layer_data, LayerExpr):
+        ctx.layers[target_layer_name] = layer_data.clipped(lower, upper)
+    else:
+        ctx.layers[target_layer_name] = np.clip(layer_data, lower, upper)
+    return ctx
+
+
+def _apply_influence(
+        ctx: GenerationContext,
+        target_layer_name: str,
+        positions: np.ndarray,
+        strengths: np.ndarray,
+        sigma: float,
+        mode: str,
+        backend: str
+) -> bool:
+    """
+    计算影响、归一化并合并到目标层。未知模式返回 False。
+    分块生成时新影响按固定尺度 (最大源强度，即单个源的峰值) 归一化，而不是按本块内的最大/最小值，
+    这样同一个源在相邻两块中产生的影响完全相同，影响图在接缝处连续。
+    """
+    w, h = ctx.grid_width, ctx.grid_height
+    target_layer = ctx.layers[target_layer_name]
+    fixed_scale = float(np.max(np.abs(strengths))) if ctx.is_tile and len(strengths) else None
+
+    if backend == 'window':
+        influence, x0, y0 = stamp_influence_windows((w, h), positions, strengths, sigma, dtype=ctx.dtype_policy.compute)
+        if influence is None:
+            # 没有任何源落在网格内，影响处处为 0
+            if mode == 'multiply':
+                target_layer.fill(0)
+            return mode in ('add', 'subtract', 'multiply', 'multiply_inverse')
+        # 截断核之外的影响恒为 0，因此只需按最大值归一化
+        peak = influence.max() if fixed_scale is None else fixed_scale
+        if peak > 1e-9:
+            influence /= peak
+        else:
+            influence.fill(0)
+        return merge_influence_window(target_layer, influence, x0, y0, mode)
+
+    new_influence_map = compute_influence_map(
+        w, h, positions, strengths, sigma, backend=backend, dtype=ctx.dtype_policy.compute
+    )
+    # 归一化新产生的影响，使其最大值为1，这样strength参数才可控 (原地进行，不再复制一份)
+    if fixed_scale is None:
+        safe_normalize(new_influence_map, out=new_influence_map)
+    elif fixed_scale > 1e-9:
+        new_influence_map /= fixed_scale
+    return merge_influence(target_layer, new_influence_map, mode)
+
+
+@declares(writes=('target_layer_name',))
+@instrumented('modifier')
 def apply_influence_from_points(
         ctx: GenerationContext,
         target_layer_name: str,
         points: List[Tuple[float, float]],
         sigma: float,
         strength: float = 1.0,
-        mode: str = 'add'  # 'add', 'subtract', 'multiply', 'multiply_inverse'
+        mode: str = 'add',  # 'add', 'subtract', 'multiply', 'multiply_inverse'
+        backend: str = 'auto'  # 'auto', 'direct', 'convolution', 'fft', 'window'
 ) -> GenerationContext:
     """
     基于一组坐标点计算影响，并按指定模式将其应用到一个目标层上。
@@ -160,64 +312,73 @@ def apply_influence_from_points(
     """
     w, h = ctx.grid_width, ctx.grid_height
 
-    if not points:
+    if len(points) == 0:
         return ctx
 
     # 1. 幂等性：按需创建目标层
     ctx = ensure_layer_exists(ctx, target_layer_name, fill_value=0.0)
+    if sigma ** 2 <= 1e-9:
+        return ctx
 
-    # 2. 计算新产生的影响图 (不存入 ctx.layers)
-    new_influence_map = np.zeros((w, h))
-
-    x_coords, y_coords = np.arange(w), np.arange(h)
-    xx, yy = np.meshgrid(x_coords, y_coords)
-    sigma_sq = sigma ** 2
-    if sigma_sq <= 1e-9:
+    # 2. 计算新产生的影响图并根据模式合并到目标层
+    positions = np.asarray(points, dtype=float)
+    strengths = np.full(len(positions), strength)
+    if not _apply_influence(ctx, target_layer_name, positions, strengths, sigma, mode, backend):
+        LOGGER.warning("在 apply_influence_from_points 中使用了未知的模式 '%s'。", mode)
         return ctx
 
-    for p in points:
-        px, py = p
-        distance_sq = (xx - px) ** 2 + (yy - py) ** 2
-        new_influence_map += np.exp(-distance_sq / (2 * sigma_sq)).T * strength
+    LOGGER.debug("--- 向层 '%s' 应用了来自 %s 个点的影响 ---", target_layer_name, len(points))
+    return ctx
 
-    new_influence_map = safe_normalize(new_influence_map)
 
-    # 3. 根据模式将新影响合并到目标层
-    target_layer = ctx.layers[target_layer_name]
-    if mode == 'add':
-        target_layer += new_influence_map
-    elif mode == 'subtract':
-        target_layer -= new_influence_map
-    elif mode == 'multiply':
-        target_layer *= new_influence_map
-    elif mode == 'multiply_inverse':
-        target_layer *= (1.0 - new_influence_map)
+def _source_positions_and_strengths(
+        source_objects: Union[ObjectSelection, Iterable[GameObject]],
+        strength_multiplier: Union[Callable[[GameObject], float], Dict[str, float]]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    取出源对象的中心位置 (N, 2) 和强度 (N,)。
+    源是对象表中的一个选择、强度是按类型给出的字典时，全程向量化，不会逐个创建对象视图。
+    """
+    if isinstance(source_objects, ObjectSelection):
+        positions = source_objects.center_visual_pos()
+        if isinstance(strength_multiplier, dict):
+            table = source_objects.table
+            per_code = np.array([strength_multiplier.get(t, 1.0) for t in table.type_names], dtype=float)
+            return positions, per_code[table.type_codes[source_objects.rows]]
+        source_objects = list(source_objects)
     else:
-        print(f"警告: 在 apply_influence_from_points 中使用了未知的模式 '{mode}'。")
-        return ctx
-
-    # 3. 将新影响合并到目标层
-    ctx.layers[target_layer_name] += new_influence_map
-
-    # 防止减法产生负值
-    if mode == 'subtract' or mode == 'multiply_inverse':
-        np.clip(target_layer, 0, None, out=target_layer)
+        source_objects = list(source_objects)
+        positions = np.array([obj.center_visual_pos for obj in source_objects], dtype=float).reshape(-1, 2)
 
-    print(f"--- 向层 '{target_layer_name}' 应用了来自 {len(points)} 个点的影响 ---")
-    return ctx
+    if isinstance(strength_multiplier, dict):
+        strengths = np.array([strength_multiplier.get(obj.obj_type, 1.0) for obj in source_objects], dtype=float)
+    else:
+        strengths = np.array([strength_multiplier(obj) for obj in source_objects], dtype=float)
+    return positions, strengths
 
 
+@declares(reads=(OBJECTS,), writes=('target_layer_name',))
+@instrumented('modifier')
 def apply_influence_to_layer(
         ctx: GenerationContext,
         target_layer_name: str,
-        source_objects: List[GameObject],
+        source_objects: Union[ObjectSelection, List[GameObject]],
         sigma: float,
-        strength_multiplier: Callable[[GameObject], float] = lambda obj: 1.0,  # 按对象类型决定强度
-        mode: str = 'add'  # 'add', 'subtract', 'multiply', 'multiply_inverse'
+        strength_multiplier: Union[Callable[[GameObject], float], Dict[str, float]] = lambda obj: 1.0,  # 按对象类型决定强度
+        mode: str = 'add',  # 'add', 'subtract', 'multiply', 'multiply_inverse'
+        backend: str = 'auto'  # 'auto', 'direct', 'convolution', 'fft', 'window'
 ) -> GenerationContext:
     """
     计算一组源对象产生的影响，并按指定模式将其应用到一个目标层上。
     此操作是幂等的：如果目标层不存在，会自动创建。
+
+    source_objects 可以是对象列表，也可以是 ctx.objects.select(...) 得到的选择；
+    strength_multiplier 可以是逐对象的函数，也可以是 {类型: 强度} 字典 (未列出的类型强度为 1.0)。
+
+    backend 决定影响图的计算方式：'direct' 对每个源在整张网格上求一次高斯 (旧实现)；
+    'convolution' / 'fft' 先把源强度双线性泼溅到密度网格，再整体做一次高斯滤波；
+    'auto' 按核半径在后两者间选择；
+    'window' 只在每个源周围 3 sigma 的窗口内累加缓存的截断高斯核，适合每次只新增少量源的增量更新。
     """
     if not source_objects:
         return ctx  # 如果没有源对象，什么都不做
@@ -226,69 +387,47 @@ def apply_influence_to_layer(
     ctx = ensure_layer_exists(ctx, target_layer_name, fill_value=(0.0 if mode == 'add' else 1.0))
 
     # 2. 计算新产生的影响图 (不存入 ctx.layers)
-    w, h = ctx.grid_width, ctx.grid_height
-    new_influence_map = np.zeros((w, h))
-
-    x_coords, y_coords = np.arange(w), np.arange(h)
-    xx, yy = np.meshgrid(x_coords, y_coords)
     sigma_sq = sigma ** 2
     if sigma_sq <= 1e-9: return ctx
-
-    for obj in source_objects:
-        center_pos = obj.center_visual_pos
-        strength = strength_multiplier(obj)
-        if strength == 0: continue
-
-        distance_sq = (xx - center_pos[0]) ** 2 + (yy - center_pos[1]) ** 2
-        new_influence_map += np.exp(-distance_sq / (2 * sigma_sq)).T * strength
-
-    # 归一化新产生的影响，使其最大值为1，这样strength参数才可控
-    new_influence_map = safe_normalize(new_influence_map)
+    positions, strengths = _source_positions_and_strengths(source_objects, strength_multiplier)
+    active = strengths != 0
 
     # 3. 将新影响直接合并到目标层
-    target_layer = ctx.layers[target_layer_name]
-    if mode == 'add':
-        target_layer += new_influence_map
-    elif mode == 'subtract':
-        target_layer -= new_influence_map
-    elif mode == 'multiply':
-        target_layer *= new_influence_map
-    elif mode == 'multiply_inverse':
-        target_layer *= (1.0 - new_influence_map)
-    else:
-        print(f"警告: 在 apply_influence_to_layer 中使用了未知的模式 '{mode}'。")
+    if not _apply_influence(ctx, target_layer_name, positions[active], strengths[active], sigma, mode, backend):
+        LOGGER.warning("在 apply_influence_to_layer 中使用了未知的模式 '%s'。", mode)
         return ctx
 
-    # 防止减法产生负值
-    if mode == 'subtract' or mode == 'multiply_inverse':
-        np.clip(target_layer, 0, None, out=target_layer)
-
-    print(f"--- 向层 '{target_layer_name}' 应用了来自 {len(source_objects)} 个对象的影响 ---")
+    LOGGER.debug("--- 向层 '%s' 应用了来自 %s 个对象的影响 ---", target_layer_name, len(positions))
     return ctx
 
 
+@declares(writes=(OBJECTS,))
+@instrumented('modifier')
 def apply_visual_jitter(
         ctx: GenerationContext,
         position_jitter: float,
-        angle_jitter_degrees: float
+        angle_jitter_degrees: float,
+        rng: Optional[np.random.Generator] = None
 ) -> GenerationContext:
     """
     为所有现存对象的视觉位置和角度增加随机扰动。
     只影响有 grid_pos 的物体 (通常是家具)。
     """
-    print("--- 开始应用视觉抖动 ---")
+    LOGGER.info("--- 开始应用视觉抖动 ---")
+    if rng is None:
+        rng = ctx.spawn_rng('apply_visual_jitter')
 
-    for obj in ctx.objects:
-        # 只对有实体格子的对象进行抖动，避免移动角色或脏污等浮动物体
-        if obj.grid_pos is not None:
-            offset = np.random.uniform(-position_jitter, position_jitter, 2)
-            obj.visual_pos += offset
-            obj.visual_angle = random.uniform(-angle_jitter_degrees, angle_jitter_degrees)
+    # 只对有实体格子的对象进行抖动，避免移动角色或脏污等浮动物体
+    rows = np.flatnonzero(ctx.objects.has_grid_pos)
+    ctx.objects.visual_pos[rows] += rng.uniform(-position_jitter, position_jitter, (len(rows), 2))
+    ctx.objects.visual_angle[rows] = rng.uniform(-angle_jitter_degrees, angle_jitter_degrees, len(rows))
 
-    print("--- 视觉抖动应用完毕 ---")
+    LOGGER.info("--- 视觉抖动应用完毕 ---")
     return ctx
 
 
+@declares(reads=('layer_a_name', 'layer_b_name'), writes=('target_layer_name',))
+@instrumented('modifier')
 def combine_layers(
         ctx: GenerationContext,
         target_layer_name: str,
@@ -296,17 +435,27 @@ def combine_layers(
         layer_b_name: str,
         mode: str = 'weighted_sum',  # 'add', 'multiply', 'weighted_sum'
         weight_a: float = 0.5,
-        weight_b: float = 0.5
+        weight_b: float = 0.5,
+        out: Optional[np.ndarray] = None
 ) -> GenerationContext:
     """
     将两个源层通过指定模式组合，并将结果存入目标层。
+    传入 out 时结果直接写入 out，目标层即为 out，不分配新数组。
     """
     if layer_a_name not in ctx.layers or layer_b_name not in ctx.layers:
-        print(f"警告: 组合操作所需的源层 ({layer_a_name} 或 {layer_b_name}) 不存在。")
+        LOGGER.warning("组合操作所需的源层 (%s 或 %s) 不存在。", layer_a_name, layer_b_name)
+        return ctx
+
+    if out is not None:
+        if not _combine_into(ctx, ctx.layers.read(layer_a_name), ctx.layers.read(layer_b_name), mode, weight_a, weight_b, out):
+            LOGGER.warning("未知的组合模式 '%s'。", mode)
+            return ctx
+        ctx.layers[target_layer_name] = out
+        LOGGER.debug("--- 组合层 '%s' 和 '%s' -> '%s' (模式: %s) ---", layer_a_name, layer_b_name, target_layer_name, mode)
         return ctx
 
-    layer_a = ctx.layers[layer_a_name]
-    layer_b = ctx.layers[layer_b_name]
+    layer_a = _layer_operand(ctx, layer_a_name)
+    layer_b = _layer_operand(ctx, layer_b_name)
 
     if mode == 'add':
         combined_map = layer_a + layer_b
@@ -317,15 +466,33 @@ def combine_layers(
         # 但为了通用性，我们也移除归一化，让用户显式处理
         combined_map = (layer_a * weight_a) + (layer_b * weight_b)
     else:
-        print(f"警告: 未知的组合模式 '{mode}'。")
+        LOGGER.warning("未知的组合模式 '%s'。", mode)
         return ctx
 
     ctx.layers[target_layer_name] = combined_map
 
-    print(f"--- 组合层 '{layer_a_name}' 和 '{layer_b_name}' -> '{target_layer_name}' (模式: {mode}) ---")
+    LOGGER.debug("--- 组合层 '%s' 和 '%s' -> '%s' (模式: %s) ---", layer_a_name, layer_b_name, target_layer_name, mode)
     return ctx
 
 
+def _combine_into(ctx, layer_a, layer_b, mode, weight_a, weight_b, out) -> bool:
+    """combine_layers 的原地版本，结果与分配新数组的版本逐位相同。"""
+    if mode == 'add':
+        np.add(layer_a, layer_b, out=out)
+    elif mode == 'multiply':
+        np.multiply(layer_a, layer_b, out=out)
+    elif mode == 'weighted_sum':
+        with ctx.buffers.scratch(out.shape, out.dtype) as weighted_b:
+            np.multiply(layer_b, weight_b, out=weighted_b)
+            np.multiply(layer_a, weight_a, out=out)
+            out += weighted_b
+    else:
+        return False
+    return True
+
+
+@declares(writes=(OBJECTS,))
+@instrumented('modifier')
 def bind_floating_objects_to_grid(ctx: GenerationContext) -> GenerationContext:
     """
     遍历所有游戏对象，为那些只有 visual_pos 而没有 grid_pos 的对象
@@ -333,28 +500,25 @@ def bind_floating_objects_to_grid(ctx: GenerationContext) -> GenerationContext:
 
     绑定规则：简单地取 visual_pos 的整数部分 (floor)。
     """
-    print("--- 开始将浮动对象绑定到网格 ---")
-
-    updated_count = 0
-    for obj in ctx.objects:
-        # 如果一个对象已经有 grid_pos (如家具)，我们不应该动它。
-        if obj.grid_pos is None:
-            # 计算网格坐标
-            grid_x = int(np.floor(obj.visual_pos[0]))
-            grid_y = int(np.floor(obj.visual_pos[1]))
+    LOGGER.info("--- 开始将浮动对象绑定到网格 ---")
 
-            # 确保坐标在网格范围内
-            grid_x = max(0, min(ctx.grid_width - 1, grid_x))
-            grid_y = max(0, min(ctx.grid_height - 1, grid_y))
+    # 如果一个对象已经有 grid_pos (如家具)，我们不应该动它。
+    rows = np.flatnonzero(~ctx.objects.has_grid_pos)
 
-            obj.grid_pos = np.array([grid_x, grid_y])
+    # 计算网格坐标，并确保坐标在网格范围内
+    grid_pos = np.floor(ctx.objects.visual_pos[rows]).astype(np.int32)
+    np.clip(grid_pos, 0, (ctx.grid_width - 1, ctx.grid_height - 1), out=grid_pos)
 
-            updated_count += 1
+    ctx.objects.grid_pos[rows] = grid_pos
+    ctx.objects.has_grid_pos[rows] = True
+    updated_count = len(rows)
 
-    print(f"--- 网格绑定完毕，更新了 {updated_count} 个对象 ---")
+    LOGGER.info("--- 网格绑定完毕，更新了 %s 个对象 ---", updated_count)
     return ctx
 
 
+@declares(writes=('layer_name',))
+@instrumented('modifier')
 def ensure_layer_exists(
         ctx: GenerationContext,
         layer_name: str,
@@ -365,12 +529,14 @@ def ensure_layer_exists(
     这是一个幂等操作。
     """
     if layer_name not in ctx.layers:
-        print(f"--- 层 '{layer_name}' 不存在，正在按需创建 (填充值: {fill_value}) ---")
+        LOGGER.debug("--- 层 '%s' 不存在，正在按需创建 (填充值: %s) ---", layer_name, fill_value)
         w, h = ctx.grid_width, ctx.grid_height
-        ctx.layers[layer_name] = np.full((w, h), fill_value=fill_value)
+        ctx.layers[layer_name] = ctx.layers.allocate(layer_name, (w, h), fill_value=fill_value)
     return ctx
 
 
+@declares(reads=('source_layer_name',), writes=('source_layer_name', FIELDS))
+@instrumented('modifier')
 def promote_layer_to_field(
         ctx: GenerationContext,
         source_layer_name: str,
@@ -378,14 +544,19 @@ def promote_layer_to_field(
         remove_source: bool = True
 ) -> GenerationContext:
     """
-    将一个临时层“提升”为一个永久的场。
+    将一个临时层“提升”为一个永久的场，场的数值类型由 ctx.dtype_policy.field_dtype 决定，
+    存储后端由 ctx.storage 按场名决定 (memmap 后端的场分块复制，不会整张读入内存)。
     """
     if source_layer_name not in ctx.layers:
-        print(f"警告: 源层 '{source_layer_name}' 不存在，无法提升为场。")
+        LOGGER.warning("源层 '%s' 不存在，无法提升为场。", source_layer_name)
         return ctx
 
-    print(f"--- 将层 '{source_layer_name}' 提升为场 '{target_field_name}' ---")
-    ctx.fields[target_field_name] = ctx.layers[source_layer_name].copy()
+    LOGGER.info("--- 将层 '%s' 提升为场 '%s' ---", source_layer_name, target_field_name)
+    source = ctx.layers.read(source_layer_name)
+    # 总是复制一份，场与源层互不影响
+    field_array = ctx.storage.allocate(target_field_name, source.shape, ctx.dtype_policy.field_dtype)
+    copy_blocks(field_array, source)
+    ctx.fields[target_field_name] = field_array
 
     if remove_source:
         del ctx.layers[source_layer_name]
@@ -393,52 +564,40 @@ def promote_layer_to_field(
     return ctx
 
 
+@instrumented('modifier')
 def reserve_grid_margin(
         ctx: GenerationContext,
         margin_width: int,
         occupant_type: str = "WALL_RESERVED"
 ) -> GenerationContext:
     """
-    在占用网格 (occupancy_grid) 的边缘保留指定宽度的区域。
+    在占用网格 (occupancy) 的边缘保留指定宽度的区域。
     这可以模拟墙壁，防止物体生成在地图的最边缘。
 
-    我们通过放置一个虚拟的、不可见的 GameObject 来实现占用。
+    这些格子只在占用索引中被标记为 occupant_type，不会创建任何 GameObject，
+    因此不会被导出或渲染。边缘指的是世界的边缘：分块生成时只有贴着世界边界的分块才会预留。
     """
     if margin_width <= 0:
         return ctx
 
-    print(f"--- 预留 {margin_width} 格宽的边缘区域 ---")
+    LOGGER.info("--- 预留 %s 格宽的边缘区域 ---", margin_width)
     w, h = ctx.grid_width, ctx.grid_height
-
-    # 创建一个虚拟的占位对象，用于标记这些格子
-    # 它不会被添加到 ctx.objects 列表中，因此不会被导出或渲染
-    wall_placeholder = GameObject(obj_type=occupant_type, visual_pos=np.array([-1, -1]))
-
-    # 上边缘
-    for i in range(w):
-        for j in range(margin_width):
-            ctx.occupancy_grid[i, j].append(wall_placeholder)
-    # 下边缘
-    for i in range(w):
-        for j in range(h - margin_width, h):
-            ctx.occupancy_grid[i, j].append(wall_placeholder)
-    # 左边缘
-    for i in range(margin_width):
-        for j in range(margin_width, h - margin_width):  # 避免重复计算角落
-            ctx.occupancy_grid[i, j].append(wall_placeholder)
-    # 右边缘
-    for i in range(w - margin_width, w):
-        for j in range(margin_width, h - margin_width):  # 避免重复计算角落
-            ctx.occupancy_grid[i, j].append(wall_placeholder)
+    ox, oy = ctx.origin
+    world_w, world_h = ctx.world_width, ctx.world_height
+
+    xs = np.arange(ox, ox + w)
+    ys = np.arange(oy, oy + h)
+    margin_mask = ((xs < margin_width) | (xs >= world_w - margin_width))[:, None] \
+        | ((ys < margin_width) | (ys >= world_h - margin_width))[None, :]
+    if not margin_mask.any():
+        return ctx
+    ctx.occupancy.stamp_mask(margin_mask, occupant_type)
 
     # (可选) 也可以在关键的数据层上直接将这些区域的概率设为0
     # 这可以提高后续采样放置器的效率，因为它们不必再考虑这些无效区域
     for layer_name, layer in ctx.layers.items():
         if isinstance(layer, np.ndarray) and layer.shape == (w, h):
-            layer[0:margin_width, :] = 0
-            layer[w - margin_width:w, :] = 0
-            layer[:, 0:margin_width] = 0
-            layer[:, h - margin_width:h] = 0
+            layer[margin_mask] = 0
 
-    print("--- 边缘预留完毕 ---")
+    LOGGER.info("--- 边缘预留完毕 ---")
     return ctx
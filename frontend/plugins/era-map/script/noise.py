@@ -0,0 +1,186 @@
+from typing import Optional, Callable, Dict
+
+import numpy as np
+
+# perlin_noise 库里的 octaves 参数实际上是“每单位坐标内的晶格数”，也就是基础频率。
+# 旧实现固定使用 PerlinNoise(octaves=4)，这里保持同样的晶格密度，
+# 保证同样的 scale 能得到同样大小的“团块”。
+DEFAULT_BASE_FREQUENCY = 4.0
+
+# 每次向量化计算最多处理的格子数，用于限制超大地图时的临时数组大小
+_CHUNK_CELLS = 1 << 20
+
+
+def _fade(t: np.ndarray) -> np.ndarray:
+    """Perlin 的五次平滑曲线 6t^5 - 15t^4 + 10t^3。"""
+    return t * t * t * (t * (t * 6.0 - 15.0) + 10.0)
+
+
+def _make_lattice(seed: int, dtype) -> tuple:
+    """
+    为一个八度生成置换表和梯度表。
+    置换表使用 uint8，这样 perm[x] + y 的溢出天然等价于 & 255。
+    """
+    rng = np.random.default_rng(seed)
+    perm = rng.permutation(256).astype(np.uint8)
+    angles = rng.uniform(0.0, 2.0 * np.pi, 256)
+    grad_x = np.cos(angles).astype(dtype)
+    grad_y = np.sin(angles).astype(dtype)
+    return perm, grad_x, grad_y
+
+
+def _split_lattice(coords: np.ndarray, period: Optional[int]) -> tuple:
+    """把一维采样坐标拆分为晶格索引 (uint8) 与晶格内的小数部分。"""
+    cell = np.floor(coords)
+    frac = coords - cell
+    cell = cell.astype(np.int64)
+    if period is not None:
+        cell0 = cell % period
+        cell1 = (cell + 1) % period
+    else:
+        cell0 = cell
+        cell1 = cell + 1
+    return (cell0 & 255).astype(np.uint8), (cell1 & 255).astype(np.uint8), frac
+
+
+def _perlin_octave(
+        xs: np.ndarray,
+        ys: np.ndarray,
+        lattice: tuple,
+        period: Optional[int],
+        out: np.ndarray
+) -> np.ndarray:
+    """
+    对 xs × ys 的规则网格计算单个八度的梯度噪声，结果写入 out (形状 (len(xs), len(ys)))。
+    由于采样点是规则网格，x/y 方向的晶格索引和平滑权重都可以分离计算，只有最后的组合是二维的。
+    """
+    perm, grad_x, grad_y = lattice
+    dtype = out.dtype
+
+    ix0, ix1, fx = _split_lattice(xs, period)
+    iy0, iy1, fy = _split_lattice(ys, period)
+    fx = fx.astype(dtype)
+    fy = fy.astype(dtype)
+    u = _fade(fx)[:, None]
+    v = _fade(fy)[None, :]
+
+    hx0 = perm[ix0][:, None]
+    hx1 = perm[ix1][:, None]
+    fx0 = fx[:, None]
+    fx1 = fx0 - 1.0
+    fy0 = fy[None, :]
+    fy1 = fy0 - 1.0
+
+    def corner(hx, iy, dx, dy):
+        h = perm[hx + iy[None, :]]  # uint8 加法自动回绕
+        return grad_x[h] * dx + grad_y[h] * dy
+
+    n00 = corner(hx0, iy0, fx0, fy0)
+    n10 = corner(hx1, iy0, fx1, fy0)
+    bottom = n00 + u * (n10 - n00)
+    n01 = corner(hx0, iy1, fx0, fy1)
+    n11 = corner(hx1, iy1, fx1, fy1)
+    top = n01 + u * (n11 - n01)
+
+    np.add(bottom, v * (top - bottom), out=out)
+    return out
+
+
+def fractal_noise_grid(
+        xs: np.ndarray,
+        ys: np.ndarray,
+        octaves: int = 1,
+        seed: int = 0,
+        base_frequency: float = DEFAULT_BASE_FREQUENCY,
+        persistence: float = 0.5,
+        lacunarity: float = 2.0,
+        period: Optional[float] = None,
+        dtype=np.float64
+) -> np.ndarray:
+    """
+    向量化的多八度梯度噪声 (fBm)。
+    xs / ys 是噪声空间中的一维采样坐标，返回形状为 (len(xs), len(ys)) 的数组，值域大致在 [-1, 1]。
+
+    每个八度都是一次整块数组运算；超大网格会按行分块计算以限制临时内存。
+    period 不为 None 时，噪声在两个方向上以 period (噪声空间单位) 为周期无缝平铺，
+    此时要求 period * base_frequency * lacunarity^k 对每个八度都是整数。
+    """
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    result = np.zeros((len(xs), len(ys)), dtype=dtype)
+    if result.size == 0:
+        return result
+
+    rows_per_chunk = max(1, _CHUNK_CELLS // max(1, len(ys)))
+    scratch = np.empty((min(rows_per_chunk, len(xs)), len(ys)), dtype=dtype)
+
+    frequency = base_frequency
+    amplitude = 1.0
+    total_amplitude = 0.0
+    for k in range(octaves):
+        lattice_period = None
+        if period is not None:
+            lattice_period = int(round(period * frequency))
+            if lattice_period <= 0 or abs(lattice_period - period * frequency) > 1e-6:
+                raise ValueError(
+                    f"平铺噪声的周期 {period} 在第 {k} 个八度 (频率 {frequency}) 上不是整数个晶格。")
+
+        lattice = _make_lattice(seed + k, dtype)
+        sample_ys = ys * frequency
+        for start in range(0, len(xs), rows_per_chunk):
+            stop = min(start + rows_per_chunk, len(xs))
+            block = scratch[:stop - start]
+            _perlin_octave(xs[start:stop] * frequency, sample_ys, lattice, lattice_period, block)
+            block *= amplitude
+            result[start:stop] += block
+
+        total_amplitude += amplitude
+        frequency *= lacunarity
+        amplitude *= persistence
+
+    result /= total_amplitude
+    return result
+
+
+def reference_noise_grid(
+        xs: np.ndarray,
+        ys: np.ndarray,
+        octaves: int = 1,
+        seed: int = 0,
+        base_frequency: float = DEFAULT_BASE_FREQUENCY,
+        persistence: float = 0.5,
+        lacunarity: float = 2.0,
+        period: Optional[float] = None,
+        dtype=np.float64
+) -> np.ndarray:
+    """
+    旧的纯 Python 实现：逐格调用 perlin_noise.PerlinNoise。
+    仅用于对照和基准测试，不支持平铺。
+    """
+    from perlin_noise import PerlinNoise
+
+    if period is not None:
+        raise ValueError("reference 噪声后端不支持平铺 (period)。")
+
+    generators = []
+    frequency = base_frequency
+    amplitude = 1.0
+    for k in range(octaves):
+        generators.append((PerlinNoise(octaves=frequency, seed=seed + k), amplitude))
+        frequency *= lacunarity
+        amplitude *= persistence
+
+    total_amplitude = sum(a for _, a in generators)
+    noise = np.array([
+        [sum(gen([x, y]) * a for gen, a in generators) for y in ys]
+        for x in xs
+    ], dtype=dtype)
+    return noise / total_amplitude
+
+
+NoiseBackend = Callable[..., np.ndarray]
+
+NOISE_BACKENDS: Dict[str, NoiseBackend] = {
+    'numpy': fractal_noise_grid,
+    'reference': reference_noise_grid,
+}
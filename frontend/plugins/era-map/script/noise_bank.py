@@ -0,0 +1,139 @@
+import logging
+import math
+import threading
+from collections import OrderedDict
+from typing import Tuple
+
+import numpy as np
+
+from disk_cache import LruDirectory
+from noise import fractal_noise_grid, DEFAULT_BASE_FREQUENCY
+
+LOGGER = logging.getLogger('era_map.noise_bank')
+
+NoiseKey = Tuple[int, int, int, int]  # (octaves, scale_bucket, seed, tile_size)
+
+
+class NoiseBank:
+    """
+    预计算的可平铺噪声纹理库。
+
+    纹理按 (octaves, scale 分桶, seed, 纹理边长) 生成一次，以 .npy 存在磁盘上并通过 np.memmap 打开，
+    之后的 apply_perlin_noise 只需从纹理中随机截取一个窗口 (越界部分环绕)，不再逐格合成噪声。
+    磁盘占用受 size_budget_bytes 限制，超出时按 LRU 淘汰；进程内还会保留少量已打开的映射。
+    """
+
+    def __init__(
+            self,
+            root_dir: str,
+            size_budget_bytes: int = 512 * 1024 * 1024,
+            tile_size: int = 1024,
+            seeds_per_key: int = 4,
+            buckets_per_octave: int = 8,
+            max_open_tiles: int = 16,
+            dtype=np.float32
+    ):
+        self.storage = LruDirectory(root_dir, size_budget_bytes)
+        self.tile_size = tile_size
+        self.seeds_per_key = seeds_per_key
+        self.buckets_per_octave = buckets_per_octave
+        self.max_open_tiles = max_open_tiles
+        self.dtype = np.dtype(dtype)
+        self._open_tiles: "OrderedDict[NoiseKey, np.ndarray]" = OrderedDict()
+        # 并发阶段可能同时请求同一张纹理，只生成一次
+        self._lock = threading.Lock()
+
+    # --- 键与尺寸 ---
+
+    def scale_bucket(self, scale: float) -> int:
+        """把连续的 scale 量化到对数分桶，每个二倍程有 buckets_per_octave 个桶。"""
+        return int(round(math.log2(scale) * self.buckets_per_octave))
+
+    def tile_size_for(self, w: int, h: int) -> int:
+        """纹理边长：不小于默认值，且能完整容纳请求的窗口 (取 2 的幂)。"""
+        needed = max(w, h, self.tile_size)
+        return 1 << (needed - 1).bit_length()
+
+    def effective_scale(self, bucket: int, tile_size: int) -> float:
+        """
+        分桶对应的实际采样间距。
+        为了让纹理无缝平铺，需要 tile_size * scale * 基础频率 恰好是整数个晶格。
+        """
+        bucket_scale = 2.0 ** (bucket / self.buckets_per_octave)
+        lattice_period = max(1, round(tile_size * bucket_scale * DEFAULT_BASE_FREQUENCY))
+        return lattice_period / (tile_size * DEFAULT_BASE_FREQUENCY)
+
+    @staticmethod
+    def _entry_name(key: NoiseKey) -> str:
+        octaves, bucket, seed, tile_size = key
+        return f"noise_o{octaves}_b{bucket}_s{seed}_t{tile_size}"
+
+    # --- 纹理获取 ---
+
+    def get_tile(self, octaves: int, scale: float, seed: int, tile_size: int) -> np.ndarray:
+        """返回 (只读映射的) 平铺噪声纹理，必要时生成并写入磁盘。"""
+        key = (octaves, self.scale_bucket(scale), seed, tile_size)
+        name = self._entry_name(key)
+
+        with self._lock:
+            tile = self._open_tiles.get(key)
+            if tile is not None:
+                self._open_tiles.move_to_end(key)
+                self.storage.touch(name)
+                return tile
+
+            if self.storage.contains(name):
+                try:
+                    tile = np.load(self.storage.path_for(name), mmap_mode='r')
+                    self.storage.touch(name)
+                except (OSError, ValueError):
+                    tile = None  # 被并发淘汰或损坏，重新生成
+
+            if tile is None:
+                tile = self._generate_tile(key)
+                path = self.storage.store(name, lambda tmp: np.save(tmp, tile))
+                tile = np.load(path, mmap_mode='r')
+
+            self._open_tiles[key] = tile
+            while len(self._open_tiles) > self.max_open_tiles:
+                self._open_tiles.popitem(last=False)
+            return tile
+
+    def _generate_tile(self, key: NoiseKey) -> np.ndarray:
+        octaves, bucket, seed, tile_size = key
+        scale = self.effective_scale(bucket, tile_size)
+        coords = np.arange(tile_size) * scale
+        LOGGER.info("--- 噪声库: 生成新的平铺纹理 %s ---", self._entry_name(key))
+        return fractal_noise_grid(
+            coords, coords,
+            octaves=octaves,
+            seed=seed,
+            period=tile_size * scale,
+            dtype=self.dtype
+        )
+
+    def sample_window(
+            self,
+            w: int,
+            h: int,
+            scale: float,
+            octaves: int,
+            rng: np.random.Generator,
+            origin: Tuple[int, int] = (0, 0)
+    ) -> np.ndarray:
+        """
+        从随机选择的纹理中截取一个随机位置的 w×h 窗口 (越过纹理边界时环绕)。
+        origin 是网格在世界中的起点：分块生成时各块用同一个随机数流，窗口再按 origin 平移，拼起来是连续的。
+        """
+        tile_size = self.tile_size_for(w, h)
+        seed = int(rng.integers(self.seeds_per_key))
+        tile = self.get_tile(octaves, scale, seed, tile_size)
+
+        ox, oy = (int(v) for v in rng.integers(tile_size, size=2))
+        ox, oy = (ox + origin[0]) % tile_size, (oy + origin[1]) % tile_size
+        if ox + w <= tile_size and oy + h <= tile_size:
+            return np.array(tile[ox:ox + w, oy:oy + h])
+
+        xi = (ox + np.arange(w)) % tile_size
+        yi = (oy + np.arange(h)) % tile_size
+        return tile[np.ix_(xi, yi)]
@@ -0,0 +1,438 @@
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Union
+
+import numpy as np
+
+# select() 接受的类型过滤条件：单个类型名、一组类型名，或者对类型名的判断函数
+TypeFilter = Union[str, Iterable[str], Callable[[str], bool]]
+
+
+class ObjectTable:
+    """
+    列式 (struct-of-arrays) 的对象表，替代原来的 List[GameObject]。
+
+    每一列是一个按容量倍增的 NumPy 数组：类型编码 (字符串被驻留为整数)、(N, 2) float32 视觉位置、
+    角度、网格位置/尺寸以及单调递增的 uid。追加是均摊 O(1) 的，按类型过滤是一次向量化比较，
+    批量删除是一次压缩。迭代或下标访问返回 GameObjectView，它与原 GameObject 的属性接口一致，
+    读写都直接落在列数组上，因此旧代码无需修改即可继续工作。
+    """
+
+    def __init__(self, capacity: int = 64):
+        capacity = max(1, capacity)
+        self.type_names: List[str] = []
+        self._type_codes: Dict[str, int] = {}
+
+        self._count = 0
+        self._type_code = np.empty(capacity, dtype=np.int16)
+        self._visual_pos = np.empty((capacity, 2), dtype=np.float32)
+        self._visual_angle = np.empty(capacity, dtype=np.float32)
+        self._grid_pos = np.empty((capacity, 2), dtype=np.int32)
+        self._grid_size = np.empty((capacity, 2), dtype=np.int32)
+        self._has_grid_pos = np.empty(capacity, dtype=bool)
+        self._has_grid_size = np.empty(capacity, dtype=bool)
+        self._uid = np.empty(capacity, dtype=np.int64)
+        self._next_uid = 1
+
+        # version 在任何增删时递增；removal_version 只在删除 (行号发生移动) 时递增
+        self.version = 0
+        self.removal_version = 0
+        self._index_cache: Dict[tuple, tuple] = {}
+        # 统计：追加过的对象总数 (不因删除而减少)
+        self.appended = 0
+
+    # --- 列访问 (长度为当前对象数的视图) ---
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def type_codes(self) -> np.ndarray:
+        return self._type_code[:self._count]
+
+    @property
+    def visual_pos(self) -> np.ndarray:
+        return self._visual_pos[:self._count]
+
+    @property
+    def visual_angle(self) -> np.ndarray:
+        return self._visual_angle[:self._count]
+
+    @property
+    def grid_pos(self) -> np.ndarray:
+        return self._grid_pos[:self._count]
+
+    @property
+    def grid_size(self) -> np.ndarray:
+        return self._grid_size[:self._count]
+
+    @property
+    def has_grid_pos(self) -> np.ndarray:
+        return self._has_grid_pos[:self._count]
+
+    @property
+    def has_grid_size(self) -> np.ndarray:
+        return self._has_grid_size[:self._count]
+
+    @property
+    def uids(self) -> np.ndarray:
+        return self._uid[:self._count]
+
+    @property
+    def nbytes(self) -> int:
+        """列数组实际占用的字节数 (按容量计)。"""
+        return sum(a.nbytes for a in (
+            self._type_code, self._visual_pos, self._visual_angle, self._grid_pos,
+            self._grid_size, self._has_grid_pos, self._has_grid_size, self._uid))
+
+    def center_visual_pos(self, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """(向量化的) 视觉中心：有网格尺寸的对象取矩形中心，否则就是视觉位置。"""
+        rows = slice(0, self._count) if rows is None else rows
+        centers = self._visual_pos[rows].astype(np.float64)
+        sized = self._has_grid_size[rows]
+        centers[sized] += self._grid_size[rows][sized] / 2
+        return centers
+
+    # --- 类型驻留 ---
+
+    def type_code(self, obj_type: str) -> int:
+        code = self._type_codes.get(obj_type)
+        if code is None:
+            code = len(self.type_names)
+            self.type_names.append(obj_type)
+            self._type_codes[obj_type] = code
+        return code
+
+    def _codes_for(self, types: TypeFilter) -> List[int]:
+        if isinstance(types, str):
+            types = [types]
+        elif callable(types):
+            types = [t for t in self.type_names if types(t)]
+        return [self._type_codes[t] for t in types if t in self._type_codes]
+
+    # --- 查询 ---
+
+    def indices_of(self, types: TypeFilter) -> np.ndarray:
+        """返回指定类型的行号 (按 version 缓存)。"""
+        codes = tuple(sorted(self._codes_for(types)))
+        cached = self._index_cache.get(codes)
+        if cached is not None and cached[0] == self.version:
+            return cached[1]
+
+        if not codes:
+            rows = np.empty(0, dtype=np.int64)
+        elif len(codes) == 1:
+            rows = np.flatnonzero(self.type_codes == codes[0])
+        else:
+            rows = np.flatnonzero(np.isin(self.type_codes, codes))
+        rows.setflags(write=False)
+        self._index_cache[codes] = (self.version, rows)
+        return rows
+
+    def select(self, types: TypeFilter) -> 'ObjectSelection':
+        """按类型筛选对象，返回一个轻量的行号集合。"""
+        return ObjectSelection(self, self.indices_of(types))
+
+    def type_mask(self, types: TypeFilter) -> np.ndarray:
+        return np.isin(self.type_codes, self._codes_for(types))
+
+    def type_name_of(self, row: int) -> str:
+        return self.type_names[self._type_code[row]]
+
+    def row_of_uid(self, uid: int) -> int:
+        """uid 单调递增且删除时保持顺序，因此可以二分查找。找不到时返回 -1。"""
+        row = int(np.searchsorted(self.uids, uid))
+        if row < self._count and self._uid[row] == uid:
+            return row
+        return -1
+
+    # --- 追加与删除 ---
+
+    def _reserve(self, extra: int) -> int:
+        """确保还能容纳 extra 个对象 (容量倍增)，返回新对象的起始行号。"""
+        start = self._count
+        needed = start + extra
+        capacity = len(self._uid)
+        if needed > capacity:
+            new_capacity = max(needed, capacity * 2)
+            for name in ('_type_code', '_visual_pos', '_visual_angle', '_grid_pos',
+                         '_grid_size', '_has_grid_pos', '_has_grid_size', '_uid'):
+                old = getattr(self, name)
+                new = np.empty((new_capacity,) + old.shape[1:], dtype=old.dtype)
+                new[:start] = old[:start]
+                setattr(self, name, new)
+        self._count = needed
+        self.version += 1
+        self.appended += extra
+        return start
+
+    def append(self, obj) -> 'GameObjectView':
+        """追加一个对象 (任何具有 GameObject 属性的对象)，为它分配新的 uid，返回指向新行的视图。"""
+        row = self._reserve(1)
+        self._type_code[row] = self.type_code(obj.obj_type)
+        self._visual_pos[row] = obj.visual_pos
+        self._visual_angle[row] = obj.visual_angle
+        self._has_grid_pos[row] = obj.grid_pos is not None
+        self._grid_pos[row] = obj.grid_pos if obj.grid_pos is not None else -1
+        self._has_grid_size[row] = obj.grid_size is not None
+        self._grid_size[row] = obj.grid_size if obj.grid_size is not None else 0
+        self._uid[row] = self._next_uid
+        self._next_uid += 1
+        return GameObjectView(self, row)
+
+    def extend_floating(self, obj_type: str, positions: np.ndarray, angles: Optional[np.ndarray] = None) -> 'ObjectSelection':
+        """批量追加一组只有视觉位置的浮动对象，positions 形状为 (N, 2)。"""
+        positions = np.asarray(positions).reshape(-1, 2)
+        count = len(positions)
+        start = self._reserve(count)
+        rows = slice(start, start + count)
+        self._type_code[rows] = self.type_code(obj_type)
+        self._visual_pos[rows] = positions
+        self._visual_angle[rows] = 0.0 if angles is None else angles
+        self._has_grid_pos[rows] = False
+        self._grid_pos[rows] = -1
+        self._has_grid_size[rows] = False
+        self._grid_size[rows] = 0
+        self._uid[rows] = np.arange(self._next_uid, self._next_uid + count)
+        self._next_uid += count
+        return ObjectSelection(self, np.arange(start, start + count))
+
+    def columns(self, rows: Optional[np.ndarray] = None) -> Dict[str, np.ndarray]:
+        """
+        按列导出对象 (rows 为 None 时导出全部)，类型以名字数组给出，不含 uid。
+        结果只包含普通数组，可以直接用 np.savez 保存，或用 extend_columns 追加到另一张对象表。
+        """
+        rows = np.arange(self._count) if rows is None else np.asarray(rows)
+        names = np.array(self.type_names if self.type_names else [''], dtype=str)
+        return {
+            'obj_type': names[self.type_codes[rows]],
+            'visual_pos': self.visual_pos[rows].copy(),
+            'visual_angle': self.visual_angle[rows].copy(),
+            'grid_pos': self.grid_pos[rows].copy(),
+            'grid_size': self.grid_size[rows].copy(),
+            'has_grid_pos': self.has_grid_pos[rows].copy(),
+            'has_grid_size': self.has_grid_size[rows].copy(),
+        }
+
+    def extend_columns(self, columns: Dict[str, np.ndarray], uids: Optional[np.ndarray] = None) -> 'ObjectSelection':
+        """
+        批量追加 columns() 格式的对象。uids 为 None 时分配新的 uid；
+        否则沿用给定的 uid (例如从另一个进程搬运回来的对象)，它们必须递增且大于表中已有的 uid。
+        """
+        obj_types = np.asarray(columns['obj_type'], dtype=str)
+        count = len(obj_types)
+        if uids is not None and count:
+            uids = np.asarray(uids, dtype=np.int64)
+            if uids[0] < self._next_uid or np.any(np.diff(uids) <= 0):
+                raise ValueError("沿用的 uid 必须递增且大于表中已有的 uid")
+        start = self._reserve(count)
+        rows = slice(start, start + count)
+        unique_names, inverse = np.unique(obj_types, return_inverse=True)
+        codes = np.array([self.type_code(str(name)) for name in unique_names], dtype=np.int16)
+        self._type_code[rows] = codes[inverse] if count else 0
+        for name in ('visual_pos', 'visual_angle', 'grid_pos', 'grid_size', 'has_grid_pos', 'has_grid_size'):
+            getattr(self, '_' + name)[rows] = columns[name]
+        if uids is None:
+            self._uid[rows] = np.arange(self._next_uid, self._next_uid + count)
+            self._next_uid += count
+        elif count:
+            self._uid[rows] = uids
+            self._next_uid = int(uids[-1]) + 1
+        return ObjectSelection(self, np.arange(start, start + count))
+
+    def remove(self, rows: np.ndarray) -> int:
+        """
+        批量删除对象 (rows 可以是行号数组或长度为 N 的布尔掩码)，一次压缩完成。
+        删除后剩余对象的相对顺序不变；返回删除的数量。
+        """
+        keep = np.ones(self._count, dtype=bool)
+        keep[rows] = False
+        removed = self._count - int(keep.sum())
+        if removed == 0:
+            return 0
+
+        kept_rows = np.flatnonzero(keep)
+        for name in ('_type_code', '_visual_pos', '_visual_angle', '_grid_pos',
+                     '_grid_size', '_has_grid_pos', '_has_grid_size', '_uid'):
+            column = getattr(self, name)
+            column[:len(kept_rows)] = column[kept_rows]
+        self._count = len(kept_rows)
+        self.version += 1
+        self.removal_version += 1
+        return removed
+
+    # --- 快照 ---
+
+    def snapshot(self) -> Dict[str, np.ndarray]:
+        """
+        表的完整状态 (包括类型表的顺序和下一个 uid)，只包含普通数组，可以直接用 np.savez 保存。
+        与 columns() 不同，restore_snapshot 之后的表与原表逐位相同，后续追加的对象也会得到相同的 uid 和类型编码。
+        """
+        return {
+            'type_names': np.array(self.type_names, dtype=str),
+            'type_code': self.type_codes.copy(),
+            'visual_pos': self.visual_pos.copy(),
+            'visual_angle': self.visual_angle.copy(),
+            'grid_pos': self.grid_pos.copy(),
+            'grid_size': self.grid_size.copy(),
+            'has_grid_pos': self.has_grid_pos.copy(),
+            'has_grid_size': self.has_grid_size.copy(),
+            'uid': self.uids.copy(),
+            'next_uid': np.array(self._next_uid, dtype=np.int64),
+        }
+
+    def restore_snapshot(self, arrays: Dict[str, np.ndarray]):
+        """原地恢复 snapshot() 的结果 (引用这张表的空间索引和缓存会在下次使用时重建)。"""
+        self.type_names = [str(name) for name in arrays['type_names']]
+        self._type_codes = {name: code for code, name in enumerate(self.type_names)}
+        self._count = 0
+        start = self._reserve(len(arrays['uid']))
+        rows = slice(start, start + len(arrays['uid']))
+        for name in ('type_code', 'visual_pos', 'visual_angle', 'grid_pos', 'grid_size',
+                     'has_grid_pos', 'has_grid_size', 'uid'):
+            getattr(self, '_' + name)[rows] = arrays[name]
+        self._next_uid = int(arrays['next_uid'])
+        self.removal_version += 1
+        self._index_cache.clear()
+
+    # --- 兼容 List[GameObject] 的接口 ---
+
+    def __getitem__(self, row: int) -> 'GameObjectView':
+        if row < 0:
+            row += self._count
+        if not 0 <= row < self._count:
+            raise IndexError(row)
+        return GameObjectView(self, row)
+
+    def __iter__(self) -> Iterator['GameObjectView']:
+        for row in range(self._count):
+            yield GameObjectView(self, row)
+
+
+class ObjectSelection:
+    """
+    对象表中若干行的集合。可以像列表一样迭代出 GameObjectView，也可以直接取列数据。
+    和 GameObjectView 一样，选择记住所选对象的 uid：表中发生删除导致行号移动后，
+    访问时按 uid 重新定位；所选对象中有被删除的，则抛出 KeyError，而不是悄悄指向别的对象。
+    """
+
+    def __init__(self, table: ObjectTable, rows: np.ndarray):
+        self.table = table
+        self._rows = rows
+        self._uids = table._uid[rows]
+        self._removal_version = table.removal_version
+
+    @property
+    def rows(self) -> np.ndarray:
+        table = self.table
+        if self._removal_version != table.removal_version:
+            uids = table.uids
+            rows = np.searchsorted(uids, self._uids)
+            found = rows < len(uids)
+            found[found] = uids[rows[found]] == self._uids[found]
+            if not found.all():
+                raise KeyError(f"选择中有 {int(np.count_nonzero(~found))} 个对象已从对象表中删除。")
+            self._rows = rows
+            self._removal_version = table.removal_version
+        return self._rows
+
+    def __len__(self) -> int:
+        return len(self._uids)
+
+    def __bool__(self) -> bool:
+        return len(self._uids) > 0
+
+    def __iter__(self) -> Iterator['GameObjectView']:
+        for row in self.rows:
+            yield GameObjectView(self.table, int(row))
+
+    def __getitem__(self, i: int) -> 'GameObjectView':
+        return GameObjectView(self.table, int(self.rows[i]))
+
+    @property
+    def visual_pos(self) -> np.ndarray:
+        return self.table.visual_pos[self.rows]
+
+    @property
+    def type_names(self) -> List[str]:
+        names = self.table.type_names
+        return [names[c] for c in self.table.type_codes[self.rows]]
+
+    def center_visual_pos(self) -> np.ndarray:
+        return self.table.center_visual_pos(self.rows)
+
+
+class GameObjectView:
+    """
+    指向对象表中一行的轻量视图，提供与 GameObject 相同的属性。
+    视图记住 uid，即使表中发生了删除导致行号移动，也能重新定位到同一个对象。
+    """
+
+    __slots__ = ('_table', '_row', '_removal_version', 'uid')
+
+    def __init__(self, table: ObjectTable, row: int):
+        self._table = table
+        self._row = row
+        self._removal_version = table.removal_version
+        self.uid = int(table._uid[row])
+
+    @property
+    def row(self) -> int:
+        table = self._table
+        if self._removal_version != table.removal_version:
+            self._row = table.row_of_uid(self.uid)
+            self._removal_version = table.removal_version
+            if self._row < 0:
+                raise KeyError(f"对象 uid={self.uid} 已从对象表中删除。")
+        return self._row
+
+    @property
+    def obj_type(self) -> str:
+        return self._table.type_name_of(self.row)
+
+    @property
+    def visual_pos(self) -> np.ndarray:
+        # 返回行视图，原地修改 (例如 +=) 会直接写回表中
+        return self._table._visual_pos[self.row]
+
+    @visual_pos.setter
+    def visual_pos(self, value):
+        self._table._visual_pos[self.row] = value
+
+    @property
+    def visual_angle(self) -> float:
+        return float(self._table._visual_angle[self.row])
+
+    @visual_angle.setter
+    def visual_angle(self, value: float):
+        self._table._visual_angle[self.row] = value
+
+    @property
+    def grid_pos(self) -> Optional[np.ndarray]:
+        row = self.row
+        return self._table._grid_pos[row] if self._table._has_grid_pos[row] else None
+
+    @grid_pos.setter
+    def grid_pos(self, value):
+        row = self.row
+        self._table._has_grid_pos[row] = value is not None
+        self._table._grid_pos[row] = value if value is not None else -1
+
+    @property
+    def grid_size(self) -> Optional[np.ndarray]:
+        row = self.row
+        return self._table._grid_size[row] if self._table._has_grid_size[row] else None
+
+    @grid_size.setter
+    def grid_size(self, value):
+        row = self.row
+        self._table._has_grid_size[row] = value is not None
+        self._table._grid_size[row] = value if value is not None else 0
+
+    @property
+    def center_visual_pos(self) -> np.ndarray:
+        grid_size = self.grid_size
+        if grid_size is not None:
+            return self.visual_pos + grid_size / 2
+        return self.visual_pos
+
+    def __repr__(self) -> str:
+        return f"GameObjectView(uid={self.uid}, obj_type={self.obj_type!r}, visual_pos={self.visual_pos.tolist()})"
@@ -0,0 +1,204 @@
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+
+@dataclass
+class _CachedValidMask:
+    blocked_by: FrozenSet[str]
+    footprint: Tuple[int, int]
+    mask: np.ndarray
+    version: int
+
+
+class OccupancyIndex:
+    """
+    基于位掩码的占用索引。
+
+    每种对象类型在首次出现时被分配一个比特位，每个格子存一个无符号整数掩码，
+    表示“哪些类型占用了这个格子”。这样“是否被 blocked_by 中的任一类型占用”
+    就变成了对整张网格的一次按位与，不再需要逐格遍历对象列表。
+    格子到对象 uid 的反查是可选的 (track_uids=True)，只有需要时才维护。
+
+    索引带有一个版本号，每次占用变化都会递增；按 (blocked_by, 足迹) 缓存的有效锚点掩码
+    在 stamp 时只更新被新足迹“膨胀”覆盖到的那一小块，迭代放置时每步只需 O(足迹) 的工作量。
+    """
+
+    def __init__(self, width: int, height: int, dtype=np.uint64, track_uids: bool = False):
+        self.width = width
+        self.height = height
+        self.dtype = np.dtype(dtype)
+        self.bits = np.zeros((width, height), dtype=self.dtype)
+        self.type_bits: Dict[str, int] = {}
+        self.cell_uids: Optional[Dict[Tuple[int, int], List[int]]] = {} if track_uids else None
+
+        self.version = 0
+        self._valid_cache: Dict[Tuple[FrozenSet[str], Tuple[int, int]], _CachedValidMask] = {}
+        # 统计：有效掩码整体重算 (缓存未命中或已过期) 的次数
+        self.mask_recomputations = 0
+
+    @property
+    def max_types(self) -> int:
+        return self.dtype.itemsize * 8
+
+    def type_bit(self, obj_type: str) -> int:
+        """返回类型对应的比特位，首次出现时分配一个新的比特位。"""
+        bit = self.type_bits.get(obj_type)
+        if bit is None:
+            if len(self.type_bits) >= self.max_types:
+                raise ValueError(f"占用索引最多只能区分 {self.max_types} 种对象类型 (dtype={self.dtype})。")
+            bit = 1 << len(self.type_bits)
+            self.type_bits[obj_type] = bit
+        return bit
+
+    def type_mask(self, obj_types: Iterable[str]) -> int:
+        """把一组类型合并为一个掩码。从未出现过的类型不可能占用任何格子，直接忽略。"""
+        mask = 0
+        for obj_type in obj_types:
+            mask |= self.type_bits.get(obj_type, 0)
+        return mask
+
+    def _clip_rect(self, x: int, y: int, w: int, h: int) -> Tuple[int, int, int, int]:
+        x0, y0 = max(0, int(x)), max(0, int(y))
+        x1, y1 = min(self.width, int(x) + int(w)), min(self.height, int(y) + int(h))
+        return x0, y0, x1, y1
+
+    def stamp(self, x: int, y: int, w: int, h: int, obj_type: str, uid: Optional[int] = None):
+        """用切片赋值把一个矩形足迹标记为被 obj_type 占用 (超出网格的部分会被裁掉)。"""
+        x0, y0, x1, y1 = self._clip_rect(x, y, w, h)
+        if x1 <= x0 or y1 <= y0:
+            return
+        self.bits[x0:x1, y0:y1] |= self.dtype.type(self.type_bit(obj_type))
+        self._update_cached_masks(obj_type, x0, y0, x1, y1)
+
+        if self.cell_uids is not None and uid is not None:
+            for i in range(x0, x1):
+                for j in range(y0, y1):
+                    self.cell_uids.setdefault((i, j), []).append(uid)
+
+    def stamp_mask(self, mask: np.ndarray, obj_type: str):
+        """把布尔掩码为 True 的所有格子标记为被 obj_type 占用。"""
+        self.bits[mask] |= self.dtype.type(self.type_bit(obj_type))
+        # 任意形状的批量修改不做增量更新，缓存的掩码会在下次请求时整体重算
+        self.version += 1
+
+    def blocked_mask(self, blocked_by: Iterable[str]) -> np.ndarray:
+        """返回一个 (W, H) 的布尔数组：格子是否被 blocked_by 中的任一类型占用。"""
+        mask = self.type_mask(blocked_by)
+        if mask == 0:
+            return np.zeros((self.width, self.height), dtype=bool)
+        return (self.bits & self.dtype.type(mask)) != 0
+
+    def valid_mask(self, blocked_by: Iterable[str], footprint: Tuple[int, int] = (1, 1)) -> np.ndarray:
+        """
+        返回以每个格子为左上角放置 footprint 大小的物体是否可行的布尔掩码，并按 (blocked_by, footprint) 缓存。
+        返回的数组是只读的，并且会随着后续的 stamp 原地保持最新。
+        """
+        blocked_by = frozenset(blocked_by)
+        footprint = (int(footprint[0]), int(footprint[1]))
+        key = (blocked_by, footprint)
+
+        entry = self._valid_cache.get(key)
+        if entry is not None and entry.version == self.version:
+            return entry.mask
+
+        mask = footprint_valid_mask(self.blocked_mask(blocked_by), *footprint)
+        mask.setflags(write=False)
+        self.mask_recomputations += 1
+        self._valid_cache[key] = _CachedValidMask(blocked_by, footprint, mask, self.version)
+        return mask
+
+    def _update_cached_masks(self, obj_type: str, x0: int, y0: int, x1: int, y1: int):
+        """
+        新占用了矩形 [x0, x1) × [y0, y1) 之后，增量更新所有仍然有效的缓存掩码。
+        对于 w×h 的足迹，受影响的锚点是矩形向左上方膨胀 (w-1, h-1) 后的区域。
+        """
+        previous_version = self.version
+        self.version += 1
+        for entry in self._valid_cache.values():
+            if entry.version != previous_version:
+                continue  # 已经过期的条目等下次请求时整体重算
+            if obj_type in entry.blocked_by:
+                fw, fh = entry.footprint
+                ax0, ay0 = max(0, x0 - fw + 1), max(0, y0 - fh + 1)
+                entry.mask.setflags(write=True)
+                entry.mask[ax0:x1, ay0:y1] = False
+                entry.mask.setflags(write=False)
+            entry.version = self.version
+
+    def snapshot(self) -> Dict[str, np.ndarray]:
+        """
+        占用状态 (位掩码网格和类型到比特位的分配顺序)，可以直接用 np.savez 保存。
+        开启 track_uids 时还包含 uid 反查，展开成每个 (格子, uid) 一行。
+        """
+        arrays = {
+            'bits': self.bits.copy(),
+            'type_names': np.array(list(self.type_bits), dtype=str),
+        }
+        if self.cell_uids is not None:
+            cells = [cell for cell, uids in self.cell_uids.items() for _ in uids]
+            arrays['uid_cells'] = np.array(cells, dtype=np.int32).reshape(-1, 2)
+            arrays['uid_values'] = np.array([uid for uids in self.cell_uids.values() for uid in uids], dtype=np.int64)
+        return arrays
+
+    def restore_snapshot(self, arrays: Dict[str, np.ndarray]):
+        """原地恢复 snapshot() 的结果；缓存的有效锚点掩码全部失效。"""
+        self.bits = np.array(arrays['bits'], dtype=self.dtype)
+        self.type_bits = {str(name): 1 << i for i, name in enumerate(arrays['type_names'])}
+        if self.cell_uids is not None:
+            if 'uid_cells' not in arrays:
+                raise ValueError("快照不包含 uid 反查，无法恢复到 track_uids=True 的占用索引")
+            self.cell_uids = {}
+            for (x, y), uid in zip(arrays['uid_cells'].tolist(), arrays['uid_values'].tolist()):
+                self.cell_uids.setdefault((x, y), []).append(uid)
+        self.version += 1
+        self._valid_cache.clear()
+
+    def is_occupied_by(self, x: int, y: int, obj_type: str) -> bool:
+        bit = self.type_bits.get(obj_type, 0)
+        return bool(int(self.bits[x, y]) & bit)
+
+    def occupant_types(self, x: int, y: int) -> List[str]:
+        """列出占用某个格子的所有类型 (调试用)。"""
+        cell = int(self.bits[x, y])
+        return [t for t, bit in self.type_bits.items() if cell & bit]
+
+    def uids_at(self, x: int, y: int) -> List[int]:
+        """反查占用某个格子的对象 uid；未开启 track_uids 时返回空列表。"""
+        if self.cell_uids is None:
+            return []
+        return list(self.cell_uids.get((x, y), []))
+
+
+def summed_area_table(mask: np.ndarray) -> np.ndarray:
+    """
+    计算布尔掩码的积分图 (summed-area table)。
+    结果形状为 (W + 1, H + 1)，S[x, y] 是 mask[:x, :y] 中 True 的数量。
+    """
+    w, h = mask.shape
+    dtype = np.int32 if w * h < 2 ** 31 else np.int64
+    sat = np.zeros((w + 1, h + 1), dtype=dtype)
+    np.cumsum(mask, axis=0, dtype=dtype, out=sat[1:, 1:])
+    np.cumsum(sat[1:, 1:], axis=1, out=sat[1:, 1:])
+    return sat
+
+
+def footprint_valid_mask(blocked: np.ndarray, w: int, h: int) -> np.ndarray:
+    """
+    对每个锚点 (x, y) 判断以它为左上角的 w×h 足迹是否完全空闲。
+
+    基于阻挡掩码的积分图，任意矩形内的阻挡格数都只需 4 次查表，
+    因此所有锚点一次性得出，总代价 O(W·H)，与足迹大小无关。
+    足迹会越出地图边缘的锚点同样视为无效。
+    """
+    grid_w, grid_h = blocked.shape
+    valid = np.zeros((grid_w, grid_h), dtype=bool)
+    if w <= 0 or h <= 0 or w > grid_w or h > grid_h:
+        return valid
+
+    sat = summed_area_table(blocked)
+    counts = (sat[w:, h:] - sat[:grid_w + 1 - w, h:]
+              - sat[w:, :grid_h + 1 - h] + sat[:grid_w + 1 - w, :grid_h + 1 - h])
+    valid[:grid_w + 1 - w, :grid_h + 1 - h] = counts == 0
+    return valid
@@ -1,29 +1,43 @@
-﻿import random
+﻿import logging
 from typing import Tuple, Optional, Set, List, Union
 
 import numpy as np
 
 from core_types import GenerationContext, GameObject
+from object_store import ObjectSelection
 from modifiers import safe_normalize
+from sampling import WeightedCellSampler, sample_cells, sample_one_cell
+from spatial_index import SpacingGrid
+from stage_scheduler import declares, OBJECTS, OCCUPANCY
+from instrumentation import instrumented
+
+LOGGER = logging.getLogger('era_map.placement_strategies')
+
 
 def _resolve_prob_map(ctx: GenerationContext, layer_source: Union[str, np.ndarray]) -> Optional[np.ndarray]:
     """根据输入是字符串还是numpy数组，返回概率图数据。"""
     if isinstance(layer_source, str):
         if layer_source not in ctx.layers:
-            print(f"警告: 概率层 '{layer_source}' 不存在。")
+            LOGGER.warning("概率层 '%s' 不存在。", layer_source)
             return None
-        return ctx.layers[layer_source]
+        # 只读取，不会修改概率图，因此不需要触发惰性层的写屏障
+        return ctx.layers.read(layer_source)
     elif isinstance(layer_source, np.ndarray):
         # 安全检查：确保传入的数组维度与上下文匹配
         if layer_source.shape != (ctx.grid_width, ctx.grid_height):
-            print(f"警告: 传入的概率图numpy数组维度 ({layer_source.shape}) 与网格维度 ({ctx.grid_width}, {ctx.grid_height}) 不匹配。")
+            LOGGER.warning(
+                "传入的概率图numpy数组维度 (%s) 与网格维度 (%s, %s) 不匹配。",
+                layer_source.shape, ctx.grid_width, ctx.grid_height
+            )
             return None
         return layer_source
     else:
-        print(f"警告: 未知的层源类型: {type(layer_source)}。")
+        LOGGER.warning("未知的层源类型: %s。", type(layer_source))
         return None
 
 
+@declares(reads=('layer_source', OBJECTS, OCCUPANCY), writes=(OBJECTS, OCCUPANCY))
+@instrumented('placement')
 def place_grid_objects_from_layer(
         ctx: GenerationContext,
         layer_source: Union[str, np.ndarray],
@@ -31,206 +45,198 @@ def place_grid_objects_from_layer(
         obj_type: str,
         grid_size: Tuple[int, int],
         blocked_by: Set[str],
-        max_attempts_multiplier: int = 100
+        max_attempts_multiplier: int = 100,
+        rng: Optional[np.random.Generator] = None
 )  -> Tuple[GenerationContext, List[GameObject]]:
     """
     使用真·加权采样在网格上放置物体，并进行碰撞检测。
     """
     placed_objects = []
+    if rng is None:
+        rng = ctx.spawn_rng('place_grid_objects_from_layer', obj_type)
     prob_map = _resolve_prob_map(ctx, layer_source)
     if prob_map is None:
         return ctx, placed_objects
     w, h = grid_size
 
-    # 预先计算所有不可放置的位置
-    valid_mask = np.ones_like(prob_map, dtype=bool)
-    for x in range(ctx.grid_width):
-        for y in range(ctx.grid_height):
-            is_blocked = False
-            # 检查目标区域内的每一个格子
-            for i in range(x, x + w):
-                for j in range(y, y + h):
-                    # 检查该格子的对象列表
-                    for occupant in ctx.occupancy_grid[i, j]:
-                        if occupant.obj_type in blocked_by:
-                            is_blocked = True
-                            break
-                    if is_blocked: break
-                if is_blocked: break
-
-            if is_blocked:
-                valid_mask[x, y] = False
-
-    # 将无效位置的概率设为0
-    masked_probs = prob_map * valid_mask
+    # 所有不可放置的位置：足迹内任一格子被 blocked_by 占用的锚点都无效
+    # 掩码由上下文缓存，放置新对象时会被增量更新
+    valid_mask = ctx.valid_mask(blocked_by, (w, h))
+
+    # 将无效位置的概率设为0，并一次性构建求和树采样器
+    sampler = WeightedCellSampler(prob_map * valid_mask)
 
     placed_count = 0
     for _ in range(num_to_place * max_attempts_multiplier):
         if placed_count >= num_to_place: break
 
-        flat_map = masked_probs.flatten()
-        map_sum = np.sum(flat_map)
-
-        if map_sum < 1e-9:
-            print(f"警告: 没有有效的放置位置了。只放置了 {placed_count}/{num_to_place} 个 {obj_type}。")
+        if sampler.total < 1e-9:
+            LOGGER.warning("没有有效的放置位置了。只放置了 %s/%s 个 %s。", placed_count, num_to_place, obj_type)
             break
 
-        # 真正的加权采样
-        normalized_probs = flat_map / map_sum
-        chosen_index = np.random.choice(len(normalized_probs), p=normalized_probs)
+        # 真正的加权采样，O(log n)
+        chosen_index = sampler.sample(rng)
+        ctx.samples_drawn += 1
         x, y = np.unravel_index(chosen_index, prob_map.shape)
 
         # 创建并添加对象
         grid_pos = np.array([x, y])
-        new_obj = GameObject(
+        new_obj = ctx.objects.append(GameObject(
             obj_type=obj_type,
             visual_pos=grid_pos.astype(float),
             grid_pos=grid_pos,
             grid_size=np.array(grid_size)
-        )
-        ctx.objects.append(new_obj)
+        ))
         ctx.update_occupancy(new_obj)
         placed_objects.append(new_obj)
 
-        # 重要：更新 masked_probs 以防止在同一区域重复放置
-        masked_probs[x:x + w, y:y + h] = 0
+        # 重要：更新采样权重以防止在同一区域重复放置
+        # update_occupancy 已经增量更新了 valid_mask，这里只需同步新足迹膨胀后覆盖的那一小块
+        ax, ay = max(0, x - w + 1), max(0, y - h + 1)
+        region = sampler.weights[ax:x + w, ay:y + h] * valid_mask[ax:x + w, ay:y + h]
+        region[x - ax:, y - ay:] = 0
+        sampler.set_rect(ax, ay, x + w, y + h, region)
 
         placed_count += 1
 
     return ctx, placed_objects
 
+@declares(reads=('layer_source', OBJECTS, OCCUPANCY), writes=(OBJECTS, OCCUPANCY))
+@instrumented('placement')
 def place_one_grid_object_from_layer(
         ctx: GenerationContext,
         layer_source: Union[str, np.ndarray],
         obj_type: str,
         grid_size: Tuple[int, int],
-        blocked_by: Set[str]
+        blocked_by: Set[str],
+        rng: Optional[np.random.Generator] = None
 ) -> Tuple[GenerationContext, Optional[GameObject]]:
     """
     使用加权采样放置单个网格对齐的物体，并返回这个物体。
     如果无法放置，则返回 None。
     """
+    if rng is None:
+        rng = ctx.spawn_rng('place_one_grid_object_from_layer', obj_type)
     prob_map = _resolve_prob_map(ctx, layer_source)
     if prob_map is None:
         return ctx, None
 
     w, h = grid_size
 
-    valid_mask = np.ones_like(prob_map, dtype=bool)
-    for x in range(ctx.grid_width):
-        for y in range(ctx.grid_height):
-            is_blocked = False
-            # 检查目标区域内的每一个格子
-            for i in range(x, x + w):
-                for j in range(y, y + h):
-                    # 检查该格子的对象列表
-                    for occupant in ctx.occupancy_grid[i, j]:
-                        if occupant.obj_type in blocked_by:
-                            is_blocked = True
-                            break
-                    if is_blocked: break
-                if is_blocked: break
-
-            if is_blocked:
-                valid_mask[x, y] = False
-
-    masked_probs = prob_map * valid_mask
-    flat_map = masked_probs.flatten()
-    map_sum = np.sum(flat_map)
-
-    if map_sum < 1e-9:
-        print(f"警告: 没有有效的放置位置了，无法放置 {obj_type}。")
-        return ctx, None
+    valid_mask = ctx.valid_mask(blocked_by, (w, h))
 
-    normalized_probs = flat_map / map_sum
-    chosen_index = np.random.choice(len(normalized_probs), p=normalized_probs)
+    # 临时数组都从上下文的缓冲池借用，迭代调用时不会反复分配整张网格
+    # 概率图按计算类型相乘，累积分布始终用 float64，保证大网格上的采样精度
+    with ctx.buffers.scratch(prob_map.shape, ctx.dtype_policy.compute) as masked_probs, \
+            ctx.buffers.scratch(prob_map.size) as cdf:
+        np.multiply(prob_map, valid_mask, out=masked_probs)
+        map_sum = np.sum(masked_probs)
+
+        if map_sum < 1e-9:
+            LOGGER.warning("没有有效的放置位置了，无法放置 %s。", obj_type)
+            return ctx, None
+
+        # 与 rng.choice(p=masked_probs / map_sum) 等价，累积分布写入借来的缓冲区
+        chosen_index = sample_one_cell(masked_probs, rng, scratch=cdf)
+        ctx.samples_drawn += 1
     x, y = np.unravel_index(chosen_index, prob_map.shape)
 
     grid_pos = np.array([x, y])
-    new_obj = GameObject(
+    new_obj = ctx.objects.append(GameObject(
         obj_type=obj_type,
         visual_pos=grid_pos.astype(float),
         grid_pos=grid_pos,
         grid_size=np.array(grid_size)
-    )
-    ctx.objects.append(new_obj)
+    ))
     ctx.update_occupancy(new_obj)
 
     return ctx, new_obj
 
+@declares(reads=('layer_source', OBJECTS, OCCUPANCY), writes=(OBJECTS, OCCUPANCY))
+@instrumented('placement')
 def place_floating_objects_from_layer(
         ctx: GenerationContext,
         layer_source: Union[str, np.ndarray],
         num_to_place: int,
         obj_type: str,
         blocked_by: Set[str],
-        max_attempts_multiplier: int = 5  # TODO 目前没有用上？还需要吗？
-) -> Tuple[GenerationContext, List[GameObject]]:
+        max_attempts_multiplier: int = 5,  # 有最小间距约束时，候选点数量为 num_to_place 的倍数
+        rng: Optional[np.random.Generator] = None,
+        min_spacing: float = 0.0,
+        spacing_against: Optional[Set[str]] = None
+) -> Tuple[GenerationContext, ObjectSelection]:
     """
     根据概率层，通过加权采样放置指定数量的非网格对齐的浮动对象。
+
+    min_spacing > 0 时，新对象之间、以及新对象与已有的 spacing_against 类型对象之间
+    (默认只包括同类型) 的距离都不小于 min_spacing。候选点仍然整批采样，
+    逐个接受时用哈希网格检查邻近的 3×3 个桶，每个候选期望 O(1)。
     """
-    placed_objects = []
+    placed_objects = ctx.objects.select(())
+    if rng is None:
+        rng = ctx.spawn_rng('place_floating_objects_from_layer', obj_type)
     prob_map_original = _resolve_prob_map(ctx, layer_source)
     if prob_map_original is None:
-        return ctx, []
-    prob_map = prob_map_original.copy()
+        return ctx, placed_objects
 
     # 已经被占用的格子不能放置
-    # 1. 创建一个有效位置的掩码
-    valid_mask = np.ones_like(prob_map, dtype=bool)
-    w, h = ctx.grid_width, ctx.grid_height
-
-    # 2. 遍历每一个格子，检查是否被指定的 blocker 占用
-    for x in range(w):
-        for y in range(h):
-            is_blocked = False
-            for occupant in ctx.occupancy_grid[x, y]:
-                if occupant.obj_type in blocked_by:
-                    is_blocked = True
-                    break
-            if is_blocked:
-                valid_mask[x, y] = False
-
-    # 3. 将掩码应用到概率图上，无效位置的概率将变为 0
-    prob_map *= valid_mask
+    # 1. 取得 (缓存的) 有效位置掩码
+    valid_mask = ctx.valid_mask(blocked_by)
+
+    # 2. 将掩码应用到概率图上，无效位置的概率将变为 0
+    prob_map = prob_map_original * valid_mask
 
     if np.sum(prob_map) < 1e-9:
-        print(f"警告: {obj_type} 没有有效的放置位置。")
+        LOGGER.warning("%s 没有有效的放置位置。", obj_type)
         return ctx,placed_objects
 
-    flat_map = prob_map.flatten()
-    normalized_probs = flat_map / np.sum(flat_map)
-
-    # 为了避免在完全相同的位置生成多个，我们可以选择不放回采样，
-    # 或者像之前一样用一个集合来记录。这里我们选择一次性采样多个。
+    # 3. 一次性有放回地采样所有格子 (累积和 + 二分查找)
     # `replace=True` 允许在同一个格子附近生成多个对象，这对于脏污是合理的。
-    chosen_indices = np.random.choice(
-        len(normalized_probs),
-        size=num_to_place,  # 直接采样目标数量
-        p=normalized_probs,
-        replace=True
-    )
+    num_candidates = num_to_place * max_attempts_multiplier if min_spacing > 0 else num_to_place
+    chosen_indices = sample_cells(prob_map.reshape(-1), num_candidates, rng)
+    ctx.samples_drawn += num_candidates
 
-    placed_count = 0
-    for index in chosen_indices:
-        ix, iy = np.unravel_index(index, prob_map.shape)
-
-        # 在格子中心附近随机抖动
-        # 这样可以确保视觉位置和逻辑位置（向下取整后）始终一致
-        center_x = ix + 0.5
-        center_y = iy + 0.5
-        # 抖动范围，例如在中心点 +/- 0.3 的范围内，确保不会越界
-        jitter = 0.3
-        pos_x = center_x + random.uniform(-jitter, jitter)
-        pos_y = center_y + random.uniform(-jitter, jitter)
-
-        new_obj = GameObject(
-            obj_type=obj_type,
-            visual_pos=np.array([pos_x, pos_y])
-        )
-        ctx.objects.append(new_obj)
-        placed_objects.append(new_obj)
-        placed_count += 1
+    # 4. 在格子中心附近随机抖动，整批生成 (N, 2) 的位置数组
+    # 抖动范围在中心点 +/- 0.3 以内，确保视觉位置和逻辑位置（向下取整后）始终一致
+    jitter = 0.3
+    cells = np.stack(np.unravel_index(chosen_indices, prob_map.shape), axis=1)
+    positions = cells + 0.5 + rng.uniform(-jitter, jitter, size=(len(chosen_indices), 2))
+
+    if min_spacing > 0:
+        positions = _filter_by_spacing(ctx, positions, num_to_place, obj_type, min_spacing, spacing_against)
+
+    # 5. 整批追加到上下文
+    placed_objects = ctx.add_floating_objects(obj_type, positions)
+    placed_count = len(placed_objects)
 
-    print(f"成功放置了 {placed_count}/{num_to_place} 个 {obj_type}。")
-    return ctx,placed_objects
\ No newline at end of file
+    LOGGER.info("成功放置了 %s/%s 个 %s。", placed_count, num_to_place, obj_type)
+    return ctx,placed_objects
+
+
+def _filter_by_spacing(
+        ctx: GenerationContext,
+        candidates: np.ndarray,
+        num_to_place: int,
+        obj_type: str,
+        min_spacing: float,
+        spacing_against: Optional[Set[str]]
+) -> np.ndarray:
+    """
+    按顺序接受候选点，跳过与已接受的点或已有对象过近的点，最多接受 num_to_place 个。
+    本批新点记录在局部的哈希网格中，已有对象则通过上下文的空间索引做半径查询；
+    两者都只拒绝距离严格小于 min_spacing 的点。
+    """
+    grid = SpacingGrid(min_spacing)
+    against = {obj_type} if spacing_against is None else spacing_against
+    check_existing = len(ctx.objects.indices_of(against)) > 0
+
+    accepted = []
+    for i, (x, y) in enumerate(candidates.tolist()):
+        if not grid.is_free(x, y):
+            continue
+        if not check_existing or len(ctx.spatial_index.query_radius((x, y), min_spacing, against, strict=True)) == 0:
+            grid.add(x, y)
+            accepted.append(i)
+            if len(accepted) >= num_to_place:
+                break
+    return candidates[accepted]
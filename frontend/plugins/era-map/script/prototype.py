@@ -6,6 +6,76 @@ class Settings:
     GRID_WIDTH = 30
     GRID_HEIGHT = 20
 
+    # 根随机种子。None 表示每次运行使用新的系统熵 (实际使用的种子会打印出来，便于复现)
+    SEED = None
+
+    # --- 噪声库 ---
+    # 设置为目录路径后，噪声会从磁盘上预计算的平铺纹理中截取，批量生成时可显著加速
+    NOISE_BANK_DIR = None
+    NOISE_BANK_BUDGET_MB = 512
+
+    # 惰性层：组合、对比度等逐元素修改器只记录表达式，真正读取时才分块融合求值
+    LAZY_LAYERS = False
+
+    # 层的数值类型：计算和存储默认用 float32；FLOAT16_LAYERS 中的层以 float16 存储 (只适合很少读取的权重层)
+    LAYER_DTYPE = 'float32'
+    FLOAT16_LAYERS = ()
+    # promote_layer_to_field 提升出的场的数值类型
+    FIELD_DTYPE = 'float32'
+
+    # 层的内存预算 (MB)：常驻层超出后，最久未使用的非 pinned 层被换出到 LAYER_SPILL_DIR
+    # (None 表示系统临时目录)，之后访问时自动读回。预算为 None 表示不限制
+    LAYER_MEMORY_BUDGET_MB = None
+    LAYER_SPILL_DIR = None
+    # 调试：保留所有中间层 (不随管道作用域释放)，供可视化查看
+    DEBUG_RETAIN_LAYERS = False
+
+    # 层、场和粒子密度网格的存储后端：'memory' 为普通数组，'memmap' 为临时目录中的内存映射文件
+    # (超大地图用，配合 LAZY_LAYERS 可以让整条流程不把任何一张层整张放在内存里)。
+    # MEMMAP_LAYERS 中的名字 (层名、场名或粒子类型) 在全局为 'memory' 时也单独使用 memmap
+    LAYER_STORAGE = 'memory'
+    MEMMAP_LAYERS = ()
+    LAYER_STORAGE_DIR = None
+
+    # 管道内互相独立的准备阶段 (噪声、吸引力图、影响图……) 并发运行的线程数 (见 stage_scheduler.py)。
+    # None 表示按 CPU 核数自动确定，1 表示按顺序串行运行；无论取值如何，相同种子的结果都完全相同
+    STAGE_WORKERS = None
+
+    # --- 性能分析与日志 (instrumentation.py) ---
+    # PROFILE 为 True 时记录每个修改器、放置策略和管道的耗时与计数器，结束后写出 PROFILE_REPORT 并打印汇总表；
+    # PROFILE_TRACE_MEMORY 额外用 tracemalloc 记录内存峰值 (会让流程慢数倍)
+    PROFILE = False
+    PROFILE_TRACE_MEMORY = False
+    PROFILE_REPORT = 'profile.json'
+    # 为 None 时流程消息全部原样输出到 stdout；不为 None 时 (例如 'WARNING')，只记录该级别及以上的消息 (见 instrumentation.quiet_output)
+    OUTPUT_LOG_LEVEL = None
+
+    # --- 管道缓存 (stage_cache.py) ---
+    # 设置目录后，每条管道 (桌子、椅子、光照、脏污、角色) 的输出按它的输入 (上游状态、读取的参数、种子) 缓存在磁盘上，
+    # 只修改后面管道读取的参数时 (例如 NUM_TORCHES)，前面的管道直接从缓存恢复；超出限额时淘汰最久未使用的快照
+    # SEED 为 None 时每次运行都使用新的随机种子，不使用缓存
+    STAGE_CACHE_DIR = None
+    STAGE_CACHE_BUDGET_MB = 1024
+
+    # --- 布局导出 (io_and_vis.export_layout) ---
+    # 'json'、'binary' (见 layout_binary.py，前端可直接映射为 TypedArray) 或 'both'；
+    # 二进制布局可以再用 'gzip' 或 'brotli' (需要 brotli 包) 压缩
+    LAYOUT_FORMAT = 'json'
+    LAYOUT_COMPRESSION = None
+    # JSON 布局中场和粒子密度网格的编码 (见 layout_encoding.py)：'auto' 为每张网格选择最短的编码，
+    # 也可以指定 'dense'、'coo'、'rle'、'uint8' 或 'uint16'；LAYOUT_GRID_ENCODINGS 按名字覆盖，例如 {'light_level': 'uint8'}。
+    # LAYOUT_QUANTIZATION 是 'auto' 对浮点场允许的有损量化，None 表示只使用无损编码
+    LAYOUT_GRID_ENCODING = 'auto'
+    LAYOUT_GRID_ENCODINGS = {}
+    LAYOUT_QUANTIZATION = 'uint16'
+
+    # --- 分块生成 (chunked_generator.py) ---
+    # 每块的核心边长；光环 (每块向外多生成、但不保留的一圈) 宽度为 None 时按最大的影响半径自动确定。
+    # 对象数量 (NUM_TABLES 等) 被解释为每 GRID_WIDTH × GRID_HEIGHT 面积上的密度
+    CHUNK_TILE_SIZE = 128
+    CHUNK_HALO = None
+    CHUNK_WORKERS = 1
+
     # --- 阶段一: 桌子生成 ---
     NUM_TABLES = 24
     TABLE_SIZE = (2, 1)  # (width, height) in grid units
@@ -43,6 +113,7 @@ class Settings:
     NUM_ELVES = 15
     NUM_DWARVES = 30
     NUM_MUSHROOM_PEOPLE = 20
+    CHARACTER_MIN_SPACING = 0.8  # 任意两个角色之间的最小距离 (单位:格子)，0 表示不限制
 
     # 舒适度地图权重
     SOCIAL_ATTRACTION_STRENGTH = 2.0  # 对家具的吸引力
@@ -58,6 +129,9 @@ class Settings:
     WINDOW_SIZE = (1, 1) # 假设窗户是1x1
     NUM_TORCHES = 15
     TORCH_SIZE = (1, 1)
+    WINDOW_LIGHT_SIGMA = 8.0  # 窗户光照的扩散半径
+    TORCH_LIGHT_SIGMA = 4.0  # 火把光照的扩散半径
+    TORCH_WALL_ATTRACTION_SIGMA = 6.0  # 墙壁对火把的吸引半径
 
     # --- 可视化 ---
     COLORS = {
@@ -0,0 +1,115 @@
+import numpy as np
+
+
+def sample_cells(weights: np.ndarray, count: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    按权重有放回地一次抽取 count 个下标 (累积和 + 二分查找)。
+    构建 O(n)，每次抽样 O(log n)，全部是整块数组运算；权重之和必须大于 0。
+    """
+    cdf = np.cumsum(weights, dtype=np.float64)
+    u = rng.random(count) * cdf[-1]
+    indices = np.searchsorted(cdf, u, side='right')
+    # 浮点舍入可能让 u 恰好等于 cdf[-1]
+    return np.minimum(indices, len(cdf) - 1)
+
+
+def sample_one_cell(weights: np.ndarray, rng: np.random.Generator, scratch: np.ndarray = None) -> int:
+    """
+    按权重抽取一个下标，结果与 rng.choice(len(w), p=w / w.sum()) 完全一致 (消耗相同的随机数)，
+    但累积分布直接写入 scratch (与 weights 同长度的一维 float64 数组)，不分配新的整张数组。
+    """
+    flat = weights.reshape(-1)
+    cdf = np.empty(flat.size) if scratch is None else scratch
+    np.true_divide(flat, flat.sum(), out=cdf)
+    np.cumsum(cdf, out=cdf)
+    cdf /= cdf[-1]
+    return int(np.searchsorted(cdf, rng.random(), side='right'))
+
+
+class WeightedCellSampler:
+    """
+    基于完全二叉求和树 (sum tree) 的加权格子采样器。
+
+    用一张概率层构建一次 (O(W·H)，逐层向量化求和)，之后：
+      - 按权重抽取一个格子：O(log n)
+      - 把任意一组格子清零或改权重：O(k log n)
+    因此连续放置 K 个物体的总代价是 O(W·H + K log(W·H))，
+    不必像 np.random.choice(p=...) 那样每抽一次都重新展平、求和、归一化整张图。
+    """
+
+    def __init__(self, weights: np.ndarray):
+        weights = np.asarray(weights, dtype=np.float64)
+        self.shape = weights.shape
+        self.n = weights.size
+        self._leaf_offset = 1 << max(0, (self.n - 1).bit_length())
+
+        self._tree = np.zeros(2 * self._leaf_offset, dtype=np.float64)
+        leaves = self._tree[self._leaf_offset:self._leaf_offset + self.n]
+        np.clip(weights.reshape(-1), 0, None, out=leaves)
+
+        level = self._leaf_offset
+        while level > 1:
+            half = level // 2
+            np.add(self._tree[level:2 * level:2], self._tree[level + 1:2 * level:2], out=self._tree[half:level])
+            level = half
+
+    @property
+    def total(self) -> float:
+        """当前所有权重之和。"""
+        return float(self._tree[1]) if self.n > 0 else 0.0
+
+    @property
+    def weights(self) -> np.ndarray:
+        """当前权重 (与输入同形状的视图)，不要直接修改，请使用 set_weights / set_rect。"""
+        return self._tree[self._leaf_offset:self._leaf_offset + self.n].reshape(self.shape)
+
+    def sample(self, rng: np.random.Generator) -> int:
+        """按权重抽取一个格子，返回展平后的下标。调用前应确认 total > 0。"""
+        tree = self._tree
+        u = rng.random() * tree[1]
+        node = 1
+        while node < self._leaf_offset:
+            left = 2 * node
+            left_weight = tree[left]
+            if u < left_weight or tree[left + 1] <= 0.0:
+                node = left
+            else:
+                u -= left_weight
+                node = left + 1
+        return node - self._leaf_offset
+
+    def sample_many(self, rng: np.random.Generator, count: int) -> np.ndarray:
+        """有放回地一次抽取 count 个格子 (逐层向量化下降)，返回展平后的下标数组。"""
+        tree = self._tree
+        u = rng.random(count) * tree[1]
+        nodes = np.ones(count, dtype=np.int64)
+        while self._leaf_offset > 1 and nodes[0] < self._leaf_offset:
+            left = 2 * nodes
+            left_weight = tree[left]
+            go_left = (u < left_weight) | (tree[left + 1] <= 0.0)
+            u = np.where(go_left, u, u - left_weight)
+            nodes = np.where(go_left, left, left + 1)
+        return nodes - self._leaf_offset
+
+    def set_weights(self, flat_indices: np.ndarray, values) -> None:
+        """修改一组格子的权重，并只重算它们的祖先节点。"""
+        flat_indices = np.asarray(flat_indices, dtype=np.int64).reshape(-1)
+        if flat_indices.size == 0:
+            return
+        nodes = flat_indices + self._leaf_offset
+        self._tree[nodes] = np.clip(values, 0, None)
+
+        # 直接由子节点重算 (而不是累加差值)，避免浮点误差随更新次数累积
+        while nodes[0] > 1:
+            nodes = np.unique(nodes >> 1)
+            self._tree[nodes] = self._tree[2 * nodes] + self._tree[2 * nodes + 1]
+
+    def set_rect(self, x0: int, y0: int, x1: int, y1: int, values) -> None:
+        """修改二维矩形 [x0, x1) × [y0, y1) 内格子的权重 (values 可以是标量或同形状数组)。"""
+        x0, y0 = max(0, x0), max(0, y0)
+        x1, y1 = min(self.shape[0], x1), min(self.shape[1], y1)
+        if x1 <= x0 or y1 <= y0:
+            return
+        xs, ys = np.meshgrid(np.arange(x0, x1), np.arange(y0, y1), indexing='ij')
+        flat_indices = np.ravel_multi_index((xs.reshape(-1), ys.reshape(-1)), self.shape)
+        self.set_weights(flat_indices, np.broadcast_to(values, xs.shape).reshape(-1))
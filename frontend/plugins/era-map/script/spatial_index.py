@@ -0,0 +1,208 @@
+import math
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from object_store import ObjectTable, TypeFilter
+
+
+class SpatialHash:
+    """
+    对象表上的均匀网格哈希，用于“某点半径 r 内有哪些对象”和最近邻查询。
+
+    索引按对象的视觉位置分桶，以 CSR 形式存储 (按桶排序的行号 + 每个桶的起止下标)。
+    它是惰性维护的：查询时如果对象表只发生过追加，新对象先进入一个小的增量桶字典，
+    积累到一定数量再整体重建；发生过删除 (行号移动) 则直接重建。
+    越出网格范围的对象被归入边缘的桶，查询时仍按真实距离过滤，因此结果总是精确的。
+    """
+
+    def __init__(self, table: ObjectTable, width: float, height: float, cell_size: float = 2.0):
+        self.table = table
+        self.cell_size = float(cell_size)
+        self.nx = max(1, int(math.ceil(width / self.cell_size)))
+        self.ny = max(1, int(math.ceil(height / self.cell_size)))
+
+        self._starts = np.zeros(self.nx * self.ny + 1, dtype=np.int64)
+        self._rows = np.empty(0, dtype=np.int64)
+        self._indexed_count = 0
+        self._built_removal_version = -1
+        self._pending: Dict[int, List[int]] = {}
+        self._pending_count = 0
+
+    # --- 维护 ---
+
+    def _cells_of(self, positions: np.ndarray) -> np.ndarray:
+        cx = np.clip(np.floor(positions[:, 0] / self.cell_size), 0, self.nx - 1).astype(np.int64)
+        cy = np.clip(np.floor(positions[:, 1] / self.cell_size), 0, self.ny - 1).astype(np.int64)
+        return cx * self.ny + cy
+
+    def _rebuild(self):
+        table = self.table
+        cells = self._cells_of(table.visual_pos)
+        self._rows = np.argsort(cells, kind='stable')
+        counts = np.bincount(cells, minlength=self.nx * self.ny)
+        self._starts[0] = 0
+        np.cumsum(counts, out=self._starts[1:])
+        self._indexed_count = len(table)
+        self._built_removal_version = table.removal_version
+        self._pending.clear()
+        self._pending_count = 0
+
+    def sync(self):
+        """让索引与对象表保持一致 (查询前会自动调用)。"""
+        table = self.table
+        if table.removal_version != self._built_removal_version:
+            self._rebuild()
+            return
+
+        new_count = len(table) - self._indexed_count - self._pending_count
+        if new_count <= 0:
+            return
+        if self._pending_count + new_count > max(64, self._indexed_count // 4):
+            self._rebuild()
+            return
+
+        start = self._indexed_count + self._pending_count
+        new_rows = np.arange(start, start + new_count)
+        for row, cell in zip(new_rows.tolist(), self._cells_of(table.visual_pos[new_rows]).tolist()):
+            self._pending.setdefault(cell, []).append(row)
+        self._pending_count += new_count
+
+    # --- 查询 ---
+
+    def _rows_in_cells(self, cx0: int, cy0: int, cx1: int, cy1: int) -> np.ndarray:
+        """
+        闭区间 [cx0, cx1] × [cy0, cy1] 内所有桶中的行号。
+        桶坐标被夹到网格范围内 (与 _cells_of 一致)，因此越界的区域会落到边缘的桶上。
+        """
+        cx0, cx1 = min(max(cx0, 0), self.nx - 1), min(max(cx1, 0), self.nx - 1)
+        cy0, cy1 = min(max(cy0, 0), self.ny - 1), min(max(cy1, 0), self.ny - 1)
+
+        # 同一列 (固定 cx) 中连续的 cy 对应 CSR 中连续的一段
+        parts = []
+        for cx in range(cx0, cx1 + 1):
+            base = cx * self.ny
+            parts.append(self._rows[self._starts[base + cy0]:self._starts[base + cy1 + 1]])
+        if self._pending:
+            for cx in range(cx0, cx1 + 1):
+                for cy in range(cy0, cy1 + 1):
+                    pending = self._pending.get(cx * self.ny + cy)
+                    if pending:
+                        parts.append(np.asarray(pending, dtype=np.int64))
+        return np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+
+    def _ring_rows(self, cx: int, cy: int, ring: int) -> np.ndarray:
+        """以桶 (cx, cy) 为中心、切比雪夫距离恰好为 ring 的一圈桶中的行号 (越界的桶直接跳过)。"""
+        if ring == 0:
+            return self._rows_in_cells(cx, cy, cx, cy)
+        y0, y1 = max(cy - ring, 0), min(cy + ring, self.ny - 1)
+        parts = []
+        for x in (cx - ring, cx + ring):  # 左右两列 (含角)
+            if 0 <= x < self.nx:
+                parts.append(self._rows_in_cells(x, y0, x, y1))
+        x0, x1 = max(cx - ring + 1, 0), min(cx + ring - 1, self.nx - 1)
+        if x0 <= x1:
+            for y in (cy - ring, cy + ring):  # 上下两行 (不含角)
+                if 0 <= y < self.ny:
+                    parts.append(self._rows_in_cells(x0, y, x1, y))
+        return np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+
+    def _filter_types(self, rows: np.ndarray, types: Optional[TypeFilter]) -> np.ndarray:
+        if types is None or len(rows) == 0:
+            return rows
+        codes = self.table._codes_for(types)
+        return rows[np.isin(self.table.type_codes[rows], codes)]
+
+    def query_radius(
+            self,
+            point,
+            radius: float,
+            types: Optional[TypeFilter] = None,
+            strict: bool = False
+    ) -> np.ndarray:
+        """
+        返回视觉位置与 point 距离不超过 radius 的对象行号 (可按类型过滤)，按行号排序。
+        strict=True 时只返回距离严格小于 radius 的对象，与 SpacingGrid 的最小间距判定一致。
+        """
+        self.sync()
+        px, py = float(point[0]), float(point[1])
+        cs = self.cell_size
+        rows = self._rows_in_cells(
+            int(math.floor((px - radius) / cs)), int(math.floor((py - radius) / cs)),
+            int(math.floor((px + radius) / cs)), int(math.floor((py + radius) / cs))
+        )
+        rows = self._filter_types(rows, types)
+        if len(rows) == 0:
+            return rows
+        d = self.table.visual_pos[rows] - np.array([px, py], dtype=np.float32)
+        dist_sq = np.einsum('ij,ij->i', d, d)
+        inside = dist_sq < radius * radius if strict else dist_sq <= radius * radius
+        return np.sort(rows[inside])
+
+    def nearest(
+            self,
+            point,
+            k: int = 1,
+            max_radius: Optional[float] = None,
+            types: Optional[TypeFilter] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        返回距离 point 最近的至多 k 个对象 (行号, 距离)，按距离升序。
+        从所在的桶开始一圈圈向外扩展，直到找到的第 k 近对象比下一圈更近为止。
+        """
+        self.sync()
+        px, py = float(point[0]), float(point[1])
+        cs = self.cell_size
+        cx = min(max(int(math.floor(px / cs)), 0), self.nx - 1)
+        cy = min(max(int(math.floor(py / cs)), 0), self.ny - 1)
+        limit = math.inf if max_radius is None else max_radius
+        max_ring = max(self.nx, self.ny)
+
+        found_rows = np.empty(0, dtype=np.int64)
+        found_dist = np.empty(0, dtype=np.float64)
+        for ring in range(max_ring + 1):
+            rows = self._filter_types(self._ring_rows(cx, cy, ring), types)
+            if len(rows):
+                d = self.table.visual_pos[rows].astype(np.float64) - (px, py)
+                found_rows = np.concatenate([found_rows, rows])
+                found_dist = np.concatenate([found_dist, np.hypot(d[:, 0], d[:, 1])])
+
+            # 第 ring 圈之外的对象距离至少为 ring * cell_size (点到所在桶边界的距离 >= 0)
+            reach = ring * cs
+            if reach > limit:
+                break
+            if len(found_rows) >= k and np.partition(found_dist, k - 1)[k - 1] <= reach:
+                break
+
+        keep = found_dist <= limit
+        found_rows, found_dist = found_rows[keep], found_dist[keep]
+        order = np.argsort(found_dist, kind='stable')[:k]
+        return found_rows[order], found_dist[order]
+
+
+class SpacingGrid:
+    """
+    最小间距约束用的哈希网格 (桶边长等于 min_spacing)。
+    判断一个候选点是否与已有点过近只需检查周围 3×3 个桶，期望 O(1)。
+    距离恰好等于 min_spacing 视为满足间距。
+    """
+
+    def __init__(self, min_spacing: float):
+        self.min_spacing = float(min_spacing)
+        self._min_sq = self.min_spacing ** 2
+        self._buckets: Dict[Tuple[int, int], List[Tuple[float, float]]] = {}
+
+    def _key(self, x: float, y: float) -> Tuple[int, int]:
+        return int(math.floor(x / self.min_spacing)), int(math.floor(y / self.min_spacing))
+
+    def add(self, x: float, y: float):
+        self._buckets.setdefault(self._key(x, y), []).append((x, y))
+
+    def is_free(self, x: float, y: float) -> bool:
+        kx, ky = self._key(x, y)
+        for i in (kx - 1, kx, kx + 1):
+            for j in (ky - 1, ky, ky + 1):
+                for ox, oy in self._buckets.get((i, j), ()):
+                    if (ox - x) ** 2 + (oy - y) ** 2 < self._min_sq:
+                        return False
+        return True
@@ -0,0 +1,280 @@
+"""
+管道级的磁盘检查点缓存。
+
+run_pipelines 依次运行桌子、椅子、光照、脏污和角色管道。设置了 Settings.STAGE_CACHE_DIR 时，
+每条管道的输出 (对象表、占用索引、层、场、粒子层和随机数流计数) 以 .npz 快照存在磁盘上，
+键由它的全部输入决定：
+  - 上游状态：第一条管道是初始上下文内容的哈希 (网格、种子、数值类型、占用……)，
+    之后每条管道的上游就是前一条管道的键 (输出由输入唯一确定，键相同即状态相同)；
+  - 管道读取的 Settings 字段的取值；
+  - 生成器代码本身 (脚本目录下所有 .py 文件的哈希，代码一改全部失效)。
+随机数流按 (名字, 序号) 从种子派生 (见 GenerationContext.spawn_rng)，种子已经包含在上游状态中，
+计数器随快照一起恢复，因此命中缓存之后的管道拿到的随机数与完整运行时逐位相同。
+
+管道读取了哪些 Settings 字段是在运行时记录的，而不是手写的清单：
+第一次运行时用一个记录属性访问的代理包装 settings，把读到的字段名存为清单 (按管道和上游状态区分)，
+之后先读清单，再按清单中字段的当前取值计算键。只修改后面管道读取的字段时 (例如 NUM_TORCHES)，
+前面管道的键不变，直接从快照恢复。
+
+快照按总大小做 LRU 淘汰 (disk_cache.LruDirectory)，多个进程可以共享同一个缓存目录。
+"""
+import hashlib
+import json
+import logging
+import os
+from typing import Callable, Dict, Optional, Set, Tuple
+
+import numpy as np
+
+from core_types import GenerationContext, ParticleLayer
+from disk_cache import LruDirectory
+from prototype import Settings
+
+LOGGER = logging.getLogger('era_map.stage_cache')
+
+# 快照格式的版本，格式改变时递增
+STAGE_CACHE_VERSION = 2
+
+# 不影响生成结果的字段 (并发线程数、日志、导出……)，读取它们不会让缓存失效
+RESULT_NEUTRAL_SETTINGS = frozenset({
+    'STAGE_WORKERS', 'LAZY_LAYERS', 'LAYER_MEMORY_BUDGET_MB', 'LAYER_SPILL_DIR', 'LAYER_STORAGE', 'MEMMAP_LAYERS',
+    'LAYER_STORAGE_DIR', 'PROFILE', 'PROFILE_TRACE_MEMORY', 'PROFILE_REPORT', 'OUTPUT_LOG_LEVEL',
+    'STAGE_CACHE_DIR', 'STAGE_CACHE_BUDGET_MB', 'COLORS',
+})
+
+# 清单很小，单独放在一个子目录里，限额只需要很小
+_MANIFEST_BUDGET_BYTES = 16 * 1024 * 1024
+
+PipelineFunc = Callable[[GenerationContext, Settings], GenerationContext]
+
+
+def _sha256(*parts) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else repr(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+_CODE_FINGERPRINT: Optional[str] = None
+
+
+def code_fingerprint() -> str:
+    """脚本目录下所有 .py 文件和 NumPy 版本的哈希 (每个进程计算一次)。"""
+    global _CODE_FINGERPRINT
+    if _CODE_FINGERPRINT is None:
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        digest = hashlib.sha256(f"{STAGE_CACHE_VERSION}:{np.__version__}".encode('utf-8'))
+        for name in sorted(os.listdir(script_dir)):
+            if name.endswith('.py'):
+                with open(os.path.join(script_dir, name), 'rb') as f:
+                    digest.update(name.encode('utf-8') + b'\0' + f.read())
+        _CODE_FINGERPRINT = digest.hexdigest()
+    return _CODE_FINGERPRINT
+
+
+def context_state_hash(ctx: GenerationContext) -> str:
+    """
+    上下文中决定后续生成结果的全部内容的哈希：网格与世界的尺寸和位置、种子、数值类型策略、噪声库配置、
+    随机数流计数、对象表、占用索引、层、场和粒子层。存储后端、惰性求值和内存预算不影响结果，不计入。
+    是否保留所有中间层 (layers.retain_all，可视化调试模式) 决定了管道结束后上下文中留下哪些层，因此计入。
+    """
+    digest = hashlib.sha256()
+
+    def update(value):
+        digest.update(value if isinstance(value, bytes) else repr(value).encode('utf-8'))
+        digest.update(b'\0')
+
+    def update_array(array: np.ndarray):
+        update((array.dtype.str, array.shape))
+        update(np.ascontiguousarray(array).tobytes())
+
+    update((ctx.grid_width, ctx.grid_height, ctx.origin, ctx.world_size))
+    for seed_sequence in (ctx.seed_sequence, ctx.world_seed_sequence):
+        update(None if seed_sequence is None else (seed_sequence.entropy, tuple(seed_sequence.spawn_key)))
+    policy = ctx.dtype_policy
+    update((np.dtype(policy.compute).str, sorted(policy.half_layers), np.dtype(policy.field_dtype).str))
+    bank = ctx.noise_bank
+    update(None if bank is None else (bank.tile_size, bank.seeds_per_key, bank.buckets_per_octave, bank.dtype.str))
+    update(sorted(ctx.rng_counters.items()))
+    update(ctx.layers.retain_all)
+    for name, array in sorted(ctx.objects.snapshot().items()):
+        update(name)
+        update_array(array)
+    for name, array in sorted(ctx.occupancy.snapshot().items()):
+        update(name)
+        update_array(array)
+    for name in sorted(ctx.layers):
+        update((name, ctx.layers.lifecycle(name)))
+        update_array(ctx.layers.read(name))
+    for name in sorted(ctx.fields):
+        update(name)
+        update_array(np.asarray(ctx.fields[name]))
+    for name in sorted(ctx.particles):
+        layer = ctx.particles[name]
+        update((name, layer.type, layer.seed))
+        update_array(np.asarray(layer.density_grid))
+    return digest.hexdigest()
+
+
+class _RecordingSettings:
+    """把属性访问转发给 settings，并记录读取过的字段名 (全大写的属性)。"""
+
+    def __init__(self, settings: Settings):
+        object.__setattr__(self, '_settings', settings)
+        object.__setattr__(self, 'read', set())
+
+    def __getattr__(self, name: str):
+        value = getattr(self._settings, name)
+        if name.isupper():
+            self.read.add(name)
+        return value
+
+    def __setattr__(self, name, value):
+        raise AttributeError("管道不应修改 Settings")
+
+
+def _settings_values(settings: Settings, names) -> Dict[str, str]:
+    return {name: repr(getattr(settings, name, None)) for name in sorted(set(names) - RESULT_NEUTRAL_SETTINGS)}
+
+
+class StageCache:
+    """
+    管道级的磁盘检查点缓存 (原理见模块说明)。
+
+    用法 (run_pipelines 中):
+        state = cache.initial_state(ctx)
+        ctx, state = cache.run('tables', table_generation_pipeline, ctx, settings, state)
+        ctx, state = cache.run('chairs', chair_placement_pipeline, ctx, settings, state)
+    """
+
+    def __init__(self, root_dir: str, size_budget_bytes: int):
+        self.snapshots = LruDirectory(root_dir, size_budget_bytes, suffix='.npz')
+        self.manifests = LruDirectory(os.path.join(root_dir, 'manifests'), _MANIFEST_BUDGET_BYTES, suffix='.json')
+        # 统计
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_settings(cls, settings: Settings) -> Optional['StageCache']:
+        """按 Settings.STAGE_CACHE_DIR 创建缓存；没有设置时返回 None。"""
+        if not settings.STAGE_CACHE_DIR:
+            return None
+        return cls(settings.STAGE_CACHE_DIR, int(settings.STAGE_CACHE_BUDGET_MB * 1024 * 1024))
+
+    def initial_state(self, ctx: GenerationContext) -> str:
+        """第一条管道的上游状态：初始上下文内容和生成器代码的哈希。"""
+        return _sha256('initial', code_fingerprint(), context_state_hash(ctx))
+
+    def run(
+            self,
+            name: str,
+            pipeline: PipelineFunc,
+            ctx: GenerationContext,
+            settings: Settings,
+            upstream: str
+    ) -> Tuple[GenerationContext, str]:
+        """
+        在作用域 name 中运行一条管道，或者从缓存中恢复它的输出。
+        返回上下文和这条管道输出状态的键 (作为下一条管道的上游状态)。
+        """
+        manifest_key = _sha256('manifest', name, upstream)
+        settings_read = self._read_manifest(manifest_key)
+        if settings_read is not None:
+            key = _sha256('stage', manifest_key, _settings_values(settings, settings_read))
+            if self.snapshots.contains(key) and self._restore(ctx, key):
+                self.snapshots.touch(key)
+                self.hits += 1
+                LOGGER.info("--- [缓存] 管道 '%s' 命中缓存，跳过 (%s) ---", name, key[:12])
+                return ctx, key
+
+        self.misses += 1
+        recording = _RecordingSettings(settings)
+        with ctx.layers.scope(name):
+            ctx = pipeline(ctx, recording)
+        key = _sha256('stage', manifest_key, _settings_values(settings, recording.read))
+        self._write_manifest(manifest_key, recording.read)
+        self.snapshots.store(key, lambda path: self._write_snapshot(ctx, name, path))
+        LOGGER.info("--- [缓存] 管道 '%s' 的输出已缓存 (%s) ---", name, key[:12])
+        return ctx, key
+
+    # --- 清单 ---
+
+    def _read_manifest(self, manifest_key: str) -> Optional[Set[str]]:
+        try:
+            with open(self.manifests.path_for(manifest_key), encoding='utf-8') as f:
+                names = json.load(f)["settings"]
+        except (OSError, ValueError, KeyError):
+            return None
+        self.manifests.touch(manifest_key)
+        return set(names)
+
+    def _write_manifest(self, manifest_key: str, names: Set[str]):
+        def write(path):
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump({"settings": sorted(names)}, f)
+        self.manifests.store(manifest_key, write)
+
+    # --- 快照 ---
+
+    @staticmethod
+    def _write_snapshot(ctx: GenerationContext, name: str, path: str):
+        arrays: Dict[str, np.ndarray] = {}
+        for key, array in ctx.objects.snapshot().items():
+            arrays['objects/' + key] = array
+        for key, array in ctx.occupancy.snapshot().items():
+            arrays['occupancy/' + key] = array
+        layer_names = list(ctx.layers)
+        for i, layer_name in enumerate(layer_names):
+            arrays[f'layers/{i}'] = ctx.layers.read(layer_name)
+        for i, field_name in enumerate(ctx.fields):
+            arrays[f'fields/{i}'] = np.asarray(ctx.fields[field_name])
+        for i, particle_name in enumerate(ctx.particles):
+            arrays[f'particles/{i}'] = np.asarray(ctx.particles[particle_name].density_grid)
+
+        meta = {
+            "stage": name,
+            "rngCounters": ctx.rng_counters,
+            "samplesDrawn": ctx.samples_drawn,
+            # 层名可能包含任意字符，数组按序号存放
+            "layers": [[layer_name, ctx.layers.lifecycle(layer_name)] for layer_name in layer_names],
+            "fields": list(ctx.fields),
+            "particles": [[n, layer.type, layer.seed] for n, layer in ctx.particles.items()],
+        }
+        arrays['meta'] = np.array(json.dumps(meta))
+        with open(path, 'wb') as f:
+            np.savez(f, **arrays)
+
+    def _restore(self, ctx: GenerationContext, key: str) -> bool:
+        """把快照恢复到 ctx 中。快照读取失败 (例如刚被其他进程淘汰) 时返回 False，ctx 保持不变。"""
+        try:
+            with np.load(self.snapshots.path_for(key)) as data:
+                arrays = {name: data[name] for name in data.files}
+        except (OSError, ValueError):
+            return False
+        meta = json.loads(str(arrays['meta']))
+
+        ctx.objects.restore_snapshot(
+            {name[len('objects/'):]: array for name, array in arrays.items() if name.startswith('objects/')}
+        )
+        ctx.occupancy.restore_snapshot(
+            {name[len('occupancy/'):]: array for name, array in arrays.items() if name.startswith('occupancy/')}
+        )
+        for layer_name in list(ctx.layers):
+            del ctx.layers[layer_name]
+        for i, (layer_name, lifecycle) in enumerate(meta["layers"]):
+            ctx.layers.set_lifecycle(layer_name, lifecycle)
+            ctx.layers[layer_name] = arrays[f'layers/{i}']
+        ctx.fields.clear()
+        for i, field_name in enumerate(meta["fields"]):
+            ctx.fields[field_name] = ctx.storage.store(field_name, arrays[f'fields/{i}'], arrays[f'fields/{i}'].dtype)
+        ctx.particles.clear()
+        for i, (particle_name, particle_type, seed) in enumerate(meta["particles"]):
+            grid = arrays[f'particles/{i}']
+            ctx.particles[particle_name] = ParticleLayer(
+                type=particle_type, seed=seed, density_grid=ctx.storage.store(particle_type, grid, grid.dtype)
+            )
+        ctx.rng_counters.clear()
+        ctx.rng_counters.update(meta["rngCounters"])
+        ctx.samples_drawn = meta["samplesDrawn"]
+        return True
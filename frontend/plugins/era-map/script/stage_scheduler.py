@@ -0,0 +1,237 @@
+"""
+管道内的阶段调度。
+
+修改器和放置策略用 @declares 声明它们的哪些参数是读取 / 写入的层名 (以及是否读写对象表、占用索引)。
+管道把一串互不相干的准备步骤加入 StageGraph，调度器按声明的读写关系建立依赖图，
+在线程池中并发运行互相独立的阶段 (NumPy / SciPy 的整图运算会释放 GIL)，有依赖的阶段按加入的顺序执行。
+
+结果与串行执行逐位相同：
+  - 每个阶段只读写自己声明的层，写同一个层 (或读写同一个资源) 的阶段之间总是按加入顺序执行；
+  - 随机数流按名字派生 (GenerationContext.spawn_rng)，与阶段执行的先后无关；
+  - 放置策略声明写入对象表和占用索引，因此它们彼此之间、以及与读取对象的阶段之间总是串行的。
+"""
+import inspect
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+from core_types import GenerationContext, ModifierFunc
+from instrumentation import Span
+
+LOGGER = logging.getLogger('era_map.stage_scheduler')
+
+# 不是层的共享资源，以 '@' 开头以免与层名冲突
+OBJECTS = '@objects'
+OCCUPANCY = '@occupancy'
+FIELDS = '@fields'
+
+# STAGE_WORKERS 为 None 时最多使用的线程数 (一条管道里能同时运行的准备阶段很少超过这个数)
+DEFAULT_MAX_STAGE_WORKERS = 4
+
+
+@dataclass(frozen=True)
+class LayerIO:
+    """一个修改器 / 放置策略的读写声明：层名参数的名字，或 '@' 开头的资源名。"""
+    reads: Tuple[str, ...] = ()
+    writes: Tuple[str, ...] = ()
+
+
+def declares(reads: Iterable[str] = (), writes: Iterable[str] = ()) -> Callable:
+    """
+    声明修改器 / 放置策略读取和写入的层。
+    reads / writes 中的名字是函数的参数名 (调用时传入的字符串即为层名)，或者 OBJECTS 这类资源名。
+    写入参数的值为 None 时 (例如 target_layer_name 缺省)，视为原地写入它读取的层。
+    """
+    io = LayerIO(tuple(reads), tuple(writes))
+
+    def decorate(func):
+        func.layer_io = io
+        return func
+
+    return decorate
+
+
+@dataclass(frozen=True)
+class Stage:
+    """调度的基本单位：一个只接受上下文的函数，以及它读写的层名和资源名。"""
+    name: str
+    func: ModifierFunc
+    reads: FrozenSet[str] = frozenset()
+    writes: FrozenSet[str] = frozenset()
+
+    @property
+    def layers(self) -> Set[str]:
+        """阶段读写的层 (不含资源)。"""
+        return {name for name in self.reads | self.writes if not name.startswith('@')}
+
+
+def stage_for_call(func: Callable, *args, **kwargs) -> Stage:
+    """
+    把一次修改器调用 func(ctx, *args, **kwargs) 包装成阶段，读写的层由 func 的 @declares 声明和实参确定。
+    只有字符串实参被视为层名 (例如放置策略的 layer_source 也可以直接传数组)。
+    """
+    io: Optional[LayerIO] = getattr(func, 'layer_io', None)
+    if io is None:
+        raise ValueError(f"'{func.__name__}' 没有用 @declares 声明读写的层，请用 StageGraph.add 显式给出")
+
+    bound = inspect.signature(func).bind(None, *args, **kwargs)
+    bound.apply_defaults()
+
+    def resolve(names: Tuple[str, ...]) -> Set[str]:
+        resolved = set()
+        for name in names:
+            if name.startswith('@'):
+                resolved.add(name)
+            elif isinstance(bound.arguments.get(name), str):
+                resolved.add(bound.arguments[name])
+        return resolved
+
+    reads = resolve(io.reads)
+    writes = resolve(io.writes)
+    if any(bound.arguments.get(name) is None for name in io.writes if not name.startswith('@')):
+        writes |= {name for name in reads if not name.startswith('@')}
+
+    label = next(iter(sorted(n for n in writes if not n.startswith('@'))), None)
+    return Stage(
+        name=f"{func.__name__}:{label}" if label else func.__name__,
+        func=lambda ctx: func(ctx, *args, **kwargs),
+        reads=frozenset(reads),
+        writes=frozenset(writes),
+    )
+
+
+def resolve_stage_workers(max_workers: Optional[int]) -> int:
+    """STAGE_WORKERS 的取值：None 表示按 CPU 核数自动确定 (不超过 DEFAULT_MAX_STAGE_WORKERS)。"""
+    if max_workers is None:
+        return min(DEFAULT_MAX_STAGE_WORKERS, os.cpu_count() or 1)
+    return max(1, int(max_workers))
+
+
+class StageGraph:
+    """
+    一组阶段及其依赖关系。阶段按加入顺序编号，依赖关系由读写声明推出：
+      - 读一个层的阶段依赖于之前最后一个写它的阶段 (写后读)；
+      - 写一个层的阶段依赖于之前最后一个写它的阶段，以及其后所有读它的阶段 (写后写、读后写)。
+    串行执行 (workers <= 1) 时就是按加入顺序逐个运行，与直接调用完全相同。
+
+    用法:
+        stages = StageGraph('tables')
+        stages.call(create_uniform_layer, 'table_base_suitability', 1.0)
+        stages.call(apply_perlin_noise, 'table_noise', settings.NOISE_SCALE, 1.0)
+        ctx = stages.run(ctx, max_workers=settings.STAGE_WORKERS)
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.stages: List[Stage] = []
+
+    def add(self, name: str, func: ModifierFunc, reads: Iterable[str] = (), writes: Iterable[str] = ()) -> Stage:
+        """加入一个自定义阶段：func(ctx) 只读写 reads / writes 中列出的层和资源。"""
+        stage = Stage(name, func, frozenset(reads), frozenset(writes))
+        self.stages.append(stage)
+        return stage
+
+    def call(self, func: Callable, *args, **kwargs) -> Stage:
+        """加入一次修改器 / 放置策略调用 func(ctx, *args, **kwargs)，读写的层按 @declares 推出。"""
+        stage = stage_for_call(func, *args, **kwargs)
+        self.stages.append(stage)
+        return stage
+
+    def dependencies(self) -> List[Set[int]]:
+        """每个阶段直接依赖的阶段编号。"""
+        return _stage_dependencies(self.stages)
+
+    def levels(self) -> List[List[str]]:
+        """按依赖深度分组的阶段名 (同一组内的阶段可以同时运行)，用于查看并行度。"""
+        depth: List[int] = []
+        for needs in self.dependencies():
+            depth.append(1 + max((depth[j] for j in needs), default=-1))
+        groups: List[List[str]] = [[] for _ in range(max(depth, default=-1) + 1)]
+        for stage, d in zip(self.stages, depth):
+            groups[d].append(stage.name)
+        return groups
+
+    def run(self, ctx: GenerationContext, max_workers: Optional[int] = None) -> GenerationContext:
+        """
+        运行所有阶段并清空图。max_workers 为 None 时按 CPU 核数自动确定，<= 1 时按加入顺序串行运行。
+        某个阶段出错时，不再启动新的阶段，等正在运行的阶段结束后重新抛出第一个异常。
+        """
+        stages, self.stages = self.stages, []
+        workers = min(resolve_stage_workers(max_workers), len(stages))
+        if workers <= 1:
+            for stage in stages:
+                _run_stage(ctx, stage)
+            return ctx
+
+        deps = _stage_dependencies(stages)
+        # 性能分析时，并发阶段的区间挂在发起它们的管道下面
+        parent = ctx.profiler.current() if ctx.profiler is not None else None
+        dependents: List[List[int]] = [[] for _ in stages]
+        for i, needs in enumerate(deps):
+            for j in needs:
+                dependents[j].append(i)
+        remaining = [len(needs) for needs in deps]
+        ready = [i for i, n in enumerate(remaining) if n == 0]
+        error: Optional[BaseException] = None
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"stage-{self.name}") as executor:
+            running = {}
+            while ready or running:
+                # 按加入顺序启动，串行和并发时阶段开始的先后尽量一致 (日志更易读)
+                ready.sort()
+                while ready and error is None:
+                    i = ready.pop(0)
+                    running[executor.submit(_run_stage, ctx, stages[i], parent)] = i
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = running.pop(future)
+                    try:
+                        future.result()
+                    except BaseException as e:
+                        LOGGER.error("!!! 阶段 '%s' 失败: %s !!!", stages[i].name, e)
+                        error = error or e
+                        continue
+                    for j in dependents[i]:
+                        remaining[j] -= 1
+                        if remaining[j] == 0:
+                            ready.append(j)
+        if error is not None:
+            raise error
+        return ctx
+
+
+def _run_stage(ctx: GenerationContext, stage: Stage, parent: Optional[Span] = None):
+    # 阶段运行期间它读写的层不会被其他线程触发的预算检查换出 (见 LayerStore.hold)
+    with ctx.layers.hold(stage.layers):
+        if parent is None:
+            stage.func(ctx)
+        else:
+            with ctx.profiler.attach(parent):
+                stage.func(ctx)
+
+
+def _stage_dependencies(stages: List[Stage]) -> List[Set[int]]:
+    """按 StageGraph 说明中的规则，从读写声明推出每个阶段直接依赖的阶段编号。"""
+    last_writer: Dict[str, int] = {}
+    readers_since_write: Dict[str, List[int]] = {}
+    deps: List[Set[int]] = []
+    for i, stage in enumerate(stages):
+        needs = set()
+        for name in stage.reads | stage.writes:
+            if name in last_writer:
+                needs.add(last_writer[name])
+        for name in stage.writes:
+            needs.update(readers_since_write.get(name, ()))
+        needs.discard(i)
+        deps.append(needs)
+
+        for name in stage.reads - stage.writes:
+            readers_since_write.setdefault(name, []).append(i)
+        for name in stage.writes:
+            last_writer[name] = i
+            readers_since_write[name] = []
+    return deps
@@ -1,7 +1,9 @@
 ﻿import type {IGameEntity} from '#/game-logic/entity/IGameEntity.ts';
 import type {FieldInfo} from '#/game-logic/entity/entityInfo.ts';
 import {EntityInfoType} from '#/game-logic/entity/entityInfo.ts';
-import {Expose} from "class-transformer";
+import type {NumericGrid} from '#/worldGeneration/types.ts';
+import {toPlainGrid} from '#/worldGeneration/binaryLayout.ts';
+import {Expose, Transform} from "class-transformer";
 
 export class FieldEntity implements IGameEntity
 {
@@ -12,9 +14,11 @@ export class FieldEntity implements IGameEntity
     @Expose()
     public readonly name: string;
     @Expose()
-    public readonly data: number[][];
+    // 从二进制布局加载时每行是 TypedArray 视图，存档时转换为普通数组
+    @Transform(({value}) => value && toPlainGrid(value), {toPlainOnly: true})
+    public readonly data: NumericGrid;
 
-    constructor(name: string, data: number[][])
+    constructor(name: string, data: NumericGrid)
     {
         this.name = name;
         this.id = name;
@@ -1,15 +1,21 @@
 ﻿import type {IGameEntity} from '#/game-logic/entity/IGameEntity.ts';
 import type {ParticleInfo} from '#/game-logic/entity/entityInfo.ts';
 import {EntityInfoType} from '#/game-logic/entity/entityInfo.ts';
-import type {ParticleLayerData} from '#/worldGeneration/types.ts';
-import {Expose} from "class-transformer";
+import type {NumericGrid, ParticleLayerData} from '#/worldGeneration/types.ts';
+import {toPlainGrid} from '#/worldGeneration/binaryLayout.ts';
+import {decodeGrid} from '#/worldGeneration/gridEncoding.ts';
+import {Expose, Transform} from "class-transformer";
 
 export class ParticleEntity implements IGameEntity
 {
     @Expose()
     public readonly entityType: string = 'PARTICLE_ENTITY';
     @Expose()
+    // 从二进制布局加载时密度网格的每行是 TypedArray 视图，存档时转换为普通数组；稀疏编码的网格原样存档
+    @Transform(({value}) => value && {...value, densityGrid: toPlainGrid(value.densityGrid)}, {toPlainOnly: true})
     public readonly data: ParticleLayerData;
+    // 按格子查询时才展开的密度网格 (不存档)
+    private denseGrid: NumericGrid | null = null;
 
     constructor(data: ParticleLayerData)
     {
@@ -30,7 +36,8 @@ export class ParticleEntity implements IGameEntity
 
     public getInfoAt(gridX: number, gridY: number): ParticleInfo | null
     {
-        const density = this.data.densityGrid[gridX]?.[gridY];
+        this.denseGrid ??= decodeGrid(this.data.densityGrid);
+        const density = this.denseGrid[gridX]?.[gridY];
         if (density !== undefined && density > 0)
         {
             return {
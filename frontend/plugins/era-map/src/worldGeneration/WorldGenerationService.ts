@@ -9,6 +9,8 @@ import {createGameObjectEntity} from '#/game-logic/entity/gameObject/GameObjectE
 import type {GameObjectEntity} from '#/game-logic/entity/gameObject/GameObjectEntity.ts';
 import {LogicalObjectLayer} from '#/game-logic/entity/gameObject/render/LogicalObjectLayer.ts';
 import {kenney_roguelike_rpg_pack} from '#/game-resource/tilesetRegistry.ts';
+import {decompressLayout, isBinaryLayout, parseBinaryLayout, type LayoutCompression} from '#/worldGeneration/binaryLayout.ts';
+import {decodeGrid} from '#/worldGeneration/gridEncoding.ts';
 
 /**
  * 一个临时的辅助函数，用于创建带墙壁的矩形背景。
@@ -61,14 +63,14 @@ class WorldGenerationService
             backgroundLayout,
         ));
 
-        // 2. 根据数据创建场实体和图层
-        const fieldEntities = Object.entries(layoutData.fields).map(([name, data]) => new FieldEntity(name, data));
+        // 2. 根据数据创建场实体和图层 (量化、稀疏等编码的场在这里解码，见 gridEncoding.ts)
+        const fieldEntities = Object.entries(layoutData.fields).map(([name, data]) => new FieldEntity(name, decodeGrid(data)));
         if (fieldEntities.length > 0)
         {
             layers.push(new FieldContainerLayer(fieldEntities));
         }
 
-        // 3. 根据数据创建粒子实体和图层
+        // 3. 根据数据创建粒子实体和图层 (稀疏编码的密度网格保持编码形式，由渲染器和 getInfoAt 解码)
         const particleEntities = Object.values(layoutData.particles).map(particleData => new ParticleEntity(particleData));
         if (particleEntities.length > 0)
         {
@@ -88,6 +90,43 @@ class WorldGenerationService
             layers,
         );
     }
+
+    /**
+     * 从 (未压缩的) 二进制布局创建 GameMap。场和粒子密度网格直接映射在 buffer 上，不复制。
+     * @param buffer - 由 script/layout_binary.py 写出的 layout.bin 的内容。
+     * @returns 一个全新的 GameMap 实例。
+     */
+    public createFromBinaryLayout(buffer: ArrayBuffer): GameMap
+    {
+        return this.createFromInitialLayout(parseBinaryLayout(buffer));
+    }
+
+    /**
+     * 下载并加载一个布局文件：layout.json、layout.bin，或 gzip / brotli 压缩的 layout.bin.gz / layout.bin.br。
+     * 格式按内容识别 (二进制布局的魔数、gzip 的魔数)，brotli 按扩展名 '.br' 识别。
+     * @param url - 布局文件的地址。
+     * @returns 一个全新的 GameMap 实例。
+     */
+    public async loadFromUrl(url: string): Promise<GameMap>
+    {
+        const response = await fetch(url);
+        if (!response.ok)
+        {
+            throw new Error(`Failed to load layout "${url}": ${response.status} ${response.statusText}`);
+        }
+        const compression: LayoutCompression | undefined = url.endsWith('.br') ? 'brotli' : undefined;
+        // 服务器以 Content-Encoding 传输时 fetch 已经解压过了，这里只处理仍然带着压缩的数据
+        let buffer = await response.arrayBuffer();
+        if (!isBinaryLayout(buffer))
+        {
+            buffer = await decompressLayout(buffer, compression);
+        }
+        if (isBinaryLayout(buffer))
+        {
+            return this.createFromBinaryLayout(buffer);
+        }
+        return this.createFromInitialLayout(JSON.parse(new TextDecoder().decode(buffer)));
+    }
 }
 
 export const worldGenerationService = new WorldGenerationService();
\ No newline at end of file
@@ -0,0 +1,206 @@
+﻿import type {EncodedGrid, FullLayoutData, NumericGrid, NumericRow, RawGameObjectData} from '#/worldGeneration/types.ts';
+
+/**
+ * 二进制布局 (由 script/layout_binary.py 写出) 的读取。
+ *
+ * 文件由 12 字节的前导 (魔数 'ERAM'、uint16 版本、uint16 保留、uint32 头部长度)、UTF-8 JSON 头部
+ * 和 8 字节对齐的小端序数组段组成。数组段直接用 TypedArray 映射在文件缓冲区上，不复制、不解析数字文本；
+ * 网格的每一行 (grid[x]) 是同一块缓冲区上的 subarray 视图。解析结果与 JSON 布局的 FullLayoutData 结构相同。
+ */
+
+const MAGIC = 'ERAM';
+const SUPPORTED_VERSION = 1;
+const PREAMBLE_BYTES = 12;
+const ALIGNMENT = 8;
+
+const TYPED_ARRAYS = {
+    uint8: Uint8Array,
+    int8: Int8Array,
+    uint16: Uint16Array,
+    int16: Int16Array,
+    uint32: Uint32Array,
+    int32: Int32Array,
+    float32: Float32Array,
+    float64: Float64Array,
+};
+
+// TypedArray 使用平台字节序，数组段是小端序的，只有在小端序平台上才能直接映射
+const IS_LITTLE_ENDIAN = new Uint8Array(new Uint16Array([1]).buffer)[0] === 1;
+
+interface SectionDescriptor
+{
+    dtype: keyof typeof TYPED_ARRAYS;
+    shape: number[];
+    offset: number; // 相对数据区起点的字节偏移
+}
+
+interface BinaryLayoutHeader
+{
+    meta: FullLayoutData['meta'];
+    objectTypes: string[];
+    objects: {
+        count: number;
+        columns: Record<'obj_type' | 'visual_pos' | 'visual_angle' | 'uid' | 'grid_pos' | 'has_grid_pos' | 'grid_size' | 'has_grid_size', SectionDescriptor>;
+    };
+    fields: Record<string, SectionDescriptor>;
+    particles: Record<string, { type: string; seed: number; densityGrid: SectionDescriptor }>;
+}
+
+export type LayoutCompression = 'gzip' | 'brotli' | null;
+
+function alignUp(n: number): number
+{
+    return Math.ceil(n / ALIGNMENT) * ALIGNMENT;
+}
+
+/**
+ * 缓冲区是否以二进制布局的魔数开头 (未压缩)。
+ */
+export function isBinaryLayout(buffer: ArrayBuffer): boolean
+{
+    if (buffer.byteLength < PREAMBLE_BYTES)
+    {
+        return false;
+    }
+    return new TextDecoder().decode(new Uint8Array(buffer, 0, 4)) === MAGIC;
+}
+
+/**
+ * 缓冲区是否是 gzip 压缩的数据。
+ */
+export function isGzip(buffer: ArrayBuffer): boolean
+{
+    const bytes = new Uint8Array(buffer, 0, Math.min(2, buffer.byteLength));
+    return bytes[0] === 0x1f && bytes[1] === 0x8b;
+}
+
+/**
+ * 解压 gzip / brotli 压缩的布局文件。compression 为 undefined 时按 gzip 魔数自动识别 (brotli 没有魔数)。
+ * brotli 需要运行环境的 DecompressionStream 支持；网页上更常见的做法是由服务器以 Content-Encoding: br 传输，
+ * 这时 fetch 得到的已经是解压后的数据。
+ */
+export async function decompressLayout(buffer: ArrayBuffer, compression?: LayoutCompression): Promise<ArrayBuffer>
+{
+    const format = compression === undefined ? (isGzip(buffer) ? 'gzip' : null) : compression;
+    if (format === null)
+    {
+        return buffer;
+    }
+    let stream: DecompressionStream;
+    try
+    {
+        stream = new DecompressionStream(format as CompressionFormat);
+    }
+    catch (e)
+    {
+        throw new Error(`This environment cannot decompress ${format} layouts: ${(e as Error).message}`);
+    }
+    return new Response(new Blob([buffer]).stream().pipeThrough(stream)).arrayBuffer();
+}
+
+/**
+ * 解析 (未压缩的) 二进制布局。所有网格和对象列都直接映射在 buffer 上，调用方不应再修改 buffer。
+ */
+export function parseBinaryLayout(buffer: ArrayBuffer): FullLayoutData
+{
+    if (!IS_LITTLE_ENDIAN)
+    {
+        throw new Error('Binary layouts can only be mapped on little-endian platforms.');
+    }
+    if (!isBinaryLayout(buffer))
+    {
+        throw new Error('Not a binary layout (missing ERAM magic). Is the file still compressed?');
+    }
+
+    const preamble = new DataView(buffer, 0, PREAMBLE_BYTES);
+    const version = preamble.getUint16(4, true);
+    if (version > SUPPORTED_VERSION)
+    {
+        throw new Error(`Unsupported binary layout version ${version} (supported up to ${SUPPORTED_VERSION}).`);
+    }
+    const headerLength = preamble.getUint32(8, true);
+    const header: BinaryLayoutHeader = JSON.parse(
+        new TextDecoder().decode(new Uint8Array(buffer, PREAMBLE_BYTES, headerLength)),
+    );
+    const dataStart = alignUp(PREAMBLE_BYTES + headerLength);
+
+    const view = (section: SectionDescriptor): Exclude<NumericRow, number[]> =>
+    {
+        const TypedArray = TYPED_ARRAYS[section.dtype];
+        if (!TypedArray)
+        {
+            throw new Error(`Unsupported dtype "${section.dtype}" in binary layout.`);
+        }
+        const length = section.shape.reduce((a, b) => a * b, 1);
+        return new TypedArray(buffer, dataStart + section.offset, length);
+    };
+
+    const grid = (section: SectionDescriptor): NumericGrid =>
+    {
+        const [width, height] = section.shape;
+        const flat = view(section);
+        return Array.from({length: width}, (_, x) => flat.subarray(x * height, (x + 1) * height));
+    };
+
+    return {
+        meta: header.meta,
+        objects: readObjects(header, view),
+        fields: Object.fromEntries(
+            Object.entries(header.fields).map(([name, section]) => [name, grid(section)]),
+        ),
+        particles: Object.fromEntries(
+            Object.entries(header.particles).map(([name, layer]) => [name, {
+                type: layer.type,
+                seed: layer.seed,
+                densityGrid: grid(layer.densityGrid),
+            }]),
+        ),
+    };
+}
+
+/**
+ * 把 TypedArray 视图组成的网格转换为普通的嵌套数组 (用于存档：序列化时 TypedArray 会变成以下标为键的对象)。
+ * 编码后的网格 (见 gridEncoding.ts) 本身就是普通对象，原样返回。
+ */
+export function toPlainGrid(grid: NumericGrid | EncodedGrid): number[][] | EncodedGrid
+{
+    if (!Array.isArray(grid))
+    {
+        return grid;
+    }
+    return grid.map(row => Array.isArray(row) ? row : Array.from(row));
+}
+
+/**
+ * 把按列存储的对象还原为与 JSON 布局相同的对象列表 (对象只有几百个，逐个组装的开销可以忽略)。
+ */
+function readObjects(
+    header: BinaryLayoutHeader,
+    view: (section: SectionDescriptor) => Exclude<NumericRow, number[]>,
+): RawGameObjectData[]
+{
+    const columns = header.objects.columns;
+    const typeCodes = view(columns.obj_type);
+    const visualPos = view(columns.visual_pos);
+    const visualAngle = view(columns.visual_angle);
+    const uids = view(columns.uid);
+    const gridPos = view(columns.grid_pos);
+    const hasGridPos = view(columns.has_grid_pos);
+    const gridSize = view(columns.grid_size);
+    const hasGridSize = view(columns.has_grid_size);
+
+    const objects: RawGameObjectData[] = [];
+    for (let i = 0; i < header.objects.count; i++)
+    {
+        objects.push({
+            obj_type: header.objectTypes[typeCodes[i]],
+            visual_pos: [visualPos[2 * i], visualPos[2 * i + 1]],
+            visual_angle: visualAngle[i],
+            uid: uids[i],
+            // 可选属性：只有存在时才添加 (与 JSON 布局一致)
+            ...(hasGridPos[i] ? {grid_pos: [gridPos[2 * i], gridPos[2 * i + 1]]} : {}),
+            ...(hasGridSize[i] ? {grid_size: [gridSize[2 * i], gridSize[2 * i + 1]]} : {}),
+        } as RawGameObjectData);
+    }
+    return objects;
+}
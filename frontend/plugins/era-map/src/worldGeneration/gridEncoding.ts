@@ -0,0 +1,121 @@
+﻿import type {EncodedGrid, NumericGrid, NumericRow} from '#/worldGeneration/types.ts';
+
+/**
+ * JSON 布局中网格编码 (见 script/layout_encoding.py) 的解码。
+ * 解码结果与二进制布局一样，每行 (grid[x]) 是同一块 TypedArray 上的 subarray 视图。
+ */
+
+const TYPED_ARRAYS: Record<string, new (length: number) => Exclude<NumericRow, number[]>> = {
+    uint8: Uint8Array,
+    int8: Int8Array,
+    uint16: Uint16Array,
+    int16: Int16Array,
+    uint32: Uint32Array,
+    int32: Int32Array,
+    float32: Float32Array,
+    float64: Float64Array,
+};
+
+export function isEncodedGrid(grid: NumericGrid | EncodedGrid): grid is EncodedGrid
+{
+    return !Array.isArray(grid);
+}
+
+function rowsOf(flat: Exclude<NumericRow, number[]>, [width, height]: [number, number]): NumericGrid
+{
+    return Array.from({length: width}, (_, x) => flat.subarray(x * height, (x + 1) * height));
+}
+
+function decodeBase64(data: string): Uint8Array
+{
+    const binary = atob(data);
+    const bytes = new Uint8Array(binary.length);
+    for (let i = 0; i < binary.length; i++)
+    {
+        bytes[i] = binary.charCodeAt(i);
+    }
+    return bytes;
+}
+
+/**
+ * 把任意编码的网格还原为 grid[x][y]；dense 网格原样返回。
+ */
+export function decodeGrid(grid: NumericGrid | EncodedGrid): NumericGrid
+{
+    if (!isEncodedGrid(grid))
+    {
+        return grid;
+    }
+    const [width, height] = grid.shape;
+    const size = width * height;
+
+    if (grid.encoding === 'quantized')
+    {
+        const bytes = decodeBase64(grid.data);
+        const quantized = grid.dtype === 'uint16'
+            ? new Uint16Array(bytes.buffer, 0, size) // 新分配的缓冲区从 0 开始，满足对齐要求 (小端序平台)
+            : bytes;
+        const flat = new Float32Array(size);
+        for (let i = 0; i < size; i++)
+        {
+            flat[i] = grid.offset + quantized[i] * grid.scale;
+        }
+        return rowsOf(flat, grid.shape);
+    }
+
+    const flat = new (TYPED_ARRAYS[grid.dtype] ?? Float64Array)(size);
+    if (grid.encoding === 'coo')
+    {
+        for (let k = 0; k < grid.index.length; k++)
+        {
+            flat[grid.index[k]] = grid.values[k];
+        }
+    }
+    else if (grid.encoding === 'rle')
+    {
+        let start = 0;
+        for (let k = 0; k < grid.values.length; k++)
+        {
+            flat.fill(grid.values[k], start, start + grid.lengths[k]);
+            start += grid.lengths[k];
+        }
+    }
+    else
+    {
+        throw new Error(`Unknown grid encoding "${(grid as EncodedGrid).encoding}".`);
+    }
+    return rowsOf(flat, grid.shape);
+}
+
+/**
+ * 按 x 优先、y 其次的顺序遍历网格中所有非零的格子。
+ * 稀疏编码的网格直接遍历记录的格子，不展开成整张网格；遍历顺序与 dense 网格相同。
+ */
+export function forEachNonZero(grid: NumericGrid | EncodedGrid, callback: (x: number, y: number, value: number) => void): void
+{
+    if (isEncodedGrid(grid) && grid.encoding === 'coo')
+    {
+        const height = grid.shape[1];
+        for (let k = 0; k < grid.index.length; k++)
+        {
+            const i = grid.index[k];
+            if (grid.values[k] !== 0)
+            {
+                callback(Math.floor(i / height), i % height, grid.values[k]);
+            }
+        }
+        return;
+    }
+    const dense = decodeGrid(grid);
+    for (let x = 0; x < dense.length; x++)
+    {
+        const row = dense[x];
+        for (let y = 0; y < (row?.length ?? 0); y++)
+        {
+            if (row[y] !== 0)
+            {
+                callback(x, y, row[y]);
+            }
+        }
+    }
+}
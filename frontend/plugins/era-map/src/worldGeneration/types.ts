@@ -5,12 +5,46 @@ export interface RawGameObjectData {
     grid_size?: number[];
     visual_pos: number[];
     visual_angle: number;
+    uid?: number;
 }
 
+// 网格按 grid[x][y] 排列。JSON 布局中每行是普通数组，二进制布局中每行是直接映射在文件缓冲区上的 TypedArray 视图
+export type NumericRow = number[] | Uint8Array | Int8Array | Uint16Array | Int16Array | Uint32Array | Int32Array | Float32Array | Float64Array;
+export type NumericGrid = NumericRow[];
+
+// JSON 布局中网格的紧凑编码 (见 script/layout_encoding.py)，都按 C 顺序展平：下标 i = x * height + y
+export interface CooEncodedGrid {
+    encoding: 'coo';
+    dtype: string;
+    shape: [number, number];
+    index: number[];
+    values: number[];
+}
+
+export interface RleEncodedGrid {
+    encoding: 'rle';
+    dtype: string;
+    shape: [number, number];
+    values: number[];
+    lengths: number[];
+}
+
+// value ≈ offset + q * scale，q 是 base64 存放的小端序无符号整数
+export interface QuantizedGrid {
+    encoding: 'quantized';
+    dtype: 'uint8' | 'uint16';
+    shape: [number, number];
+    scale: number;
+    offset: number;
+    data: string;
+}
+
+export type EncodedGrid = CooEncodedGrid | RleEncodedGrid | QuantizedGrid;
+
 
 export interface FieldLayerData {
     // 场数据是数值类型
-    [fieldName: string]: number[][];
+    [fieldName: string]: NumericGrid | EncodedGrid;
 }
 
 export interface ParticleConfig {
@@ -23,7 +57,7 @@ export interface ParticleConfig {
 export interface ParticleLayerData {
     type: string;
     seed: number;
-    densityGrid: number[][]; // 一般来说应该是整数
+    densityGrid: NumericGrid | EncodedGrid; // 一般来说应该是整数；稀疏的密度网格保持编码形式 (见 gridEncoding.ts)
 }
 
 export interface AllParticleLayersData {